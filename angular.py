@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import math
+import numpy as np
+import utils
+
+# Angular momentum coupling coefficients for the multipole expansions of hf_newton.py
+#
+# The Coulomb and exchange integrals of two orbitals R_a(r) Y_a(O) and R_b(r) Y_b(O) follow from
+# 1/|r1 - r2| = sum_k 4 pi/(2k+1) r<^k/r>^(k+1) sum_q Ykq(O1) Ykq(O2)
+# (with real or complex harmonics, conjugating one of them in the complex case), which separates each
+# of them in radial integrals of the multipoles r<^k/r>^(k+1) and angular integrals of three harmonics,
+# the Gaunt coefficients
+# int Yl1m1 Yl2m2 Yl3m3 dO = sqrt((2l1+1)(2l2+1)(2l3+1)/(4 pi)) (l1 l2 l3; 0 0 0) (l1 l2 l3; m1 m2 m3)
+# for the complex harmonics, where (j1 j2 j3; m1 m2 m3) are the Wigner 3j symbols (Racah's formula below).
+# The real harmonics (Y in hf_newton.py, SphHarmReal in utils.py, with the Condon-Shortley phase) are
+#   Yl0 = Y_l^0
+#   Ylm = ((-1)^m Y_l^m + Y_l^-m)/sqrt(2)     for m > 0
+#   Ylm = ((-1)^m Y_l^|m| - Y_l^m)/(i sqrt(2)) for m < 0
+# so their Gaunt coefficients (realGaunt) are sums of at most eight complex ones.
+# Only integer angular momenta are needed here.
+# The functions below evaluate one coefficient at a time; CouplingTable evaluates all of them up to some lmax
+# once, for the inner loops of hf_newton.py.
+
+# n! as an exact integer, kept in _factorials once calculated
+_factorials = [1]
+def factorial(n):
+    while len(_factorials) <= n:
+        _factorials.append(_factorials[-1]*len(_factorials))
+    return _factorials[n]
+
+# Wigner 3j symbol (j1 j2 j3; m1 m2 m3), with Racah's formula
+def wigner3j(j1, j2, j3, m1, m2, m3):
+    if m1 + m2 + m3 != 0:
+        return 0.0
+    if abs(m1) > j1 or abs(m2) > j2 or abs(m3) > j3:
+        return 0.0
+    if j3 > j1 + j2 or j3 < abs(j1 - j2):
+        return 0.0
+    f = factorial
+    # triangle coefficient and the factorials of j +/- m, exact as integers
+    triangle = f(j1 + j2 - j3)*f(j1 - j2 + j3)*f(-j1 + j2 + j3)
+    norm = f(j1 + m1)*f(j1 - m1)*f(j2 + m2)*f(j2 - m2)*f(j3 + m3)*f(j3 - m3)
+    kmin = max(0, j2 - j3 - m1, j1 - j3 + m2)
+    kmax = min(j1 + j2 - j3, j1 - m1, j2 + m2)
+    s = 0.0
+    for k in range(kmin, kmax+1):
+        d = f(k)*f(j3 - j2 + k + m1)*f(j3 - j1 + k - m2)*f(j1 + j2 - j3 - k)*f(j1 - k - m1)*f(j2 - k + m2)
+        s += (-1.0)**k/float(d)
+    return (-1.0)**(j1 - j2 - m3)*math.sqrt(triangle*norm/float(f(j1 + j2 + j3 + 1)))*s
+
+# Clebsch-Gordan coefficient <j1 m1 j2 m2|j m>, with the arguments in the order of CG in utils.py
+def clebschGordan(j1, j2, m1, m2, j, m):
+    return (-1.0)**(j1 - j2 + m)*math.sqrt(2*j + 1)*wigner3j(j1, j2, j, m1, m2, -m)
+
+# int Y_l1^m1 Y_l2^m2 Y_l3^m3 dO for the complex harmonics
+def gaunt(l1, m1, l2, m2, l3, m3):
+    if m1 + m2 + m3 != 0 or (l1 + l2 + l3) % 2 != 0:
+        return 0.0
+    w = wigner3j(l1, l2, l3, 0, 0, 0)
+    if w == 0:
+        return 0.0
+    return math.sqrt((2*l1+1)*(2*l2+1)*(2*l3+1)/(4*np.pi))*w*wigner3j(l1, l2, l3, m1, m2, m3)
+
+# the real Ylm as [[mu, coefficient of Y_l^mu], ...]
+def _realInComplex(l, m):
+    if m == 0:
+        return [[0, 1.0]]
+    a = abs(m)
+    if m > 0:
+        return [[a, (-1.0)**a/np.sqrt(2)], [-a, 1.0/np.sqrt(2)]]
+    return [[a, (-1.0)**a/(1j*np.sqrt(2))], [-a, -1.0/(1j*np.sqrt(2))]]
+
+# int Yl1m1 Yl2m2 Yl3m3 dO for the real harmonics
+def realGaunt(l1, m1, l2, m2, l3, m3):
+    if (l1 + l2 + l3) % 2 != 0 or l3 > l1 + l2 or l3 < abs(l1 - l2):
+        return 0.0
+    s = 0.0
+    for [mu1, c1] in _realInComplex(l1, m1):
+        for [mu2, c2] in _realInComplex(l2, m2):
+            mu3 = -mu1 - mu2
+            for [mu, c3] in _realInComplex(l3, m3):
+                if mu == mu3:
+                    s += c1*c2*c3*gaunt(l1, mu1, l2, mu2, l3, mu3)
+    return np.real(s)
+
+# Dense tables of the coefficients above for all the angular momenta up to lmax, calculated once per run,
+# so that each coefficient is an array lookup afterwards. Arguments beyond lmax fall back to the functions above.
+class CouplingTable:
+    lmax = 0
+    threej = None  # threej[j1, j2, j3, m1 + lmax, m2 + lmax] = (j1 j2 j3; m1 m2 -m1-m2)
+    cg = None      # cg[j1, j2, j, m1 + lmax, m2 + lmax] = <j1 m1 j2 m2|j m1+m2>
+    real = None    # real[index(l1, m1), index(l2, m2), index(l3, m3)] = realGaunt(l1, m1, l2, m2, l3, m3)
+
+    def __init__(self, _lmax):
+        self.lmax = _lmax
+        L = _lmax
+        self.threej = np.zeros((L+1, L+1, L+1, 2*L+1, 2*L+1))
+        for j1 in range(0, L+1):
+            for j2 in range(0, L+1):
+                for j3 in range(abs(j1 - j2), min(j1 + j2, L)+1):
+                    for m1 in range(-j1, j1+1):
+                        for m2 in range(max(-j2, -j3 - m1), min(j2, j3 - m1)+1):
+                            self.threej[j1, j2, j3, m1 + L, m2 + L] = wigner3j(j1, j2, j3, m1, m2, -m1 - m2)
+        # <j1 m1 j2 m2|j m> = (-1)^(j1 - j2 + m) sqrt(2j + 1) (j1 j2 j; m1 m2 -m), as clebschGordan
+        j = np.arange(L+1)
+        m = np.arange(-L, L+1)
+        sign = (-1.0)**(j[:, None, None, None, None] - j[None, :, None, None, None] + m[None, None, None, :, None] + m[None, None, None, None, :])
+        self.cg = sign*np.sqrt(2*j + 1.0)[None, None, :, None, None]*self.threej
+        self.real = np.zeros(((L+1)**2, (L+1)**2, (L+1)**2))
+        for l1 in range(0, L+1):
+            for l2 in range(0, L+1):
+                for l3 in range(abs(l1 - l2), min(l1 + l2, L)+1, 2):
+                    for m1 in range(-l1, l1+1):
+                        for m2 in range(-l2, l2+1):
+                            # the product of the real Yl1m1 Yl2m2 only has components with |m3| = ||m1| +/- |m2||
+                            for m3 in range(-l3, l3+1):
+                                if abs(m3) == abs(m1) + abs(m2) or abs(m3) == abs(abs(m1) - abs(m2)):
+                                    self.real[self.index(l1, m1), self.index(l2, m2), self.index(l3, m3)] = self._realGaunt(l1, m1, l2, m2, l3, m3)
+
+    # row of Ylm in real, as in SphereQuadrature
+    def index(self, l, m):
+        return l*l + l + m
+
+    def _inTable(self, j1, j2, j3, m1, m2, m3):
+        return max(j1, j2, j3) <= self.lmax and abs(m1) <= j1 and abs(m2) <= j2 and abs(m3) <= j3
+
+    def wigner3j(self, j1, j2, j3, m1, m2, m3):
+        if not self._inTable(j1, j2, j3, m1, m2, m3):
+            return wigner3j(j1, j2, j3, m1, m2, m3)
+        if m1 + m2 + m3 != 0:
+            return 0.0
+        return self.threej[j1, j2, j3, m1 + self.lmax, m2 + self.lmax]
+
+    def clebschGordan(self, j1, j2, m1, m2, j, m):
+        if not self._inTable(j1, j2, j, m1, m2, m):
+            return clebschGordan(j1, j2, m1, m2, j, m)
+        if m1 + m2 != m:
+            return 0.0
+        return self.cg[j1, j2, j, m1 + self.lmax, m2 + self.lmax]
+
+    def gaunt(self, l1, m1, l2, m2, l3, m3):
+        if m1 + m2 + m3 != 0 or (l1 + l2 + l3) % 2 != 0:
+            return 0.0
+        return np.sqrt((2*l1+1)*(2*l2+1)*(2*l3+1)/(4*np.pi))*self.wigner3j(l1, l2, l3, 0, 0, 0)*self.wigner3j(l1, l2, l3, m1, m2, m3)
+
+    def realGaunt(self, l1, m1, l2, m2, l3, m3):
+        if not self._inTable(l1, l2, l3, m1, m2, m3):
+            return realGaunt(l1, m1, l2, m2, l3, m3)
+        return self.real[self.index(l1, m1), self.index(l2, m2), self.index(l3, m3)]
+
+    # realGaunt above, with the complex coefficients from the table
+    def _realGaunt(self, l1, m1, l2, m2, l3, m3):
+        s = 0.0
+        for [mu1, c1] in _realInComplex(l1, m1):
+            for [mu2, c2] in _realInComplex(l2, m2):
+                for [mu3, c3] in _realInComplex(l3, m3):
+                    if mu1 + mu2 + mu3 == 0:
+                        s += c1*c2*c3*self.gaunt(l1, mu1, l2, mu2, l3, mu3)
+        return np.real(s)
+
+# Quadrature on the sphere: Gauss-Legendre points in cos(theta) times equally spaced points in phi,
+# exact for the polynomials in x, y, z of degree up to 'degree' (2 lmax by default), so for the products of
+# harmonics with l1 + l2 + ... <= degree
+# The real harmonics up to lmax are evaluated once on the nodes (the table Y, with utils.SphHarmReal),
+# so projecting a function on them, or evaluating an expansion on the nodes, is a matrix product.
+class SphereQuadrature:
+    lmax = 0
+    theta = None  # polar angle of the nodes
+    phi = None    # azimuthal angle of the nodes
+    w = None      # weights, summing to 4 pi
+    Y = None      # Y[index(l, m)] is the real Ylm on the nodes
+
+    def __init__(self, _lmax, degree = None):
+        self.lmax = _lmax
+        if degree is None:
+            degree = 2*_lmax
+        # 2 nTheta - 1 >= degree for Gauss-Legendre, and nPhi > degree for the trapezoidal rule in phi
+        nTheta = degree//2 + 1
+        nPhi = degree + 1
+        [x, wx] = np.polynomial.legendre.leggauss(nTheta)
+        p = np.arange(nPhi)*2*np.pi/nPhi
+        self.theta = np.repeat(np.arccos(x), nPhi)
+        self.phi = np.tile(p, nTheta)
+        self.w = np.repeat(wx, nPhi)*2*np.pi/nPhi
+        self.Y = np.zeros(((_lmax+1)**2, len(self.w)))
+        for l in range(0, _lmax+1):
+            for m in range(-l, l+1):
+                self.Y[self.index(l, m)] = utils.SphHarmReal(m, l, self.phi, self.theta)
+
+    # row of Ylm in Y
+    def index(self, l, m):
+        return l*l + l + m
+
+    # int f dO for f on the nodes (the last axis)
+    def integrate(self, f):
+        return np.dot(f, self.w)
+
+    # average of f over the sphere
+    def average(self, f):
+        return self.integrate(f)/(4*np.pi)
+
+    # coefficients int f Ylm dO of f on the nodes (the last axis), in the order of the rows of Y
+    def project(self, f):
+        return np.dot(f*self.w, self.Y.T)
+
+    # sum_lm c_lm Ylm on the nodes, for the coefficients c in the order of the rows of Y
+    def evaluate(self, c):
+        return np.dot(c, self.Y[:np.shape(c)[-1]])
+
+if __name__ == '__main__':
+    # orthogonality of the Clebsch-Gordan coefficients, sum_m1m2 <j1 m1 j2 m2|j m> <j1 m1 j2 m2|j' m> = delta_jj'
+    for [j1, j2] in [[1, 1], [2, 1], [3, 2]]:
+        for m in range(-(j1 + j2), j1 + j2 + 1):
+            for j in range(max(abs(j1 - j2), abs(m)), j1 + j2 + 1):
+                for jp in range(max(abs(j1 - j2), abs(m)), j1 + j2 + 1):
+                    s = 0.0
+                    for m1 in range(-j1, j1 + 1):
+                        m2 = m - m1
+                        if abs(m2) <= j2:
+                            s += clebschGordan(j1, j2, m1, m2, j, m)*clebschGordan(j1, j2, m1, m2, jp, m)
+                    assert abs(s - (j == jp)) < 1e-12, [j1, j2, j, jp, m, s]
+    # tabulated Gaunt coefficients
+    assert abs(gaunt(0, 0, 0, 0, 0, 0) - 0.5/np.sqrt(np.pi)) < 1e-14
+    assert abs(gaunt(1, 1, 1, -1, 0, 0) + 0.5/np.sqrt(np.pi)) < 1e-14
+    assert abs(gaunt(1, 0, 1, 0, 2, 0) - 1/np.sqrt(5*np.pi)) < 1e-14
+    # the tables, and the real Gaunt coefficients against the quadrature on the sphere
+    table = CouplingTable(2)
+    sphere = SphereQuadrature(2, 6)
+    for l1 in range(0, 3):
+        for l2 in range(0, 3):
+            for l3 in range(0, 3):
+                for m1 in range(-l1, l1 + 1):
+                    for m2 in range(-l2, l2 + 1):
+                        for m3 in range(-l3, l3 + 1):
+                            g = realGaunt(l1, m1, l2, m2, l3, m3)
+                            Y = sphere.Y
+                            q = sphere.integrate(Y[sphere.index(l1, m1)]*Y[sphere.index(l2, m2)]*Y[sphere.index(l3, m3)])
+                            assert abs(table.realGaunt(l1, m1, l2, m2, l3, m3) - g) < 1e-14
+                            assert abs(q - g) < 1e-12, [l1, m1, l2, m2, l3, m3, g, q]
+                            assert abs(table.wigner3j(l1, l2, l3, m1, m2, m3) - wigner3j(l1, l2, l3, m1, m2, m3)) < 1e-14
+    print 'Clebsch-Gordan orthogonality, Gaunt coefficients and CouplingTable up to l = 2: OK'
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+# Matrix form of the Numerov method
+#
+# The scripts solve d^2y/dx^2 + a(x) y = 0 with a = w E + c
+# (see shooting.py for w and c in the logarithmic and linear grids).
+# Numerov's recurrence at every grid point i:
+# y_{i+1} (1 + a_{i+1} dx^2/12) - 2 y_i (1 - 5 a_i dx^2/12) + y_{i-1} (1 + a_{i-1} dx^2/12) = 0
+# is linear in E, so writing D2 = tridiag(1, -2, 1) and T = tridiag(1, 10, 1)
+# the whole set of equations becomes the generalized tridiagonal eigenproblem:
+# [ - 12/dx^2 D2 - T diag(c) ] y = E [ T diag(w) ] y
+#    A y = E B y
+# with y = 0 just outside both ends of the grid.
+# Instead of shooting one energy at a time, the lowest levels come out of a
+# shift-invert eigensolver: the eigenvalues mu of (A - sigma B)^{-1} B are
+# mu = 1/(E - sigma), so the levels closest to sigma are the largest mu.
+# (A - sigma B) is factorised once and every iteration of the eigensolver
+# is a single O(N) banded solve.
+
+# build the sparse matrices A and B above
+# parity = 'even' imposes y_{-1} = y_1 (zero derivative at the first point, for symmetric potentials)
+# otherwise the point before the grid is taken as y_{-1} = leftRatio*y_0
+# (zero by default; on the logarithmic grid y ~ r^(l+0.5) near r = 0, so exp(-(l+0.5) dx) is better)
+def numerovMatrices(w, c, dx, parity = None, leftRatio = 0.0):
+    N = len(w)
+    d2 = scipy.sparse.lil_matrix((N, N), dtype = np.float64)
+    t = scipy.sparse.lil_matrix((N, N), dtype = np.float64)
+    d2.setdiag(-2.0*np.ones(N))
+    d2.setdiag(np.ones(N-1), 1)
+    d2.setdiag(np.ones(N-1), -1)
+    t.setdiag(10.0*np.ones(N))
+    t.setdiag(np.ones(N-1), 1)
+    t.setdiag(np.ones(N-1), -1)
+    if parity == 'even':
+        # y_{-1} is the mirror image of y_1
+        d2[0, 1] = 2.0
+        t[0, 1] = 2.0
+    else:
+        # y_{-1} = leftRatio*y_0, using a_{-1} ~ a_0
+        d2[0, 0] += leftRatio
+        t[0, 0] += leftRatio
+    d2 = d2.tocsr()
+    t = t.tocsr()
+    A = -12.0/dx**2*d2 - t.dot(scipy.sparse.diags(c, 0))
+    B = t.dot(scipy.sparse.diags(w, 0))
+    return [A.tocsc(), B.tocsc()]
+
+# return the K eigenvalues closest to sigma (by default, the bottom of the effective potential
+# -c/w, so these are the K lowest levels) and the corresponding y, one row per level
+# parity = 'odd' imposes y = 0 at the first grid point, parity = 'even' a zero derivative there
+# (see numerovMatrices for leftRatio)
+def lowestLevels(w, c, dx, K, sigma = None, parity = None, leftRatio = 0.0):
+    if parity == 'odd':
+        [E, y] = lowestLevels(w[1:], c[1:], dx, K, sigma)
+        return [E, np.hstack([np.zeros((len(E), 1)), y])]
+    N = len(w)
+    if sigma is None:
+        sigma = np.min(-c/w)
+    [A, B] = numerovMatrices(w, c, dx, parity, leftRatio)
+    lu = scipy.sparse.linalg.splu((A - sigma*B).tocsc())
+    OP = scipy.sparse.linalg.LinearOperator((N, N), matvec = lambda v: lu.solve(B.dot(np.ravel(v))), dtype = np.float64)
+    [mu, v] = scipy.sparse.linalg.eigs(OP, k = K, which = 'LM')
+    E = sigma + 1.0/mu.real
+    order = np.argsort(E)
+    y = np.zeros((K, N))
+    for k in range(0, K):
+        vk = v[:, order[k]]
+        # the eigensolver returns complex vectors with an arbitrary phase
+        j = np.argmax(np.abs(vk))
+        y[k] = (vk*np.abs(vk[j])/vk[j]).real
+    return [E[order], y]
+
+# lowest K levels of a potential that is symmetric about the first grid point (harmonic.py, well.py)
+# even and odd solutions are found separately and merged in increasing energy
+# returns the energies, y on the half-grid (one row per level) and whether each level is even
+def lowestLevelsSymmetric(w, c, dx, K, sigma = None):
+    [Eeven, yeven] = lowestLevels(w, c, dx, K, sigma, 'even')
+    [Eodd, yodd] = lowestLevels(w, c, dx, K, sigma, 'odd')
+    E = np.concatenate([Eeven, Eodd])
+    y = np.vstack([yeven, yodd])
+    even = np.concatenate([np.ones(K, dtype = bool), np.zeros(K, dtype = bool)])
+    order = np.argsort(E)[0:K]
+    return [E[order], y[order], even[order]]
+
+# Sturm sequence of the Numerov matrix
+#
+# With u_i = f_i y_i, Numerov's recurrence f_{i+1} y_{i+1} - (12 - 10 f_i) y_i + f_{i-1} y_{i-1} = 0
+# becomes u_{i+1} - g_i u_i + u_{i-1} = 0, with g_i = (12 - 10 f_i)/f_i.
+# This is the symmetric tridiagonal matrix S(E) = tridiag(1, -g_i, 1) and A - E B = -12/dx^2 S(E) diag(f),
+# so S(E) is singular exactly at the levels. Its diagonal grows with E, and the number of positive
+# pivots of S(E) = L D L^T,
+# d_0 = -g_0,  d_i = -g_i - 1/d_{i-1}
+# is the number of levels below E (Sylvester's law of inertia).
+# -d_i is also the ratio u_{i+1}/u_i of the outward solution, so this is the node count
+# of the outward solution, obtained without storing it and without overflow.
+# Elist can be a single energy or a vector of them; one count is returned per energy.
+# parity and leftRatio are as in numerovMatrices.
+def sturmCount(w, c, dx, Elist, parity = None, leftRatio = 0.0):
+    Elist = np.atleast_1d(np.asarray(Elist, dtype = np.float64))
+    if parity == 'odd':
+        w = w[1:]
+        c = c[1:]
+    f = 1 + (np.outer(Elist, w) + c[np.newaxis, :])*dx**2/12.0
+    g = (12 - 10*f)/f
+    tiny = 1e-300
+    count = np.zeros(len(Elist), dtype = int)
+    # far out on long grids f < 0 (dx is too coarse there for Numerov) and the pivots alternate in sign,
+    # as the ratios do in shooting.outwardRatios, so a pivot is only counted where f_i and f_{i+1} are positive
+    fpos = f > 0
+    fpos[:, :-1] &= f[:, 1:] > 0
+    for k in range(0, len(Elist)):
+        # plain floats: this loop is the whole cost
+        gk = g[k].tolist()
+        fk = fpos[k].tolist()
+        d = -gk[0]
+        if parity != 'even':
+            d += leftRatio
+        nk = int(d > 0 and fk[0])
+        # y_{-1} = y_1 doubles the coupling of the first point
+        p = 1.0
+        if parity == 'even':
+            p = 2.0
+        for i in range(1, len(gk)):
+            if d == 0:
+                d = tiny
+            d = -gk[i] - p/d
+            p = 1.0
+            if d > 0 and fk[i]:
+                nk += 1
+        count[k] = nk
+    return count
+
+# bisect the window [Emin, Emax] with sturmCount until it is narrower than tol
+# and contains only the level with the given number of nodes
+# (the level with k nodes is the (k+1)-th one, so it lies where the count goes from k to k+1)
+def bisectLevel(w, c, dx, nodes, Emin, Emax, tol, parity = None, leftRatio = 0.0):
+    while Emax - Emin > tol:
+        E = 0.5*(Emin + Emax)
+        if sturmCount(w, c, dx, E, parity, leftRatio)[0] > nodes:
+            Emax = E
+        else:
+            Emin = E
+    return [Emin, Emax]
+
+if __name__ == '__main__':
+    # hydrogen (Z = 1, l = 0) on a logarithmic grid up to r ~ 100: the levels are -1/(2 n^2) Hartree
+    dx = 5e-3
+    r = np.exp(np.log(1e-4) + dx*np.arange(2800))
+    w = 2*r**2
+    c = 2*r - 0.25
+    leftRatio = np.exp(-0.5*dx)
+    [E, y] = lowestLevels(w, c, dx, 3, leftRatio = leftRatio)
+    exact = -0.5/np.arange(1, 4)**2
+    assert np.all(np.fabs(E - exact) < 1e-5), E
+    # between the levels the Sturm count gives the number of levels below
+    count = sturmCount(w, c, dx, [-1.0, -0.3, -0.1, -0.04], None, leftRatio)
+    assert list(count) == [0, 1, 2, 3], count
+    [Emin, Emax] = bisectLevel(w, c, dx, 1, -0.3, -0.1, 1e-10, None, leftRatio)
+    assert abs(Emin - E[1]) < 1e-8, [Emin, E[1]]
+    print 'lowestLevels: ', E, ' Hartree, sturmCount: ', count
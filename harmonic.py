@@ -2,6 +2,9 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
+from shooting import linearGridCoefficients, getAFBatch, outwardBatch, bracketEnergies, NumerovWorkspace
+from eigensolver import lowestLevelsSymmetric, sturmCount
+from rootfinder import findLevel
 
 eV = 27.2113966413442 # Hartrees
 nm = 0.052917721092 # Bohr radius
@@ -22,62 +25,6 @@ def init(xmax, N):
         x[i] = xmin + i*dx
     return x
 
-def F(i, f, y):
-    return (12 - 10*f[i])*y[i] - f[i-1]*y[i-1] - f[i+1]*y[i+1]
-
-# to solve:
-# -hbar/2 m d^2 y/ dx^2 + V y = E y
-# d^2 y / dx^2 + 2 m (E - V) y = 0
-# a = 2 m (E - V)
-def getAF(x, pot, E, m, dx):
-    icl = -1
-    a = np.zeros(len(x))
-    f = np.zeros(len(x))
-    for i in range(0, len(x)):
-        a[i] = 2*m*(E - pot[i])
-	f[i] = 1 + a[i]*dx**2/12.0
-	if icl < 0 and i >= 1 and a[i]*a[i-1] < 0:
-	    icl = i
-    return [a, f, icl]
-
-# boundary conditions:
-# x -> 0 => y = exp(+/-sqrt(-2 m E) x)
-# energy is positive (V > 0), so solution is oscillatory
-# y = cos(2 m E x) or y = sin(2 m E x)
-def solution(x, m, f, E, n):
-    y = np.zeros(len(x))
-    m = 1
-    no = 0
-    if n % 2 == 0:
-        y[0] = 1
-        y[1] = ((12 - f[0]*10)*1)/(2*f[1])
-    else:
-        y[0] = 0
-        y[1] = x[1] - x[0]
-    for i in range(1, len(x)-1):
-	y[i+1] = ((12 - f[i]*10)*y[i] - f[i-1]*y[i-1])/f[i+1]
-    for i in range(1, len(x)-1):
-	if y[i]*y[i+1] < 0:
-	    no += 2
-    if n % 2 == 1:
-      no += 1
-    return [y, no]
-
-def inward(x, m, f, E, n):
-    y = np.zeros(len(x))
-    m = 1
-    no = 0
-    y[len(x)-1] = 0
-    y[len(x)-2] = x[1] - x[0]
-    for i in reversed(range(1, len(x)-1)):
-	y[i-1] = ((12 - f[i]*10)*y[i] - f[i+1]*y[i+1])/f[i-1]
-    for i in reversed(range(1, len(x)-1)):
-	if y[i]*y[i-1] < 0:
-	    no += 2
-    if n % 2 == 1:
-      no += 1
-    return [y, no]
-
 # return a function that is identically y up until index icl
 # and that is yp afterwards, rescaling the yp part so that it matches
 # y in icl (ie: so that it is continuous)
@@ -93,19 +40,45 @@ def matchInOut(y, yp, icl):
 	    y_ren[i] = rat*yp[i]
     return y_ren
 
+# to solve:
+# -hbar/2 m d^2 y/ dx^2 + V y = E y
+# d^2 y / dx^2 + 2 m (E - V) y = 0
+# a = 2 m (E - V), for the whole grid at once in shooting.linearGridCoefficients and NumerovWorkspace
 # f = 1 + a * dx^2/12
 # y_{n+1} = ((12 - 10 f_n) y_n - f_{n-1} y_{n-1}) / f_{n+1}
-def solve(x, pot, n, E):
+# boundary conditions:
+# x -> 0 => y = exp(+/-sqrt(-2 m E) x)
+# energy is positive (V > 0), so solution is oscillatory
+# y = cos(2 m E x) or y = sin(2 m E x)
+# outward from x = 0 with y_0 = 1 and y_1 = (12 - 10 f_0)/(2 f_1) for even n (y_{-1} = y_1),
+# or y_0 = 0 and y_1 = dx for odd n, and inward from y = 0, dx at the last two points
+# z = dy/dE is propagated alongside y (see shooting.py), so F(icl) and dF/dE come out of a single pass
+# ws is the shooting.NumerovWorkspace of x and pot, kept between calls so that only the E term of f
+# is updated for each trial energy (a new one is made if it is not given)
+def solve(x, pot, n, E, ws = None):
     m = 1.0
-    icl = -1
     dx = x[1] - x[0]
-    [a, f, icl] = getAF(x, pot, E, m, dx)
-    
-    [y, no] = solution(x, m, f, E, n)
-    [yp, nop] = inward(x, m, f, E, n)
-    yren = matchInOut(y, yp, icl)
+    if ws is None:
+        [w, c] = linearGridCoefficients(pot, m)
+        ws = NumerovWorkspace(w, c, dx)
+    f = ws.setEnergy(E)[0][0]
+    h = ws.h
+    if n % 2 == 0:
+        # y_1 = (12 - 10 f_0)/(2 f_1) depends on E through f
+        y0 = 1
+        y1 = ((12 - f[0]*10)*1)/(2*f[1])
+        z0 = 0
+        z1 = -10*h[0]/(2*f[1]) - (12 - f[0]*10)*h[1]/(2*f[1]**2)
+    else:
+        y0 = 0
+        y1 = dx
+        z0 = 0
+        z1 = 0
+    [Ficl, dFdE, no, nop, icl, y, yp, levels] = ws.shootDerivative(E, y0, y1, 0, dx, z0, z1)
+    yren = matchInOut(y[0], yp[0], icl[0])
 
-    return [yren, f, icl]
+    # levels is the number of levels of this parity below E, consistent with the root of F (see shooting.levelCount)
+    return [yren, f, icl[0], Ficl[0], dFdE[0], levels[0]]
 
 
 def toPsi(x, y, even):
@@ -148,9 +121,15 @@ def reflect(x, y):
 k = 1
 # select energy level here
 n = 0
+# or pass 'all' to get the lowest Nlevels levels at once from the matrix form of Numerov's method
+solveAllLevels = False
+Nlevels = 6
 import sys
 if len(sys.argv) >= 2:
-  n = int(sys.argv[1])
+  if sys.argv[1] == 'all':
+    solveAllLevels = True
+  else:
+    n = int(sys.argv[1])
 # Harmonic oscillator energy levels are E_n = (1/2 + n) hbar omega
 # for k = 1, hbar omega = 1 in atomic units
 # 1 atomic unit = 27.2 eV
@@ -161,6 +140,12 @@ Emin = 0
 E = 20
 x = init(10.0, 400)
 pot = V(x, k)
+if solveAllLevels:
+    [w, c] = linearGridCoefficients(pot)
+    [Elevels, yLevels, evenLevels] = lowestLevelsSymmetric(w, c, x[1] - x[0], Nlevels)
+    for i in range(0, Nlevels):
+        print "n = ", i, ", even = ", evenLevels[i], ": E = ", Elevels[i]*eV, " eV"
+    sys.exit(0)
 for i in range(0, len(pot)):
   if pot[i] < Emin:
     Emin = pot[i]
@@ -171,68 +156,85 @@ if n % 2 == 0:
     even = True
 else:
     even = False
-for i in range(0,10):
-    dE = 0.01*E
-    [y, f, icl] = solve(x, pot, n, E)
-    [y_dE, f, icl_dE] = solve(x, pot, n, E+dE)
-    # F(new) = 0 = F(old) + F'(old)*dE
-    # dE = -F(old)/F'(old)
-    F_old = F(icl, f, y)
-    F_new = F(icl, f, y_dE)
-    dE = - F_old*dE/(F_new - F_old)
-
-    [xr_full, psi_full] = toPsi(x, y, even)
-    nodes = 0
-    nodesList = []
-    for it in range(0, len(xr_full)-1):
-        if psi_full[it]*psi_full[it+1] < 0:
-	    nodes += 1
-	    nodesList.append(i)
-    if not even:
+# shoot a vector of trial energies at once from x = 0 and bracket the level:
+# the solution on x > 0 has n/2 zeroes for both parities
+Escan = np.linspace(Emin, Emax, 64)
+[w, c] = linearGridCoefficients(pot)
+[aScan, fScan, iclScan] = getAFBatch(w, c, Escan, x[1] - x[0])
+if even:
+    [yScan, noScan] = outwardBatch(fScan, 1, ((12 - fScan[:, 0]*10)*1)/(2*fScan[:, 1]))
+else:
+    [yScan, noScan] = outwardBatch(fScan, 0, x[1] - x[0])
+bracket = bracketEnergies(Escan, noScan, n/2)
+if bracket is not None:
+    [Emin, Emax] = bracket
+    E = 0.5*(Emin + Emax)
+if even:
+    parity = 'even'
+else:
+    parity = 'odd'
+dx = x[1] - x[0]
+# f and the solution buffers for every trial energy below
+ws = NumerovWorkspace(w, c, dx)
+# mismatch at the matching point, its derivative and the number of levels of this parity below E, for findLevel
+def shoot(E):
+    # levels of this parity below E from the Sturm sequence of the Numerov matrix: O(N) and no propagation
+    # only shoot once E is in the window of the level with n/2 zeroes on x > 0
+    count = sturmCount(w, c, dx, E, parity)[0]
+    if count < n/2 or count > n/2 + 1:
+        print "E = ", E*eV, " eV, levels below E = ", count, ", bisecting"
+        return [np.nan, np.nan, count]
+    [y, f, icl, Ficl, dFdE, levels] = solve(x, pot, n, E, ws)
+    print "E = ", E*eV, " eV, F = ", Ficl, ", crossing zero at = ", icl
+    if np.isnan(Ficl):
+        return [Ficl, dFdE, count]
+    # the levels below E counted on the matched solution change exactly where F vanishes
+    return [Ficl, dFdE, levels]
+
+[E, Emin, Emax, iterations, evaluations, converged] = findLevel(shoot, n/2, Emin, Emax, E, eps)
+if converged:
+    print "Converged after ", iterations, " iterations (", evaluations, " shooting passes)"
+else:
+    print "Not converged after ", iterations, " iterations (", evaluations, " shooting passes): the level is in [", Emin*eV, ", ", Emax*eV, "] eV"
+
+[y, f, icl, Ficl, dFdE, levels] = solve(x, pot, n, E, ws)
+[xr_full, psi_full] = toPsi(x, y, even)
+nodes = 0
+nodesList = []
+for it in range(0, len(xr_full)-1):
+    if psi_full[it]*psi_full[it+1] < 0:
         nodes += 1
-    print "Iteration ", i, ", E = ", E*eV, " eV, nodes = ", nodes, ", expected nodes = ", n, ", crossing zero at = ", icl, nodesList
-
-
-    idx = np.where(x > 4)
-    idx=  idx[0][0]
-    [xr, psi] = toPsi(x[0:idx], y[0:idx], even)
-    psi2 = psi*psi
-    [xV_full, V_full] = reflect(x[0:idx], pot[0:idx])
-    if True:
-      #plt.clf()
-      fig, ax1 = plt.subplots()
-      ax1.plot(xr*nm, psi, 'r-', linewidth=2, label='$\Psi(x)$')
-      ax1.plot(xr*nm, psi2, 'r--', linewidth=2, label='$\Psi^2(x)$')
-      ax1.set_xlabel('$x$ [nm]')
-      ax1.set_ylabel('$\Psi(x)$ or $|\Psi(x)|^2$', color='r')
-      for tl in ax1.get_yticklabels():
-          tl.set_color('r')
-      ax2 = ax1.twinx()
-      ax2.plot(xr*nm, V_full*eV, 'b--', linewidth=2, label='$V(x)$')
-      ax2.plot(xr*nm, E*eV*np.ones(len(V_full)), 'b:', linewidth=2, label='$E$')
-      ax2.set_xlabel('$x$ [nm]')
-      ax2.set_ylabel('Energy [eV]', color='b')
-      for tl in ax2.get_yticklabels():
-          tl.set_color('b')
-      ax2.legend(('$V(x)$ [eV]', '$E$ [eV]'), frameon = False, loc = 'upper right')
-      ax1.legend(('Wave function', 'Probability'), frameon = False, loc = 'upper left')
-      plt.title('')
-      #plt.draw()
-      plt.show()
-    if nodes != n:
-        if nodes > n:
-            Emax = E
-        elif nodes < n:
-            Emin = E
-        E = (Emax + Emin)*0.5
-    else:
-        if dE > 0:
-	    Emin = E
-        elif dE < 0:
-	    Emax = E
-        E += dE
-    if np.fabs(Emax - Emin) < eps:
-        break
+        nodesList.append(it)
+if not even:
+    nodes += 1
+print "E = ", E*eV, " eV, nodes = ", nodes, ", expected nodes = ", n, ", crossing zero at = ", icl, nodesList
+
+idx = np.where(x > 4)
+idx=  idx[0][0]
+[xr, psi] = toPsi(x[0:idx], y[0:idx], even)
+psi2 = psi*psi
+[xV_full, V_full] = reflect(x[0:idx], pot[0:idx])
+if True:
+  #plt.clf()
+  fig, ax1 = plt.subplots()
+  ax1.plot(xr*nm, psi, 'r-', linewidth=2, label='$\Psi(x)$')
+  ax1.plot(xr*nm, psi2, 'r--', linewidth=2, label='$\Psi^2(x)$')
+  ax1.set_xlabel('$x$ [nm]')
+  ax1.set_ylabel('$\Psi(x)$ or $|\Psi(x)|^2$', color='r')
+  for tl in ax1.get_yticklabels():
+      tl.set_color('r')
+  ax2 = ax1.twinx()
+  ax2.plot(xr*nm, V_full*eV, 'b--', linewidth=2, label='$V(x)$')
+  ax2.plot(xr*nm, E*eV*np.ones(len(V_full)), 'b:', linewidth=2, label='$E$')
+  ax2.set_xlabel('$x$ [nm]')
+  ax2.set_ylabel('Energy [eV]', color='b')
+  for tl in ax2.get_yticklabels():
+      tl.set_color('b')
+  ax2.legend(('$V(x)$ [eV]', '$E$ [eV]'), frameon = False, loc = 'upper right')
+  ax1.legend(('Wave function', 'Probability'), frameon = False, loc = 'upper left')
+  plt.title('')
+  #plt.draw()
+  plt.show()
 print "Last energy ", E*eV, " eV"
     
 
@@ -2,6 +2,13 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
+from shooting import logGridCoefficients, shootBatch, bracketEnergies, shootRatiosBatch, ratiosToY, ratiosToBranches, decayRatio
+from shooting import NumerovWorkspace, wkbCutoff, wkbRatio, padToGrid
+from eigensolver import sturmCount
+from rootfinder import findLevel
+from richardson import extrapolate, equivalentGridSizes
+from poisson import GaussLawSolver, NumerovPoissonSolver, HartreeCache
+from quadrature import LogGridQuadrature
 
 # ---------- global variables ----------
 
@@ -16,6 +23,30 @@ Z = 2  # stop here for He
 # can be annoying ...
 debug = True 
 
+# set this to true to propagate the ratios y_{i+1}/y_i (renormalized Numerov) instead of y
+# the ratios never overflow, so any number of grid points N can be used (see below)
+# the energies are the same either way
+useRatios = False
+
+# set this to true to get the Hartree-Fock potential from the radial Poisson equation solved with Numerov's method
+# (O(dx^4), see poisson.py) instead of the first order sums of Gauss' law
+# the normalisation and the energy use Bode's rule (see quadrature.py), so the first order sums
+# leave an O(dx) error that Numerov's method removes
+# this moves the ground state energy from about -79.46 eV (tests/solutions.txt) to -77.87 eV, the Hartree-Fock limit,
+# so it is off by default to keep the results of tests/solutions.txt
+useNumerovPoisson = False
+
+# set this to true to solve each spatial orbital once, with the number of electrons in it (occ),
+# instead of once per electron: for a closed shell (as the 1s^2 of Helium) the electrons in
+# the same orbital have identical potentials and wave functions, so this halves the work
+# (the energies are the same, but only one eigenvalue is printed for the 1s^2)
+restricted = False
+
+# the direct potential of each orbital is only calculated again when its density changed by more than
+# this (relative to its largest value) since the last time (see poisson.HartreeCache)
+hartreeTolerance = 1e-8
+hartreeCache = None
+
 # conversion from Hartree to eV
 eV = 27.2113966413442 # 1 Hartree = 2 Rydberg, Bohr radius a_0 = 1, electron mass = 1, h/4pi = 1
 
@@ -37,6 +68,7 @@ xmin = np.log(1e-4)
 # down to r = 0, the wave function goes to infinity at r = 0 (actually NaN)
 # choose this wisely
 # 14000 is a good number, but you can reduce it to speed things up, if possible
+# (with useRatios = True, the inward solution cannot blow up, so only the first problem remains)
 # rmax = np.exp(xmin+(N-1)*dx)
 # for the default values (xmin = log(1e-4), dx = 1e-3, N = 11000):
 # rmax = 5.98 a_0
@@ -44,6 +76,26 @@ xmin = np.log(1e-4)
 # (6 Hydrogen atom radii seem reasonable, bu with N =14000, you can get 120 H radii)
 N = 15000
 
+# set this to a list of decreasing grid spacings (for instance [4e-3, 2e-3, 1e-3]) to run the Hartree-Fock
+# iterations once per spacing, on grids covering the same range of r as dx and N above, and extrapolate
+# the eigenvalues and the ground state energy to dx = 0 (see richardson.py)
+richardsonDx = None
+
+# the Hartree-Fock iterations stop when the ground state energy changes by less than scfTolerance (relative)
+# or after maxHartreeFockIterations
+scfTolerance = 1e-2
+maxHartreeFockIterations = 30
+
+# the differences between the grids of richardsonDx are O(dx^4) (O(dx) without useNumerovPoisson), so the Hartree-Fock
+# iterations, the direct potential and the energy of each level must converge well below them: otherwise they are noise,
+# and the extrapolation is meaningless
+if richardsonDx is not None:
+    # the energy converges linearly (by a factor of about 0.7 per iteration), so this takes about 70 iterations
+    scfTolerance = min(scfTolerance, 1e-10)
+    maxHartreeFockIterations = max(maxHartreeFockIterations, 200)
+    hartreeTolerance = min(hartreeTolerance, 1e-12)
+    eps = min(eps, 1e-10)
+
 
 # factorial
 def fact(n):
@@ -71,8 +123,8 @@ def Vcoulomb(r, Z):
 # Z is the atomic number (to make the Grid finer for atoms that have higher Z)
 # the reason for Z in this is that the Coulomb potential is stronger for
 # atoms with higher Z, so more detail close to r = 0 is needed
-# getAF() has been written with this Grid format in mind
-# other Grids can be tried, but then getAF() needs to be changed, since
+# shooting.logGridCoefficients has been written with this Grid format in mind
+# other Grids can be tried, but then the coefficients need to be changed (see shooting.linearGridCoefficients), since
 # the derivative in the Schr. equation now are taken as a function of
 # x = ln(C*r) (that is: r = exp(x)/C)
 # dx/dr = 1/r (that is: dr/dx = r)
@@ -82,35 +134,23 @@ def init(N, xmin, C):
         r[i] = np.exp(xmin + i*dx)/C
     return r
 
-def norm(x, y):
-    n = 0
-    for i in range(0, len(y)):
-        dx = 0
-	ip = len(y)-2
-	if i < len(y)-1:
-	    ip = i + 1
-	dx = np.fabs(x[ip]-x[i])
-        n += (x[i]*y[i])**2*dx        # normalise it so that int |r R(r)|^2 dr == 1
-    return np.sqrt(n)
+# the integrals below use the quadrature of quadrature.py on the grid x,
+# which is built here if quad (a LogGridQuadrature on x) is not given
+def norm(x, y, quad = None):
+    if quad is None:
+        quad = LogGridQuadrature(x)
+    return quad.norm(y)        # normalise it so that int |r R(r)|^2 dr == 1
 
 # transform y back into R(r)
 # and normalise it so that int R(r)^2 r^2 dr = 1
-def toPsi(x, y):
-    n = 0
-    psi = np.zeros(len(y))
-    for i in range(0, len(y)):
-        psi[i] = y[i]*x[i]**(-0.5) # undo y->R(r) transform
-	ip = len(y)-2
-	if i < len(y)-1:
-	    ip = i + 1
-	dx = np.fabs(x[ip]-x[i])
-        n += (x[i]*psi[i])**2*dx        # normalise it so that int |r R(r)|^2 dr == 1
+def toPsi(x, y, quad = None):
+    psi = y*x**(-0.5) # undo y->R(r) transform
+    n = norm(x, psi, quad)
     if n != 0:
-        for i in range(0, len(y)):
-            psi[i] /= np.sqrt(n)
+        psi /= n
     return psi
 
-# calculate auxiliary functions a and f
+# auxiliary functions a and f, for the whole grid at once in shooting.logGridCoefficients and NumerovWorkspace
 # a is the function in the Schr. eq as in:
 # deriv(deriv(y)) + a * y = E * y
 # f is necessary in the Numerov method
@@ -122,16 +162,6 @@ def toPsi(x, y):
 # in which case, a = 2 m / hbar^2 [ E - V - (hbar^2 l (l+1) ) / 2 m r^2 ] and dx is replaced by r(i) - r(i-1)
 # but in this case, the potential has a singularity close to zero
 # perhaps consider other schemes for this
-def getAF(r, pot, E, l, m):
-    icl = -1
-    a = np.zeros(len(r))
-    f = np.zeros(len(r))
-    for i in range(0, len(r)):
-        a[i] = 2*m*r[i]**2*(E - pot[i]) - (l+0.5)**2
-	f[i] = 1 + a[i]*dx**2/12.0
-        if icl < 0 and i >= 1 and a[i]*a[i-1] < 0:
-            icl = i
-    return [a, f, icl]
 
 # for each orbital
 class Orbital:
@@ -145,7 +175,7 @@ class Orbital:
     nop = 0        # number of zeros in wave function integrated inward (should be n - l - 1)
     # copy of the grid r
     r = None
-    Niter = 1000   # number of iterations to use to converge on Energy in Sturm-Liouville problem
+    Niter = 100    # maximum number of iterations to use to converge on Energy in Sturm-Liouville problem
     
     y = None       # wave function integrated outward
     yp = None      # wave function integrated inward
@@ -156,8 +186,14 @@ class Orbital:
     psifinal = None # final, normalised R(r) function (full radial WF is r*R(r))
 
     spin = 0       # spin of this particle
+    occ = 1        # number of electrons in this orbital (2 for both spins in restricted mode)
+
+    Nscan = 64     # number of trial energies shot at once to bracket the eigenvalue
+
+    poisson = None # poisson.GaussLawSolver or NumerovPoissonSolver on r, for the Hartree-Fock potential
+    quad = None    # quadrature.LogGridQuadrature on r, for the normalisation and the energy
 
-    def __init__(self, _n, _l, _Z, _r, _spin):
+    def __init__(self, _n, _l, _Z, _r, _spin, _occ = 1):
         self.n = _n
 	self.l = _l
 	## this is just a good first guess: the lowest energy is that when the electron is alone
@@ -173,15 +209,16 @@ class Orbital:
 	self.Z = _Z
 	self.r = _r
 	self.V = Vcoulomb(self.r, self.Z)
+	if useNumerovPoisson:
+	    self.poisson = NumerovPoissonSolver(self.r)
+	else:
+	    self.poisson = GaussLawSolver(self.r)
+	self.quad = LogGridQuadrature(self.r)
 	self.Vhf = np.zeros(len(r))
 	self.spin = _spin
+	self.occ = _occ
 	pass
 
-    # this function is zero for neighbour points that
-    # are solution of the Numerov equation
-    def F(self, i, f, y):
-        return (12 - 10*f[i])*y[i] - f[i-1]*y[i-1] - f[i+1]*y[i+1]
-
     # https://en.wikipedia.org/wiki/Laguerre_polynomials#Generalized_Laguerre_polynomials
     def L(self, d, alpha, rho):
 	r = 0
@@ -198,60 +235,6 @@ class Orbital:
 	# n = 3 -> n - l - 1 = 2 -> ((3-x)*L(1, x) - 1*L(0, x))/2 = (3-x)*(1-x)*0.5 - 0.5 = 0.5*x^2 - 2*x + 1 = 0.5*(x^2 - 4*x + 2)
 	return r
 
-    # assume the r->0 behaviour of the Hydrogen atom
-    # and solve the Schr. equation from that
-    # also count the number of zeroes of the solution
-    def outwardSolution(self, r, m, E, n, l, Z, f):
-        y = np.zeros(len(r))
-        no = 0
-	mu = 1 # TODO
-	a = 1.0/mu
-
-        # only assuming tendency from Schr. eq.:
-	# psi = r^l
-	# psi -> r R(r) * angular part
-	# xi = r^l/r
-	# y = xi/sqrt(r)
-	# y = r^l/r/sqrt(r)
-        # generic approx. solution
-	# from ignoring r^2 term in:
-	# d^2y/dx^2 + [2mr^2(E-V) - (l+0.5)^2] y = 0
-	# when r -> 0, x-> - infinity
-	# -> d^2y/dx^2 = (l+0.5)^2 y
-	# -> y = exp((l+0.5) x)   # notice that x -> -infinity means exp(x) converges not exp(-x)
-	# -> y = exp((l+0.5) ln(Zr)) = (Zr)^(l+0.5)
-	#N = ((2*Z/n)**3*fact(n-l-1)/(2*n*fact(n+l)**3))**0.5
-        y[0] = ((Z*r[0])**(np.sqrt((l+0.5)**2)))/n
-        y[1] = ((Z*r[1])**(np.sqrt((l+0.5)**2)))/n
-        for i in range(1, len(r)-1):
-    	    y[i+1] = ((12 - f[i]*10)*y[i] - f[i-1]*y[i-1])/f[i+1]
-    	    #if y[i+1] > 10:
-    	    #    for j in range(0, i+2):
-    	    #        y[j] /= y[i+1]
-        for i in range(1, len(r)-1):
-    	    if y[i]*y[i+1] < 0:
-    	        no += 1
-        return [y, no]
-    
-    # assume the r->infinity behaviour of the orbitals (ie: assume they tend to zero)
-    # and solve the Schr. equation from that
-    # also count number of zeroes of the solution
-    def inwardSolution(self, r, m, E, n, l, Z, f, eps):
-        yp = np.zeros(len(r))
-        nop = 0
-        yp[len(r)-1] = np.exp(-np.sqrt(-2*m*E)*r[len(r)-1])
-        yp[len(r)-2] = np.exp(-np.sqrt(-2*m*E)*r[len(r)-2])
-        for i in reversed(range(1, len(r)-1)):
-    	    yp[i-1] = ((12 - f[i]*10)*yp[i] - f[i+1]*yp[i+1])/f[i-1];
-    	    #if yp[i-1] > 10:
-    	    #    for j in reversed(range(i-1, len(r)-1)):
-    	    #        yp[j] /= yp[i-1]
-    
-        for i in reversed(range(1, len(r)-1)):
-      	    if yp[i-1]*yp[i] < 0:
-    	        nop += 1
-        return [yp, nop]
-    
     # return a function that is identically y up until index icl
     # and that is yp afterwards, rescaling the yp part so that it matches
     # y in icl (ie: so that it is continuous)
@@ -291,13 +274,28 @@ class Orbital:
     # the eq. in terms of r, so it would be:
     # deriv(deriv(xi)) + 2 m / hbar^2 [ E - V - (hbar^2 l (l+1) ) / 2 m r^2 ] xi (r) = 0
     # in which case, a = 2 m / hbar^2 [ E - V - (hbar^2 l (l+1) ) / 2 m r^2 ] and dx is replaced by r(i) - r(i-1)
-    def solve(self, r, pot, n, l, E, Z):
+    # ws is the shooting.NumerovWorkspace of r, pot and l, which keeps the parts of a and f that do not
+    # depend on E and the buffers for the solutions between calls (a new one is made if it is not given)
+    def solve(self, r, pot, n, l, E, Z, ws = None):
+        if useRatios:
+            return self.solveRatios(r, pot, n, l, E, Z, ws)
         m = 1.0
-        icl = -1
-        [a, f, icl] = getAF(r, pot, E, l, m)
-        
-        [y, no] = self.outwardSolution(r, m, E, n, l, Z, f)
-        [yp, nop] = self.inwardSolution(r, m, E, n, l, Z, f, y[len(r)-1])
+        N = len(r)
+        if ws is None:
+            [w, c] = logGridCoefficients(r, pot, l, m)
+            ws = NumerovWorkspace(w, c, dx)
+        # outward starting values from the r->0 behaviour of the Hydrogen atom, only assuming tendency from Schr. eq.:
+        # psi = r^l, xi = r R(r) = r^l/r, y = xi/sqrt(r)
+        # ignoring the r^2 term in d^2y/dx^2 + [2mr^2(E-V) - (l+0.5)^2] y = 0 when r -> 0 (x -> - infinity)
+        # -> d^2y/dx^2 = (l+0.5)^2 y -> y = exp((l+0.5) ln(Zr)) = (Zr)^(l+0.5)
+        # the inward solution starts from the WKB tail at the last point of r (see shooting.wkbRatio),
+        # which may be an outer cut-off well before the end of the full grid
+        # z = dy/dE is propagated alongside y in the same pass (see shooting.py), to get dF/dE below
+        # z = 0 for the outward start and at the last point, which do not depend on E
+        [yN2yN1, dyN2yN1] = wkbRatio(ws.w, ws.c, dx, E)
+        [Fb, dFb, no, nop, icl, y, yp, levels] = ws.shootDerivative(E, ((Z*r[0])**(l+0.5))/n, ((Z*r[1])**(l+0.5))/n,
+                                                                     1.0, yN2yN1, 0, 0, 0, dyN2yN1)
+        [y, yp, icl, no, nop, levels] = [y[0], yp[0], icl[0], no[0], nop[0], levels[0]]
         y_ren = self.matchInOut(y, yp, icl)
         # y_ren is continuous
         # y_ren was estimated outward until icl
@@ -316,31 +314,38 @@ class Orbital:
         # for E_new, F(E_new) = 0
         # dE = E_new - E_current = - F(E_current)/(F'(E_current))
         # F(E_current) = (12 - 10 f_icl) y_icl - f_{icl-1} y_{icl-1} - f_{icl+1} y_{icl+1}
-        Ficl = self.F(icl, f, y_ren) # get F at icl
-        # calculate dF/dE, by varying E very slightly
-        dE = -0.1e-1
-        if dE == 0:
-          dE = -0.1e-1
-        # recalculate the solution with a slihtly varied E
-        [ap, fp, iclp] = getAF(r, pot, E+dE, l, m)
-        [y_ep, no_ep] = self.outwardSolution(r, m, E, n, l, Z, fp)
-        [yp_ep, nop_ep] = self.inwardSolution(r, m, E, n, l, Z, fp, y_ren[len(r)-1])
-        y_ep_ren = self.matchInOut(y_ep, yp_ep, icl)
-        # new solution has a discontinuity at icl again
-        # dF/dE is defined as the difference over dE of the change in F
-        Fp = self.F(icl, fp, y_ep_ren)
-        #dFdE = (Fp - Ficl)/dE
-        #bestdE = -Ficl/dFdE
-        if Fp != Ficl:
-            bestdE = -Ficl*dE/(Fp - Ficl)
-        else:
-            bestdE = dE
-        if icl < 0:
-            bestdE = 1 # arbitrary, but must be positive to make energy less negative
-        #return [y_ren, yp, icl, no, nop, bestdE]
-        return [y, yp, y_ren, icl, no, nop, bestdE]
+        # F(icl) on y_ren and dF/dE, without solving again at a slightly varied E
+        # (NaN if there is no icl)
+        # levels is the number of levels below E, consistent with the root of F (see shooting.levelCount)
+        Ficl = Fb[0]
+        dFdE = dFb[0]
+        return [y, yp, y_ren, icl, no, nop, Ficl, dFdE, levels]
     
     
+    # same as solve, but propagating the ratios of neighbouring points of the solution
+    # (see shooting.py), so nothing overflows for any grid length
+    # the scale-free mismatch at icl replaces F, and its derivative with respect to E
+    # is propagated alongside the ratios, so a single pass gives the Newton step
+    # D replaces F in the returned values
+    # the matched solution is only rebuilt from the ratios at the end
+    def solveRatios(self, r, pot, n, l, E, Z, ws = None):
+        m = 1.0
+        N = len(r)
+        if ws is None:
+            [w, c] = logGridCoefficients(r, pot, l, m)
+            ws = NumerovWorkspace(w, c, dx)
+        # y ~ (Zr)^(l+0.5) close to r = 0 and the WKB tail at the last point of r
+        y1y0 = (r[1]/r[0])**(l+0.5)
+        [yN2yN1, dyN2yN1] = wkbRatio(ws.w, ws.c, dx, E)
+        [D, dD, no, nop, icl, R, Q, f, levels] = ws.shootRatiosDerivative(E, y1y0, yN2yN1, 0, dyN2yN1)
+        icl = icl[0]
+        if icl < 0:
+            return [np.zeros(N), np.zeros(N), np.zeros(N), icl, no[0], nop[0], D[0], dD[0], levels[0]]
+        # the outward (up to icl) and inward (from icl) solutions, continuous at icl, and the matched one
+        [y, yp] = ratiosToBranches(f[0], R[0], Q[0], icl)
+        y_ren = ratiosToY(f[0], R[0], Q[0], icl)
+        return [y, yp, y_ren, icl, no[0], nop[0], D[0], dD[0], levels[0]]
+
     # return the number of zeroes expected in the solution that has n and l
     # as quantum numbers
     def nodes(self, n, l):
@@ -348,74 +353,94 @@ class Orbital:
     
     # loop over energies to solve the Schr. equation and adapt the energy until a consistent
     # solution is found and a valid energy is available
+    # shoot a whole vector of trial energies between Emin and Emax in one pass over the grid
+    # and use the outward node counts to bracket the eigenvalue with n - l - 1 nodes
+    # Emin and Emax are reset to the bracket found and E is moved inside it
+    def bracketEnergy(self):
+        m = 1.0
+        Zr = self.Z*self.r
+        # the Coulomb levels are closer together near zero, so space the trial energies logarithmically
+        Escan = -np.logspace(np.log10(self.Z**2*100), np.log10(1e-3), self.Nscan)
+        [w, c] = logGridCoefficients(self.r, self.V + self.Vhf, self.l, m)
+        N = len(self.r)
+        if useRatios:
+            [Ficl, no, nop, icl, R, Q, f] = shootRatiosBatch(w, c, Escan, dx, (Zr[1]/Zr[0])**(self.l+0.5),
+                                                             decayRatio(Escan, self.r[N-1] - self.r[N-2], m))
+        else:
+            [Ficl, no, nop, icl, y, yp] = shootBatch(w, c, Escan, dx,
+                                                     (Zr[0]**(self.l+0.5))/self.n, (Zr[1]**(self.l+0.5))/self.n,
+                                                     np.exp(-np.sqrt(-2*m*Escan)*self.r[N-1]), np.exp(-np.sqrt(-2*m*Escan)*self.r[N-2]))
+        bracket = bracketEnergies(Escan, no, self.nodes(self.n, self.l))
+        if bracket is None:
+            return
+        [self.Emin, self.Emax] = bracket
+        if self.E <= self.Emin or self.E >= self.Emax:
+            self.E = 0.5*(self.Emin + self.Emax)
+        if debug:
+            print "->  Eigenvalue bracketed in [", self.Emin, ",", self.Emax, "], starting at E = ", self.E
+
     def solveWithCurrentPotential(self):
-        for i in range(0, self.Niter):
-	    # solve Schroedinger equation using self.E as energy guess
+        self.bracketEnergy()
+        # coefficients of the Numerov matrix for the Sturm sequence (y ~ r^(l+0.5) before the first point)
+        [w, c] = logGridCoefficients(self.r, self.V + self.Vhf, self.l, 1.0)
+        leftRatio = np.exp(-(self.l+0.5)*dx)
+        # the level lies below Emax, so beyond the point where the WKB tail at Emax has decayed
+        # the solution is zero to double precision: propagate only up to there (see shooting.wkbCutoff)
+        N = len(self.r)
+        Nc = wkbCutoff(w, c, dx, self.Emax)
+        [w, c] = [w[0:Nc], c[0:Nc]]
+        rc = self.r[0:Nc]
+        potc = (self.V + self.Vhf)[0:Nc]
+        if debug:
+            print "->  Outer cut-off at r = ", rc[Nc-1], " (", Nc, " of ", N, " points)"
+        # the potential is fixed while looking for the level, so the same workspace serves every trial energy
+        ws = NumerovWorkspace(w, c, dx)
+        # mismatch, its derivative and number of levels below E, for findLevel
+        def shoot(E):
+            # the Sturm sequence of the Numerov matrix counts the levels below E in O(N)
+            # without propagating anything: the level with nodes(n, l) zeroes is the next one
+            # if E is outside the window of this level, do not shoot at all
+            count = sturmCount(w, c, dx, E, None, leftRatio)[0]
+            if count < self.nodes(self.n, self.l) or count > self.nodes(self.n, self.l) + 1:
+                if debug:
+                    print "->  E = ", E, ", levels below E = ", count, ", expected nodes = ", self.nodes(self.n, self.l), ", bisecting"
+                return [np.nan, np.nan, count]
+
+	    # solve Schroedinger equation using E as energy guess
 	    # solves it using Numerov's method assuming initial solution at r->0 (y) and
 	    # assuming y = 0 for r->infinity (yp)
 	    # then it rescales yp to y and returns y as the solution with boundary conditions at r=0,1
 	    # up until icl and after icl, it uses the shape of yp, which has boundary conditions from r->infinity
 	    # the solution returned in y is continuous, but there is no guarantee its derivative is continuous
 	    # the error in the Numerov identity at icl in this amalgama-solution should be zero if both solutions
-	    # are consistent.
-            # as they are not, the discrepancy is used to return the "bestdE", which has the variation one
-	    # should apply in the energy to get a better solution, to first order
-            [self.y, self.yp, self.yfinal, self.icl, self.no, self.nop, bestdE] = self.solve(self.r, self.V + self.Vhf, self.n, self.l, self.E, self.Z)
-
-            dE = 0 # delta E to be used to shift energy
-
-	    # first check the number of nodes
-	    # the number of zeros in y must be nodes(n, l) (==n - l - 1) for us to have the
-	    # solution corresponding to the correct energy level given by n and l
-	    # the number of zeroes is linear in n, so if it is too high, it means our current
-	    # guess for the energy is too high
-	    # if the number of zeroes is too low, it means our current guess for the energy
-	    # is too low
-            if self.no > self.nodes(self.n, self.l) or self.nop > self.nodes(self.n, self.l):
-	        # don't let us go above the current energy again, as it gives the wrong solution
-		# and shift the energy to some value far far away
-	        self.Emax = self.E
-	        dE = (self.Emax + self.Emin)*0.5 - self.E
-            elif self.no < self.nodes(self.n, self.l) or self.nop < self.nodes(self.n, self.l):
-	        # don't let us go below the current energy again, as it gives the wrong solution
-		# and shift the energy to some value far far away
-	        self.Emin = self.E
-	        dE = (self.Emax + self.Emin)*0.5 - self.E
-            else: # number of nodes is ok, but the energy needs to be adjusted
-	        # in principle we could use the bestdE above as a shift
-		# but it is too much sometimes, so let's soften it so we don't go too far away
-                dE = 1e-1*bestdE
-		# don't let it anyway give us a too big shift, otherwise this never converges
-	        if np.fabs(dE) > 0.5:
-	            dE = 1.0*dE/np.fabs(dE)
-
-            if debug or i % 50 == 0:
-                print "->  Iteration ", i, ", E = ", self.E, ", dE = ", dE, ", nodes = ", self.no, self.nop, ", expected nodes = ", self.nodes(self.n, self.l), ", crossing zero at = ", self.icl
-
-	    # now we have y for this energy
-	    # if we want to plot it, we would need to
-	    # undo the transformation done previously (y = sqrt(r)*psi) and normalise it so that
-	    # int psi^2 r^2 dr = 1
-            psi = toPsi(self.r, self.y)
-            psip = toPsi(self.r, self.yp)
-            self.psifinal = toPsi(self.r, self.yfinal)
-	    # only plot it sometimes, as I don't have patience otherwise
-	    if i % 10 == 0:
-  	        plotWaveFunction(r, psi, psip, self.psifinal, self.n, self.l, 'lastwf.eps')
-
-            # increment the energy now
-            self.E += dE
-	    # and cap it so it doesn't go crazy
-            if dE > 0 and self.E > self.Emax:
-                self.E = self.Emax
-            elif dE < 0 and self.E < self.Emin:
-                self.E = self.Emin
-            #print "E, Emax, Emin = " , E, Emax, Emin
-	    # if the delta E is too small, stop
-            #if np.fabs(dE) < 1e-12 or np.fabs(self.Emax - self.Emin) < 1e-5:
-            if np.fabs(dE) < eps or np.fabs(self.Emax - self.Emin) < 1e-5:
-                print "Converged to energy ", self.E*eV, " eV"
-                break
+	    # are consistent, and findLevel looks for the energy where it is
+            [self.y, self.yp, self.yfinal, self.icl, self.no, self.nop, Ficl, dFdE, levels] = self.solve(rc, potc, self.n, self.l, E, self.Z, ws)
+            if debug:
+                print "->  E = ", E, ", F = ", Ficl, ", nodes = ", self.no, self.nop, ", expected nodes = ", self.nodes(self.n, self.l), ", crossing zero at = ", self.icl
+            if np.isnan(Ficl):
+                return [Ficl, dFdE, count]
+            # the levels below E counted on the matched solution change exactly where F vanishes
+            return [Ficl, dFdE, levels]
+
+        [self.E, self.Emin, self.Emax, iterations, evaluations, converged] = findLevel(shoot, self.nodes(self.n, self.l), self.Emin, self.Emax, self.E, eps, self.Niter)
+        if converged:
+            print "Converged to energy ", self.E*eV, " eV after ", iterations, " iterations (", evaluations, " shooting passes)"
+        else:
+            print "Not converged after ", iterations, " iterations (", evaluations, " shooting passes): the level is in [", self.Emin*eV, ", ", self.Emax*eV, "] eV, using E = ", self.E*eV, " eV"
+        # findLevel does not shoot its last trial energy (and skips the ones outside the window of the level),
+        # so the solution is calculated once more at the energy it returns
+        [self.y, self.yp, self.yfinal, self.icl, self.no, self.nop, Ficl, dFdE, levels] = self.solve(rc, potc, self.n, self.l, self.E, self.Z, ws)
+        # the solution is zero beyond the cut-off
+        [self.y, self.yp, self.yfinal] = [padToGrid(self.y, N), padToGrid(self.yp, N), padToGrid(self.yfinal, N)]
+
+	# now we have y for the final energy
+	# if we want to plot it, we would need to
+	# undo the transformation done previously (y = sqrt(r)*psi) and normalise it so that
+	# int psi^2 r^2 dr = 1
+        psi = toPsi(self.r, self.y, self.quad)
+        psip = toPsi(self.r, self.yp, self.quad)
+        self.psifinal = toPsi(self.r, self.yfinal, self.quad)
+        plotWaveFunction(r, psi, psip, self.psifinal, self.n, self.l, 'lastwf.eps')
 
     # calculates the Vd = sum_orbitals integral psi_orb^2/r dr
     # calculates also Vex = sum orbitals integral psi_orb psi_this_orbital/r dr
@@ -424,84 +449,69 @@ class Orbital:
     # to return Vd/2
     def loadHartreeFockPotential(self, orbitalList, orbKey):
         print "in load HF", orbKey, self.spin
-        thisVhf = np.zeros(len(self.r))
 
-	thisVd = np.zeros(len(r))
+        # now calculate Vhf = sum_orb integral psi_orb(r) psi_orb(r') 1/(r-r') dr'
+        # for Vd, consider all orbitals, including this one
+        #### but my own term cancels out by Vex, so remove it to make it faster
+        #if orbitalName == orbKey and orbPsi.spin == self.spin:
+        #    continue
+        #
+        # calculate Vd(r) * W_this(r) = int W(r')*W(r')*1/(r-r') dV *W_this(r)
+        # the W_this(r) part is already part of the Schr. equation
+        # (basically Vd is added as part of a(x) in y''(x) + a(x) y(x) = E y(x) )
+        # So we calculate the integral above only
+        # this is similar to an electrostatis problem
+        # Define a "charge density" rho(r) = W^2(r)/r
+        # We can use Gauss' law (e0 = 1) to arrive at the integral above:
+        # div E = rho(r)
+        # Vd(r) = int rho(r) dV = int div E dV = int E . dS
+        # now we only need to find the "electric field"
+        # and integrate it (in surface and not volume!)
+        # int E . dS = Q(S)/(4*pi*r^2), where Q(S) is the charge
+        # contained in the surface S (because rho(r) is radial)
+        # Q(S) = int rho(r) dV = 4*pi* sum_r=0^S rho(r)*r^2*dr
+        # so Vd(r) will be the line integral:
+        # Vd(r) = int E . dl = sum_r'=inf^r Q(S)/(4*pi*r^2) dr
+        #
+        # So, in summary:
+        # 0) calculate rho(r) = W(r)^2/r
+        # 1) calculate Q(r) = 4*pi*sum_r'=0^r rho(r)*r^2*dr
+        # 2) calculate E(r) = Q(r)/(4*pi*r^2)
+        # 3) calculate Vd(r) = sum_r'=inf^r E(r)*dr
+        # in principle Vd = 0 for r = inf,
+        # but we can choose any reference we want
+        # in any case, the potential in r = r_max is due
+        # to the charge contained in r_max
+        # (see poisson.py, which does this for the densities of all orbitals at once)
+        # only the orbitals whose density changed since the last time are calculated again,
+        # and the sum over the orbitals is kept in hartreeCache
+        keys = []
+        rho = []
         for orbitalName in orbitalList: # go through 1s, 2s, 2p, etc.
-	    k = 0
-	    for orbPsi in orbitalList[orbitalName]: # go through electrons in each of the orbital (ie: 1s1, 1s2)
-	        k += 1
-	        # now calculate Vhf = sum_orb integral psi_orb(r) psi_orb(r') 1/(r-r') dr'
-		# for Vd, consider all orbitals, including this one
-		#### but my own term cancels out by Vex, so remove it to make it faster
-		#if orbitalName == orbKey and orbPsi.spin == self.spin:
-		#    continue
-	        print orbitalName, orbPsi.spin
-
-                # calculate Vd(r) * W_this(r) = int W(r')*W(r')*1/(r-r') dV *W_this(r)
-		# the W_this(r) part is already part of the Schr. equation
-		# (basically Vd is added as part of a(x) in y''(x) + a(x) y(x) = E y(x) )
-		# So we calculate the integral above only
-		# this is similar to an electrostatis problem
-		# Define a "charge density" rho(r) = W^2(r)/r
-	        # We can use Gauss' law (e0 = 1) to arrive at the integral above:
-		# div E = rho(r)
-		# Vd(r) = int rho(r) dV = int div E dV = int E . dS
-		# now we only need to find the "electric field"
-		# and integrate it (in surface and not volume!)
-		# int E . dS = Q(S)/(4*pi*r^2), where Q(S) is the charge
-		# contained in the surface S (because rho(r) is radial)
-		# Q(S) = int rho(r) dV = 4*pi* sum_r=0^S rho(r)*r^2*dr
-		# so Vd(r) will be the line integral:
-		# Vd(r) = int E . dl = sum_r'=inf^r Q(S)/(4*pi*r^2) dr
-		#
-		# So, in summary:
-		# 0) calculate rho(r) = W(r)^2/r
-		# 1) calculate Q(r) = 4*pi*sum_r'=0^r rho(r)*r^2*dr
-		# 2) calculate E(r) = Q(r)/(4*pi*r^2)
-		# 3) calculate Vd(r) = sum_r'=inf^r E(r)*dr
-                E = np.zeros(len(self.r))
-                rho = np.zeros(len(self.r))
-		for z in range(0, len(self.r)):
-		    rho[z] = orbPsi.psifinal[z]**2
-                Q = 0
-		for z in range(0, len(self.r)):
-		    dr = 0
-		    if z >= 1:
-		        dr = self.r[z] - self.r[z-1]
-		    else:
-		        dr = self.r[z]
-		    Q += rho[z]*self.r[z]**2*dr
-		    # this is E:
-		    E[z] = Q/(self.r[z]**2)
-                Vd = np.zeros(len(self.r))
-		# now Vd will be integrated as sum r'=inf^r E(r) dr
-		# in principle Vd = 0 for r = inf,
-		# but we can choose any reference we want
-		# in any case, the potential in r = r_max is due
-		# to the charge contained
-		# in r_max:
-		#Vd[len(self.r)-1] = E[len(self.r)-1]*self.r[len(self.r)-1]
-		Vd[len(self.r)-1] = Q/self.r[len(self.r)-1]
-		# now integrate backwards
-		# Vd(r) = int_inf^r E(r') dr'
-		# Vd(r-h) = int_inf^r E(r') dr' + int_r^r-h E(r') dr'
-		# Vd(r-h) = Vd(r) + E(r)*dr
-		for z in reversed(range(0, len(self.r)-1)):
-                    Vd[z] = Vd[z+1] + E[z]*(self.r[z+1] - self.r[z])
-		# for Helium, final Vhf = 0.5 Vd
-		# not calculating Vex now: this makes it specific to Helium
-		# the fact that Vex = 0.5 Vd is only true for Helium
-                thisVhf += 0.5*Vd
-		thisVd += 0.5*Vd
-
-	print "Sum Vd  = ", np.sum(thisVd)
-	print "Sum Vhf = ", np.sum(thisVhf)
-	# this (alledgedly) helps in the convergence
-	# should be just this otherwise:
-	#self.Vhf = thisVhf
-	self.Vhf = 0.7*self.Vhf + 0.3*thisVhf
-                
+            for k in range(0, len(orbitalList[orbitalName])): # go through electrons in each of the orbital (ie: 1s1, 1s2)
+                orbPsi = orbitalList[orbitalName][k]
+                print orbitalName, orbPsi.spin, orbPsi.occ
+                if hartreeCache.changed((orbitalName, k), orbPsi.occ*orbPsi.psifinal**2):
+                    keys.append((orbitalName, k))
+                    rho.append(orbPsi.occ*orbPsi.psifinal**2)
+        print "Direct potential recalculated for ", len(rho), " orbitals"
+        if len(rho) > 0:
+            Vd = self.poisson.potential(np.array(rho), outerCharge = True)
+            for i in range(0, len(keys)):
+                hartreeCache.store(keys[i], rho[i], Vd[i])
+        # for Helium, final Vhf = 0.5 Vd
+        # not calculating Vex now: this makes it specific to Helium
+        # the fact that Vex = 0.5 Vd is only true for Helium
+        thisVd = 0.5*hartreeCache.total
+        thisVhf = thisVd
+
+        print "Sum Vd  = ", np.sum(thisVd)
+        print "Sum Vhf = ", np.sum(thisVhf)
+        # this (alledgedly) helps in the convergence
+        # should be just this otherwise:
+        #self.Vhf = thisVhf
+        self.Vhf = 0.7*self.Vhf + 0.3*thisVhf
+
 
 def plotPotential(r, V, Vhf, name):
     idx = np.where(r > 1)
@@ -609,13 +619,9 @@ def calculateTotalEnergy(orbitalList):
     JmK = 0
     for orbitalName in orbitalList: # go through 1s, 2s, 2p, etc.
         for orbPsi in orbitalList[orbitalName]: # go through electrons in each of the orbital (ie: 1s1, 1s2)
-	    E0 += orbPsi.E # sums eigen values
-	    for z in range(0, len(orbPsi.r)):
-	        dr = 0
-		if z < len(orbPsi.r)-1:
-		    dr = orbPsi.r[z+1] - orbPsi.r[z]
-		# ignoring Vex, as it is already included by doing 0.5*Vd in He
-  	        JmK += orbPsi.Vhf[z]*(orbPsi.psifinal[z]**2)*(orbPsi.r[z]**2)*dr
+	    E0 += orbPsi.occ*orbPsi.E # sums eigen values
+	    # ignoring Vex, as it is already included by doing 0.5*Vd in He
+	    JmK += orbPsi.occ*orbPsi.quad.integrate(orbPsi.Vhf*(orbPsi.psifinal**2)*(orbPsi.r**2))
     print "J-K", JmK
     E0 += -0.5*JmK
     return E0
@@ -627,75 +633,112 @@ def calculateTotalEnergy(orbitalList):
 # Z is the atomic number (to make the Grid finer for atoms that have higher Z)
 # the reason for Z in this is that the Coulomb potential is stronger for
 # atoms with higher Z, so more detail close to r = 0 is needed
-# getAF() has been written with this Grid format in mind
-# other Grids can be tried, but then getAF() needs to be changed, since
+# shooting.logGridCoefficients has been written with this Grid format in mind
+# other Grids can be tried, but then the coefficients need to be changed (see shooting.linearGridCoefficients), since
 # the derivative in the Schr. equation now are taken as a function of
 # x = ln(Z*r) (that is: r = exp(x)/Z)
 # dx/dr = 1/r (that is: dr/dx = r)
-r = init(N, xmin, C = 2.0)
-
-# make orbital configuration
-# for Helium: 1s^2
-# spin is used to distinguish electrons in same orbital
-# any other ID could be used: the objective is only to avoid
-# double counting the energy when calculating the Hartree-Fock potential
-# the electron's own energy should not be included
-# n and l are needed to establish number of zeroes and initial conditions
-# when solving the equation
-# Z is used in Coulomb potential
-orb = {}
-orb['1s'] = []
-orb['1s'].append(Orbital(_n = 1, _l = 0, _Z = Z, _r = r, _spin = 0.5))   # stop here for H
-orb['1s'].append(Orbital(_n = 1, _l = 0, _Z = Z, _r = r, _spin = -0.5))  # stop here for He
-
-E_gs_old = 0
-hfIter = 0
-while hfIter < 30:
-    print '---> Hartree-Fock iteration', hfIter
-    print '-->  (HF iteration '+str(hfIter)+') Will now solve atom Schr. equation using Coulomb potential and effective potential caused by other atoms'
-    for orbitalName in orb:
-	k = 0
-        for orbPsi in orb[orbitalName]:
-            print '-->  (HF iteration '+str(hfIter)+') Solving equation for orbital ', orbitalName, ' electron ', k
-            orbPsi.solveWithCurrentPotential()
-	    k += 1
-	
-    for orbitalName in orb:
-	k = 0
-        for orbPsi in orb[orbitalName]:
-            print '-->  (HF iteration '+str(hfIter)+') Solving equation for orbital ', orbitalName, ' electron ', k
-            print '->   (HF iteration '+str(hfIter)+') ', orbitalName, ', electron ', k, ': Hartree-Fock eigenvalue = ', orbPsi.E*eV
-	    k += 1
-
-    print '---> (HF iteration '+str(hfIter)+') Solved the Schr. equation with effective potentials, now we use wave functions found to recalculate effective potentials of other electrons in electron x, for each x.'
-    for orbitalName in orb:
-        k = 0
-        for orbPsi in orb[orbitalName]:
-            print '-->  (HF iteration '+str(hfIter)+') Recalculating effective potentials for orbital ', orbitalName, ', electron ', k
-            orbPsi.loadHartreeFockPotential(orb, orbitalName)
-	    k += 1
-    
-    # plot potential
-    keys = orb.keys()
-    highestE = -999999999
-    externOrb = ''
-    externIdx = -1
-    for k in keys:
-        for item in range(0, len(orb[k])):
-            if orb[k][item].E > highestE:
-	        highestE = orb[k][item].E
-		externOrb = k
-		externIdx = item
-    plotPotential(r, orb[externOrb][externIdx].V, orb[externOrb][externIdx].Vhf, 'potential_hfIter'+str(hfIter)+'.eps')
-    fitPotential(r, orb[externOrb][externIdx].V, orb[externOrb][externIdx].Vhf, 'potentialFit_hfIter'+str(hfIter)+'.eps')
-
-    # calculate ground state energy
-    E_gs = calculateTotalEnergy(orb)
-    print '-->  (HF iteration '+str(hfIter)+') Ground state energy = ', E_gs*eV, ' eV'
-    
-    hfIter += 1
-    # stop when the new ground state energy is less than 1% of the old one
-    if np.fabs((E_gs - E_gs_old)/E_gs) < 1e-2:
-        break
-    E_gs_old = E_gs
-
+#
+# run the Hartree-Fock iterations on the grid with spacing _dx and _N points
+# (dx and r are replaced by the ones of this grid)
+# returns the ground state energy and the orbitals
+def runHartreeFock(_dx, _N):
+    global dx, r, hartreeCache
+    dx = _dx
+    r = init(_N, xmin, C = 2.0)
+    hartreeCache = HartreeCache(hartreeTolerance)
+
+    # make orbital configuration
+    # for Helium: 1s^2
+    # spin is used to distinguish electrons in same orbital
+    # any other ID could be used: the objective is only to avoid
+    # double counting the energy when calculating the Hartree-Fock potential
+    # the electron's own energy should not be included
+    # n and l are needed to establish number of zeroes and initial conditions
+    # when solving the equation
+    # Z is used in Coulomb potential
+    # in restricted mode, both electrons share one orbital with occ = 2 (occ = 1 for He^+)
+    orb = {}
+    orb['1s'] = []
+    if restricted:
+        orb['1s'].append(Orbital(_n = 1, _l = 0, _Z = Z, _r = r, _spin = 0, _occ = 2))
+    else:
+        orb['1s'].append(Orbital(_n = 1, _l = 0, _Z = Z, _r = r, _spin = 0.5))   # stop here for H
+        orb['1s'].append(Orbital(_n = 1, _l = 0, _Z = Z, _r = r, _spin = -0.5))  # stop here for He
+
+    E_gs_old = 0
+    hfIter = 0
+    while hfIter < maxHartreeFockIterations:
+        print '---> Hartree-Fock iteration', hfIter
+        print '-->  (HF iteration '+str(hfIter)+') Will now solve atom Schr. equation using Coulomb potential and effective potential caused by other atoms'
+        for orbitalName in orb:
+            k = 0
+            for orbPsi in orb[orbitalName]:
+                print '-->  (HF iteration '+str(hfIter)+') Solving equation for orbital ', orbitalName, ' electron ', k
+                orbPsi.solveWithCurrentPotential()
+                k += 1
+
+        for orbitalName in orb:
+            k = 0
+            for orbPsi in orb[orbitalName]:
+                print '-->  (HF iteration '+str(hfIter)+') Solving equation for orbital ', orbitalName, ' electron ', k
+                print '->   (HF iteration '+str(hfIter)+') ', orbitalName, ', electron ', k, ': Hartree-Fock eigenvalue = ', orbPsi.E*eV
+                k += 1
+
+        print '---> (HF iteration '+str(hfIter)+') Solved the Schr. equation with effective potentials, now we use wave functions found to recalculate effective potentials of other electrons in electron x, for each x.'
+        for orbitalName in orb:
+            k = 0
+            for orbPsi in orb[orbitalName]:
+                print '-->  (HF iteration '+str(hfIter)+') Recalculating effective potentials for orbital ', orbitalName, ', electron ', k
+                orbPsi.loadHartreeFockPotential(orb, orbitalName)
+                k += 1
+
+        # plot potential
+        keys = orb.keys()
+        highestE = -999999999
+        externOrb = ''
+        externIdx = -1
+        for k in keys:
+            for item in range(0, len(orb[k])):
+                if orb[k][item].E > highestE:
+                    highestE = orb[k][item].E
+                    externOrb = k
+                    externIdx = item
+        plotPotential(r, orb[externOrb][externIdx].V, orb[externOrb][externIdx].Vhf, 'potential_hfIter'+str(hfIter)+'.eps')
+        fitPotential(r, orb[externOrb][externIdx].V, orb[externOrb][externIdx].Vhf, 'potentialFit_hfIter'+str(hfIter)+'.eps')
+
+        # calculate ground state energy
+        E_gs = calculateTotalEnergy(orb)
+        print '-->  (HF iteration '+str(hfIter)+') Ground state energy = ', E_gs*eV, ' eV'
+
+        hfIter += 1
+        # stop when the new ground state energy is less than scfTolerance (1%) of the old one
+        if np.fabs((E_gs - E_gs_old)/E_gs) < scfTolerance:
+            break
+        E_gs_old = E_gs
+    else:
+        print '-->  Hartree-Fock iterations not converged to ', scfTolerance, ' after ', maxHartreeFockIterations, ' iterations'
+    return [E_gs, orb]
+
+if richardsonDx is None:
+    [E_gs, orb] = runHartreeFock(dx, N)
+else:
+    # the same calculation on grids covering the same range of r, extrapolated to dx = 0
+    E_gsList = []
+    eigenvalues = {}
+    for [dxk, Nk] in zip(richardsonDx, equivalentGridSizes(dx, N, richardsonDx)):
+        print '---> Hartree-Fock iterations with dx = ', dxk, ' and ', Nk, ' grid points'
+        [E_gs, orb] = runHartreeFock(dxk, Nk)
+        E_gsList.append(E_gs)
+        for orbitalName in orb:
+            for k in range(0, len(orb[orbitalName])):
+                eigenvalues.setdefault((orbitalName, k), []).append(orb[orbitalName][k].E)
+    # the first order sums of Gauss' law dominate the error unless useNumerovPoisson is set
+    order = 4
+    if not useNumerovPoisson:
+        order = 1
+    for key in sorted(eigenvalues.keys()):
+        [Eext, Eerr, p] = extrapolate(richardsonDx, eigenvalues[key], order)
+        print '-->  ', key[0], ', electron ', key[1], ': Hartree-Fock eigenvalue = ', np.array(eigenvalues[key])*eV, ' eV -> extrapolated to dx = 0: ', Eext*eV, ' eV (discretisation error on the finest grid ', Eerr*eV, ' eV, order ', p, ')'
+    [Eext, Eerr, p] = extrapolate(richardsonDx, E_gsList, order)
+    print '-->  Ground state energy = ', np.array(E_gsList)*eV, ' eV -> extrapolated to dx = 0: ', Eext*eV, ' eV (discretisation error on the finest grid ', Eerr*eV, ' eV, order ', p, ')'
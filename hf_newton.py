@@ -7,6 +7,11 @@ import collections
 import scipy
 import scipy.sparse
 import scipy.sparse.linalg
+from shooting import logGridCoefficients, NumerovWorkspace
+from poisson import GaussLawSolver, NumerovPoissonSolver, HartreeCache
+from quadrature import LogGridQuadrature
+import montecarlo
+import angular
 
 class bcolors:
     HEADER = '\033[4m'
@@ -49,8 +54,6 @@ def init(dx, N, xmin):
 def nodes(n, l):
     return n - l - 1
 
-import random
-
 def Y(l, m, theta, phi):
     if l == 0:
         return 0.5*np.sqrt(1.0/np.pi)
@@ -73,252 +76,6 @@ def factorial(n):
         return 1
     return n * factorial(n-1)
 
-def CG(j1, j2, m1, m2, j, m):
-    if abs(m) > j:
-        return 0
-    if j1 + j2 < j:
-        return 0
-    if abs(j1-j2) > j:
-        return 0
-    if m1+m2 != m:
-        return 0
-    if j1 < j2:
-        return (-1.0)**(j-j1-j2)*CG(j2,j1,m2,m1,j,m)
-    if m < 0:
-        return (-1.0)**(j-j1-j2)*CG(j1,j2,-m1,-m2,j,-m)
-    if j2 == 0:
-        if j == j1 and m == m1:
-            return 1
-        else:
-            return 0
-    elif j1 == 1 and j2 == 1:
-        if m == 2:
-            if m1 == 1 and m2 == 1 and j == 2:
-                return 1
-            else:
-                return 0
-        elif m == 1:
-            if m1 == 1 and m2 == 0 and j == 2:
-                return 0.5**0.5
-            elif m1 == 1 and m2 == 0 and j == 1:
-                return 0.5**0.5
-            elif m1 == 0 and m2 == 1 and j == 1:
-                return - (0.5**0.5)
-            elif m1 == 1 and m2 == 0 and j == 2:
-                return (0.5**0.5)
-            else:
-                return 0
-        elif m == 0:
-            if m1 == 1 and m2 == -1 and j == 2:
-                return (1.0/6.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 1:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 0:
-                return (1.0/3.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 2:
-                return (2.0/3.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 1:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 0:
-                return - (1.0/3.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 2:
-                return (1.0/6.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 1:
-                return - (1.0/2.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 0:
-                return (1.0/3.0)**0.5
-            else:
-                return 0
-        else:
-            return 0
-    elif j1 == 2 and j2 == 1:
-        if m == 3:
-            if m1 == 2 and m2 == 1 and j == 3:
-                return 1
-            else:
-                return 0
-        elif m == 2:
-            if m1 == 2 and m2 == 0 and j == 3:
-                return (1.0/3.0)**0.5
-            elif m1 == 2 and m2 == 0 and j == 2:
-                return (2.0/3.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 3:
-                return (2.0/3.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 2:
-                return - (1.0/3.0)**0.5
-            else:
-                return 0
-        elif m == 1:
-            if m1 == 2 and m2 == -1 and j == 3:
-                return (1.0/15.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 2:
-                return (1.0/3.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 1:
-                return (3.0/5.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 3:
-                return (8.0/15.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 2:
-                return (1.0/16.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 1:
-                return - (3.0/10.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 3:
-                return (2.0/5.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 2:
-                return -(1.0/2.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 1:
-                return (1.0/10.0)**0.5
-            else:
-                return 0
-        elif m == 0:
-            if m1 == 1 and m2 == -1 and j == 3:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 2:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 1:
-                return (3.0/10.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 3:
-                return (3.0/5.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 2:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 1:
-                return - (2.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 3:
-                return (1.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 2:
-                return - (1.0/2.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 1:
-                return - (3.0/10.0)**0.5
-            else:
-                return 0
-    elif j1 == 2 and j2 == 2:
-        if m == 4:
-            if m1 == 2 and m2 == 2 and j == 4:
-                return 1
-            else:
-                return 0
-        elif m == 3:
-            if m1 == 2 and m2 == 1 and j == 4:
-                return (1.0/2.0)**0.5
-            elif m1 == 2 and m2 == 1 and j == 3:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == 2 and j == 4:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == 2 and j == 3:
-                return - (1.0/2.0)**0.5
-            else:
-                return 0
-        elif m == 2:
-            if m1 == 2 and m2 == 0 and j == 4:
-                return (3.0/14.0)**0.5
-            elif m1 == 2 and m2 == 0 and j == 3:
-                return (1.0/2.0)**0.5
-            elif m1 == 2 and m2 == 0 and j == 2:
-                return (2.0/7.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 4:
-                return (4.0/7.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 3:
-                return 0
-            elif m1 == 1 and m2 == 1 and j == 2:
-                return - (3.0/7.0)**0.5
-            elif m1 == 0 and m2 == 2 and j == 4:
-                return (3.0/14.0)**0.5
-            elif m1 == 0 and m2 == 2 and j == 3:
-                return -(1.0/2.0)**0.5
-            elif m1 == 0 and m2 == 2 and j == 2:
-                return (2.0/7.0)**0.5
-            else:
-                return 0
-        elif m == 1:
-            if m1 == 2 and m2 == -1 and j == 4:
-                return (1.0/14.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 3:
-                return (3.0/10.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 2:
-                return (3.0/7.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 1:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 4:
-                return (3.0/7.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 3:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 2:
-                return - (1.0/14.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 1:
-                return - (3.0/10.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 4:
-                return (3.0/7.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 3:
-                return - (1.0/5.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 2:
-                return - (1.0/14.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 1:
-                return - (3.0/10.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 4:
-                return (1.0/14.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 3:
-                return - (3.0/10.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 2:
-                return (3.0/7.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 1:
-                return - (1.0/5.0)**0.5
-            else:
-                return 0
-        elif m == 0:
-            if m1 == 2 and m2 == -2 and j == 4:
-                return (1.0/70.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 3:
-                return (1.0/10.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 2:
-                return (2.0/7.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 1:
-                return (2.0/5.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 0:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 4:
-                return (8.0/35.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 3:
-                return (2.0/5.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 2:
-                return (1.0/14.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 1:
-                return -(1.0/10.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 0:
-                return -(1.0/5.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 4:
-                return (18.0/35.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 3:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 2:
-                return -(2.0/7.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 1:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 0:
-                return (1.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 4:
-                return (8.0/35.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 3:
-                return -(2.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 2:
-                return (1.0/14.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 1:
-                return (1.0/10.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 0:
-                return -(1.0/5.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 4:
-                return (1.0/70.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 3:
-                return -(1.0/10.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 2:
-                return (2.0/7.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 1:
-                return -(2.0/5.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 0:
-                return (1.0/5.0)**0.5
-            else:
-                return 0
-
-    return 0
-
 ## potential calculation
 # calculate int rpsi1(r1)*Ylm(t1, p1)*rpsi1(r1)*Ylm(t1, p1)/|r1-r2| r^2 sin t1 dt1 dp1 dr1
 # 1/|r1 - r2| = \sum_l=0^inf \sum_m=-l^m=l 4 pi / (2l + 1) rs^l/rb^(l+1) Ylm(t1, p1) Ylm(t2, p2)
@@ -327,234 +84,434 @@ def CG(j1, j2, m1, m2, j, m):
 # int Ylm^3(t1, p1) dOmega1 = ... (A4.40)
 #                           = (-1)^m sqrt( (2l+1)*(2l+1) / (4 pi (2l+1)) ) <ll00|l0> <llmm|l -m>
 # = \sum_l=0^inf \sum_m=-l^m=l 4 pi / (2l + 1)   (int rpsi(r1)^2 rs^l/rb^(l+1) r1^2 dr1) (-1)^m sqrt( (2l+1)*(2l+1) / (4 pi (2l+1)) ) <ll00|l0> <llmm|l -m> Ylm(t2, p2)
-def getIntegrandH(r, z1, t1, p1, z2, t2, p2, phi1):
-    return (r[z1]**2)*(phi1.rpsi[z1]**2)*(Y(phi1.l, phi1.m, t1, p1)**2)*(np.sin(t1))/np.sqrt((r[z1]*np.sin(t1)*np.cos(p1) - r[z2]*np.sin(t2)*np.cos(p2))**2 + (r[z1]*np.sin(t1)*np.sin(p1) - r[z2]*np.sin(t2)*np.sin(p2))**2 + (r[z1]*np.cos(t1) - r[z2]*np.cos(t2))**2)
+# getDensityH is the numerator, r1^2 rpsi1(r1)^2 Ylm(t1, p1)^2 sin t1
+def getDensityH(r, z1, t1, p1, phi1):
+    return (r[z1]**2)*(phi1.rpsi[z1]**2)*(Y(phi1.l, phi1.m, t1, p1)**2)*(np.sin(t1))
 
+def getIntegrandH(r, z1, t1, p1, z2, t2, p2, phi1):
+    return getDensityH(r, z1, t1, p1, phi1)/np.sqrt((r[z1]*np.sin(t1)*np.cos(p1) - r[z2]*np.sin(t2)*np.cos(p2))**2 + (r[z1]*np.sin(t1)*np.sin(p1) - r[z2]*np.sin(t2)*np.sin(p2))**2 + (r[z1]*np.cos(t1) - r[z2]*np.cos(t2))**2)
+
+# points u uniform in [0, 1)^5 (one per row) to r1 and the directions of r1 and r2 in the MC integrals of the potentials
+# r1 = tan(x1) with x1 = pi/2 u, as in getMCCoordinates, t = pi u and p = 2 pi u
+# returns [z1, t1, p1, t2, p2, volume], with volume = pi 2 pi (pi/2 sec^2(x1)) 2 pi pi sin(t2)/(4 pi)
+# (the last factors average over the direction of r2)
+def getMCPotentialCoordinates(r, u):
+    x1 = np.pi*0.5*u[:, 0]
+    z1 = np.clip(((np.log(np.tan(x1)) - xmin)/dx).astype(int), 0, len(r)-1)
+    t1 = u[:, 1]*np.pi
+    t2 = u[:, 2]*np.pi
+    p1 = u[:, 3]*2*np.pi
+    p2 = u[:, 4]*2*np.pi
+    volume = np.pi*2*np.pi*np.pi*0.5*1.0/(np.cos(x1)**2)*2*np.pi*np.pi*np.sin(t2)/(4*np.pi)
+    return [z1, t1, p1, t2, p2, volume]
+
+# potential on all the grid points at once of the density given by density(z1, t1, p1) (getDensityH or getDensityXC),
+# with common random numbers: the same samples of r1 and of the directions of r1 and r2 for all r2
+# each block of samples is evaluated against all the grid points (a samples x points array, with at most
+# mcGridElements entries), until the largest error is below mcTolerance, with at most mcPotentialSamples samples
+def getPotentialMCAllPoints(r, density, key, name):
+    print "Using MC integration to calculate %s on all the points" % name
+    def integrand(u):
+        [z1, t1, p1, t2, p2, volume] = getMCPotentialCoordinates(r, u)
+        w = volume*density(z1, t1, p1)
+        r1 = r[z1][:, np.newaxis]
+        return w[:, np.newaxis]/getDistance(r1, t1[:, np.newaxis], p1[:, np.newaxis], r[np.newaxis, :], t2[:, np.newaxis], p2[:, np.newaxis])
+    blockSize = max(1, min(mcBatchSize, mcGridElements//len(r)))
+    acc = montecarlo.integrate(integrand, 5, mcPotentialSamples, blockSize = blockSize, tolerance = mcTolerance,
+                               seed = mcSeed, key = key, workers = mcWorkers)
+    print "%s: %d MC samples, largest error %.3g (tolerance %.3g)" % (name, acc.samples, np.max(acc.error()), mcTolerance)
+    return acc.mean
+
+# each point of the potential is integrated until its error is below mcTolerance, with at most mcPotentialSamples samples
+# the points run on mcWorkers processes, each one with its own random streams
+# (or all the points at once with the same samples, if mcCommonSamples is True)
 def getPotentialHMC(r, phiList, iOrb):
-    Vd = np.zeros(len(r), dtype=np.float64)
+    key = nextMCKey()
+    if mcCommonSamples:
+        density = lambda z1, t1, p1: getDensityH(r, z1, t1, p1, phiList[iOrb])
+        return getPotentialMCAllPoints(r, density, key, "Coulomb potential for %s" % iOrb)
     # integrate on r1[0, len(r)], p1[0, 2pi], t1[0, pi]
-    for z2 in range(0, len(r)):
+    def integratePoint(z2):
         if z2 % 50 == 0:
             print "Using MC integration to calculate Coulomb potential for %s: %d" % (iOrb, z2)
-        Ntot = int(20000)
-        for N in range(0, Ntot):
-            x1 = np.pi*0.5*random.random()
-            r1 = np.tan(x1)
-            z1 = int((np.log(r1) - xmin)/dx)
-            if z1 > len(r)-1:
-                z1 = len(r)-1
-            # r = tan(x) => dr/dx = sec^2(x)
-            # int f(x) dr = int f(x) dr/dx dx
-            t1 = random.random()*np.pi
-            t2 = random.random()*np.pi
-            p1 = random.random()*2*np.pi
-            p2 = random.random()*2*np.pi
-            #Vd[z2] += np.pi*2*np.pi*np.pi*0.5*1.0/(np.cos(x1)**2)*getIntegrandH(r, z1, t1, p1, z2, t2, p2, phiList[iOrb])*Y(phiList[xOrb].l, phiList[xOrb].m, t2, p2)*2*np.pi*np.pi*np.sin(t2)/(4*np.pi)/float(Ntot)
-            Vd[z2] += np.pi*2*np.pi*np.pi*0.5*1.0/(np.cos(x1)**2)*getIntegrandH(r, z1, t1, p1, z2, t2, p2, phiList[iOrb])*2*np.pi*np.pi*np.sin(t2)/(4*np.pi)/float(Ntot)
+        def integrand(u):
+            [z1, t1, p1, t2, p2, volume] = getMCPotentialCoordinates(r, u)
+            return volume*getIntegrandH(r, z1, t1, p1, z2, t2, p2, phiList[iOrb])
+        acc = montecarlo.integrate(integrand, 5, mcPotentialSamples, blockSize = mcBatchSize, tolerance = mcTolerance,
+                                   seed = mcSeed, key = key + (z2,))
+        return [acc.mean, acc.samples]
+    result = np.array(montecarlo.parallelMap(integratePoint, range(0, len(r)), mcWorkers))
+    Vd = result[:, 0]
+    samples = np.sum(result[:, 1])
+    print "Coulomb potential for %s: %d MC samples (%.1f per point)" % (iOrb, samples, samples/float(len(r)))
     return Vd
 
 ## potential calculation
 # calculate int rpsi1(r1)*Yl1m1(t1, p1)*rpsi2(r1)*Yl2m2(t1, p1)/|r1-r2| r1^2 sin t1 dt1 dp1 dr1
+# getDensityXC is the numerator, r1^2 rpsi1(r1) Yl1m1(t1, p1) rpsi2(r1) Yl2m2(t1, p1) sin t1
+def getDensityXC(r, z1, t1, p1, phi1, phi2):
+    return r[z1]**2*phi1.rpsi[z1]*Y(phi1.l, phi1.m, t1, p1)*phi2.rpsi[z1]*Y(phi2.l, phi2.m, t1, p1)*np.sin(t1)
+
 def getIntegrandXC(r, z1, t1, p1, z2, t2, p2, phi1, phi2):
-    return r[z1]**2*phi1.rpsi[z1]*Y(phi1.l, phi1.m, t1, p1)*phi2.rpsi[z1]*Y(phi2.l, phi2.m, t1, p1)*np.sin(t1)/np.sqrt((r[z1]*np.sin(t1)*np.cos(p1) - r[z2]*np.sin(t2)*np.cos(p2))**2 + (r[z1]*np.sin(t1)*np.sin(p1) - r[z2]*np.sin(t2)*np.sin(p2))**2 + (r[z1]*np.cos(t1) - r[z2]*np.cos(t2))**2)
+    return getDensityXC(r, z1, t1, p1, phi1, phi2)/np.sqrt((r[z1]*np.sin(t1)*np.cos(p1) - r[z2]*np.sin(t2)*np.cos(p2))**2 + (r[z1]*np.sin(t1)*np.sin(p1) - r[z2]*np.sin(t2)*np.sin(p2))**2 + (r[z1]*np.cos(t1) - r[z2]*np.cos(t2))**2)
 
 def getPotentialXCMC(r, phiList, iOrb, jOrb):
-    Vex = np.zeros(len(r), dtype=np.float64)
+    key = nextMCKey()
+    if mcCommonSamples:
+        density = lambda z1, t1, p1: getDensityXC(r, z1, t1, p1, phiList[iOrb], phiList[jOrb])
+        return getPotentialMCAllPoints(r, density, key, "XC potential for %s,%s" % (iOrb, jOrb))
     # integrate on r1[0, len(r)], p1[0, 2pi], t1[0, pi]
-    for z2 in range(0, len(r)):
+    def integratePoint(z2):
         if z2 % 50 == 0:
             print "Using MC integration to calculate XC potential for %s,%s: %d" % (iOrb, jOrb, z2)
-        Ntot = int(20000)
-        for N in range(0, Ntot):
-            x1 = np.pi*0.5*random.random()
-            r1 = np.tan(x1)
-            z1 = int((np.log(r1) - xmin)/dx)
-            if z1 > len(r)-1:
-                z1 = len(r)-1
-            # r = tan(x) => dr/dx = sec^2(x)
-            # int f(x) dr = int f(x) dr/dx dx
-            t1 = random.random()*np.pi
-            t2 = random.random()*np.pi
-            p1 = random.random()*2*np.pi
-            p2 = random.random()*2*np.pi
-            #Vex[z2] += np.pi*2*np.pi*np.pi*0.5*1.0/(np.cos(x1)**2)*getIntegrandXC(r, z1, t1, p1, z2, t2, p2, phiList[iOrb], phiList[jOrb])*Y(phiList[iOrb].l, phiList[iOrb].m, t2, p2)*2*np.pi*np.pi*np.sin(t2)/(4*np.pi)/float(Ntot)
-            Vex[z2] += np.pi*2*np.pi*np.pi*0.5*1.0/(np.cos(x1)**2)*getIntegrandXC(r, z1, t1, p1, z2, t2, p2, phiList[iOrb], phiList[jOrb])*2*np.pi*np.pi*np.sin(t2)/(4*np.pi)/float(Ntot)
+        def integrand(u):
+            [z1, t1, p1, t2, p2, volume] = getMCPotentialCoordinates(r, u)
+            return volume*getIntegrandXC(r, z1, t1, p1, z2, t2, p2, phiList[iOrb], phiList[jOrb])
+        acc = montecarlo.integrate(integrand, 5, mcPotentialSamples, blockSize = mcBatchSize, tolerance = mcTolerance,
+                                   seed = mcSeed, key = key + (z2,))
+        return [acc.mean, acc.samples]
+    result = np.array(montecarlo.parallelMap(integratePoint, range(0, len(r)), mcWorkers))
+    Vex = result[:, 0]
+    samples = np.sum(result[:, 1])
+    print "XC potential for %s,%s: %d MC samples (%.1f per point)" % (iOrb, jOrb, samples, samples/float(len(r)))
     return Vex
 
+# potential of the density rpsi1(r1) rpsi2(r1) Yl1m1(O1) Yl2m2(O1) on the grid r and on the nodes O2 of sphereQuadrature
+# V(r2, O2) = sum_kq 4 pi/(2k+1) beta_k(r2) c_kq Ykq(O2)
+# with the multipoles beta_k of rpsi1 rpsi2 (see poisson.py) and c_kq = int Yl1m1 Yl2m2 Ykq dO, the projection of the
+# angular part on the harmonics, so both the angular integral and the potential on the nodes are matrix products
+# with the table of the harmonics on the nodes
+# returns an array (len(r), number of nodes)
+def getPotentialOnSphere(r, phi1, phi2):
+    Q = sphereQuadrature
+    kmax = phi1.l + phi2.l
+    nk = (kmax+1)**2
+    c = Q.project(Q.Y[Q.index(phi1.l, phi1.m)]*Q.Y[Q.index(phi2.l, phi2.m)])[:nk]
+    beta = radialPoisson.multipoles(phi1.rpsi*phi2.rpsi, kmax)
+    A = np.zeros((len(r), nk))
+    for k in range(0, kmax+1):
+        for q in range(-k, k+1):
+            A[:, Q.index(k, q)] = 4*np.pi/(2*k+1)*c[Q.index(k, q)]*beta[k]
+    return Q.evaluate(A)
+
+# deterministic version of getPotentialHMC: the potential of iOrb averaged over the direction of r2
+def getPotentialHQuad(r, phiList, iOrb):
+    return sphereQuadrature.average(getPotentialOnSphere(r, phiList[iOrb], phiList[iOrb]))
+
+# deterministic version of getPotentialXCMC (the same for iOrb, jOrb and jOrb, iOrb)
+def getPotentialXCQuad(r, phiList, iOrb, jOrb):
+    return sphereQuadrature.average(getPotentialOnSphere(r, phiList[iOrb], phiList[jOrb]))
+
+# weight of the exchange with the electrons in jOrb: 1 for a spin orbital and, in restricted mode,
+# occ/2, the number of electrons in jOrb with the same spin as each of the ones in the other orbital
+# (exact for filled orbitals, and the average over the spin otherwise)
+def exchangeWeight(phiList, jOrb):
+    if restricted:
+        return 0.5*phiList[jOrb].occ
+    return 1.0
+
 ## potential calculation
+# each orbital contributes with its number of electrons (occ)
 def getPotentialH(r, phiList):
     totalVd = np.zeros(len(r), dtype=np.float64)
+    rho = []
     for iOrb in phiList.keys():
         if listPhi[iOrb].virtual:
             continue
-        # for p, d and f states, use the MC integration
+        # for p, d and f states, use the angular quadrature (or the MC integration if useAngularQuadrature is False)
         # we cannot factorize the spherical harmonics then
         if phiList[iOrb].l != 0:
-            totalVd += getPotentialHMC(r, phiList, iOrb)
+            if useAngularQuadrature:
+                totalVd += phiList[iOrb].occ*getPotentialHQuad(r, phiList, iOrb)
+            else:
+                totalVd += phiList[iOrb].occ*getPotentialHMC(r, phiList, iOrb)
             continue
         # otherwise, we can use Gauss' law
         # to integrate rho^2(r)/|r-r'| dr, which is similar to a central Coulomb potential
         # for a charge density rho(r)^2, which is spherically symmetric
-	# In summary:
-	# 0) calculate rho(r) = W(r)^2
-	# 1) calculate Q(r) = 4*pi*sum_r'=0^r rho(r)*r^2*dr
-	# 2) calculate E(r) = Q(r)/(4*pi*r^2)
-	# 3) calculate Vd(r) = sum_r'=inf^r E(r)*dr
-        E = np.zeros(len(r), dtype=np.float64)
-        rho = np.zeros(len(r), dtype=np.float64)
-        for z in range(0, len(r)):
-            rho[z] = phiList[iOrb].rpsi[z]**2
-        Q = 0
-        for z in range(0, len(r)):
-            dr = 0
-            if z >= 1:
-                dr = r[z] - r[z-1]
-            else:
-                dr = r[z]
-            Q += 4*np.pi*rho[z]*r[z]**2*dr
-            # this is E:
-            E[z] = Q/(4*np.pi*r[z]**2)
-        # now Vd will be integrated as sum r'=inf^r E(r) dr
-        # in principle Vd = 0 for r = inf,
-        # but we can choose any reference we want
-        # in any case, the potential in r = r_max is due
-        # to the charge contained
-        # in r_max:
-        Vd = np.zeros(len(r), dtype=np.float64)
-        Vd[len(r)-1] = 0
-        # now integrate backwards
-        # Vd(r) = int_inf^r E(r') dr'
-        # Vd(r-h) = int_inf^r E(r') dr' + int_r^r-h E(r') dr'
-        # Vd(r-h) = Vd(r) + E(r)*dr
-        for z in reversed(range(0, len(r)-1)):
-            Vd[z] = Vd[z+1] + E[z]*(r[z+1] - r[z])
-        totalVd += Vd
+        # In summary:
+        # 0) calculate rho(r) = W(r)^2
+        # 1) calculate Q(r) = 4*pi*sum_r'=0^r rho(r)*r^2*dr
+        # 2) calculate E(r) = Q(r)/(4*pi*r^2)
+        # 3) calculate Vd(r) = sum_r'=inf^r E(r)*dr
+        # with Vd = 0 at r = r_max
+        # this is done for all s orbitals at once below (see poisson.py)
+        rho.append(phiList[iOrb].occ*phiList[iOrb].rpsi**2)
+    if len(rho) > 0:
+        totalVd += np.sum(radialPoisson.potential(np.array(rho), outerCharge = False), axis = 0)
     return totalVd
 
+# the exchange potentials are stored in a (number of orbitals, number of orbitals, len(r)) array vxc,
+# indexed with phiToInt, where vxc[i, j] is the potential multiplying orbital j in the equation of orbital i
+# getExchangeMask(phiList)[i, j] is True where it is used: jOrb is not virtual and can have the same spin as iOrb
+# ('+' and '-' in the names, no spin in restricted mode)
+def getExchangeMask(phiList):
+    mask = np.zeros((len(phiList), len(phiList)), dtype = bool)
+    for iOrb in phiList.keys():
+        for jOrb in phiList.keys():
+            if phiList[jOrb].virtual:
+                continue
+            if ('+' in jOrb and '-' in iOrb) or ('-' in jOrb and '+' in iOrb):
+                continue
+            mask[phiToInt[iOrb], phiToInt[jOrb]] = True
+    return mask
+
+# the pairs of orbitals (i, j) with i <= j for which vxc[i, j] or vxc[j, i] is needed
+# the "charge density" rpsi_i rpsi_j is the same for both, so its integrals are done once per pair
+def getExchangePairs(mask):
+    pairs = []
+    for i in range(0, len(mask)):
+        for j in range(i, len(mask)):
+            if mask[i, j] or mask[j, i]:
+                pairs.append([i, j])
+    return pairs
+
 # calculate exchange potential 
-# returns the coefficient multiplying each orbital
-def getPotentialX(r, phiList, iOrb):
-    totalVx = {}
-    for jOrb in phiList.keys():
-        if listPhi[jOrb].virtual:
-            continue
-        if ('+' in jOrb and '-' in iOrb) or ('-' in jOrb and '+' in iOrb):
-              continue
-        # for p, d and f states, use the MC integration
+# returns vxc (see getExchangeMask): the coefficient multiplying each orbital (times exchangeWeight)
+def getPotentialX(r, phiList):
+    mask = getExchangeMask(phiList)
+    totalVx = np.zeros((len(phiList), len(phiList), len(r)), dtype = np.float64)
+    pairs = []
+    rho = []
+    for [i, j] in getExchangePairs(mask):
+        iOrb = intToPhi[i]
+        jOrb = intToPhi[j]
+        # for p, d and f states, use the angular quadrature (or the MC integration if useAngularQuadrature is False)
         # we cannot factorize the spherical harmonics then
         if phiList[iOrb].l != 0 or phiList[jOrb].l != 0:
-            totalVx[jOrb] = getPotentialXCMC(r, phiList, iOrb, jOrb)
+            if useAngularQuadrature:
+                # the same potential for both orbitals of the pair
+                Vex = getPotentialXCQuad(r, phiList, iOrb, jOrb)
+                totalVx[i, j] = exchangeWeight(phiList, jOrb)*Vex
+                totalVx[j, i] = exchangeWeight(phiList, iOrb)*Vex
+                continue
+            if mask[i, j]:
+                totalVx[i, j] = exchangeWeight(phiList, jOrb)*getPotentialXCMC(r, phiList, iOrb, jOrb)
+            if mask[j, i] and i != j:
+                totalVx[j, i] = exchangeWeight(phiList, iOrb)*getPotentialXCMC(r, phiList, jOrb, iOrb)
             continue
         # otherwise, we can use Gauss' law
         # to integrate rho^2(r)/|r-r'| dr, which is similar to a central Coulomb potential
         # for a charge density rho(r)^2, which is spherically symmetric
 
         # calculate Vex(r) * W_other(r) = int W_this(r')*W_other(r')*1/(r-r') dV W_other(r)
-	# notice that, differently from Vd, the potential is multiplying W_other, not W_this
-	# Define a "charge density" rho(r) = W_this(r)W_other(r)
-	# 0) calculate rho(r) = W_this(r)W_other(r)
-	# 1) calculate Q(r) = 4*pi*sum_r'=0^r rho(r)*r^2*dr
-	# 2) calculate E(r) = Q(r)/(4*pi*r^2)
-	# 3) calculate Vex(r) = sum_r'=inf^r E(r)*dr
-        E = np.zeros(len(r), dtype=np.float64)
-        rho = np.zeros(len(r), dtype=np.float64)
-	for z in range(0, len(r)):
-	    # jOrb is "other"
-	    # iOrb is "this"
-	    rho[z] = phiList[jOrb].rpsi[z]*phiList[iOrb].rpsi[z]
-        Q = 0
-        Q2 = 0
-	for z in range(0, len(r)):
-	    dr = 0
-	    if z >= 1:
-	        dr = r[z] - r[z-1]
-	    else:
-	        dr = r[z]
-	    Q += 4*np.pi*rho[z]*r[z]**2*dr
-	    # this is E:
-	    E[z] = Q/(4*np.pi*r[z]**2)
-        Vex = np.zeros(len(r), dtype=np.float64)
-	# now Vex will be integrated as sum r'=inf^r E(r) dr
-	# in principle Vex = 0 for r = inf,
-	# but we can choose any reference we want
-	# in any case, the potential in r = r_max is due
-	# to the charge contained
-	# in r_max:
-	Vex[len(r)-1] = 0
-	# now integrate backwards
-	# Vex(r) = int_inf^r E(r') dr'
-	# Vex(r-h) = int_inf^r E(r') dr' + int_r^r-h E(r') dr'
-	# Vex(r-h) = Vex(r) + E(r)*dr
-	for z in reversed(range(0, len(r)-1)):
-            Vex[z] = Vex[z+1] + E[z]*(r[z+1] - r[z])
-        totalVx[jOrb] = Vex
-    return totalVx
+        # notice that, differently from Vd, the potential is multiplying W_other, not W_this
+        # Define a "charge density" rho(r) = W_this(r)W_other(r)
+        # 0) calculate rho(r) = W_this(r)W_other(r)
+        # 1) calculate Q(r) = 4*pi*sum_r'=0^r rho(r)*r^2*dr
+        # 2) calculate E(r) = Q(r)/(4*pi*r^2)
+        # 3) calculate Vex(r) = sum_r'=inf^r E(r)*dr
+        # with Vex = 0 at r = r_max
+        # this is done for all pairs of s orbitals at once below (see poisson.py)
+        # and the potential is the same for both orbitals of the pair
+        pairs.append([i, j])
+        rho.append(phiList[jOrb].rpsi*phiList[iOrb].rpsi)
+    if len(rho) > 0:
+        Vex = radialPoisson.potential(np.array(rho), outerCharge = False)
+        for k in range(0, len(pairs)):
+            [i, j] = pairs[k]
+            totalVx[i, j] = exchangeWeight(phiList, intToPhi[j])*Vex[k]
+            totalVx[j, i] = exchangeWeight(phiList, intToPhi[i])*Vex[k]
+    return totalVx*mask[:, :, np.newaxis]
 
 # calculate int |rpsi1(r1)*Yl1m1(t1, p1)|^2*|rpsi2(r2)*Yl2m2(t2, p2)|^2/|r1-r2| r1^2 sin t1 r2^2 sin t2 dt1 dp1 dr1 dt2 dp2 dr2
 def getIntegrandJ(r, z1, t1, p1, z2, t2, p2, phi1, phi2):
     return (phi1.rpsi[z1]*Y(phi1.l, phi1.m, t1, p1))**2*(phi2.rpsi[z2]*Y(phi2.l, phi2.m, t2, p2))**2*(r[z1]**2*np.sin(t1))*(r[z2]**2*np.sin(t2))/np.sqrt((r[z1]*np.sin(t1)*np.cos(p1) - r[z2]*np.sin(t2)*np.cos(p2))**2 + (r[z1]*np.sin(t1)*np.sin(p1) - r[z2]*np.sin(t2)*np.sin(p2))**2 + (r[z1]*np.cos(t1) - r[z2]*np.cos(t2))**2)
 
+# points u uniform in [0, 1)^6 (one per row) to the coordinates of r1 and r2 in the MC integrals of J and K
+# r = tan(x) with x = pi/2 u (dr/dx = sec^2(x)), t = pi u and p = 2 pi u
+# r is replaced by the nearest grid point below it (the first one if r < r[0], the last one if r > r[-1])
+# returns [z1, t1, p1, z2, t2, p2, volume], where volume = (2 pi)^2 pi^2 (pi/2 sec^2(x1)) (pi/2 sec^2(x2))
+def getMCCoordinates(r, u):
+    x1 = np.pi*0.5*u[:, 0]
+    x2 = np.pi*0.5*u[:, 1]
+    z1 = np.clip(((np.log(np.tan(x1)) - xmin)/dx).astype(int), 0, len(r)-1)
+    z2 = np.clip(((np.log(np.tan(x2)) - xmin)/dx).astype(int), 0, len(r)-1)
+    t1 = u[:, 2]*np.pi
+    t2 = u[:, 3]*np.pi
+    p1 = u[:, 4]*2*np.pi
+    p2 = u[:, 5]*2*np.pi
+    volume = (np.pi*2)**2*(np.pi)**2*(np.pi*0.5*1.0/(np.cos(x1)**2))*(np.pi*0.5*1.0/(np.cos(x2)**2))
+    return [z1, t1, p1, z2, t2, p2, volume]
+
+# MC integrals of J and K: mcSamples points for each of them, from the low-discrepancy sequence mcSequence
+# ('sobol' or 'halton', in mcReplicas randomly shifted replicas for the error, see montecarlo.py)
+# or pseudo-random ones if it is None
+# if mcImportance is True, r1 and r2 are sampled from the radial densities (getRadialDistribution) and the
+# directions uniformly on the sphere, instead of the uniform samples of getMCCoordinates;
+# then, if mcControlVariate is True, the s-wave part of the integrand (its average over the directions,
+# with 1/max(r1, r2) for 1/|r1 - r2|, as for two s orbitals) is the control variate, with the exact mean
+# of getSWaveMean, so the s orbitals have no statistical error at all and the others only that of the
+# angular part
+mcSequence = 'sobol'
+mcReplicas = 16
+mcImportance = True
+mcControlVariate = True
+# all the MC integrals (J, K and each point of the MC potentials) stop as soon as their error is below
+# mcTolerance (in Hartree), drawing mcBatchSize samples at a time, or when they reach their budget:
+# mcSamples for J and K and mcPotentialSamples for each point of the potentials
+# mcTolerance follows the SCF (see the end of the SCF loop): it starts at mcInitialTolerance and is then
+# mcToleranceFactor times the last change of E0, but never below mcFinalTolerance, so the first
+# iterations cost little and the last ones get the accuracy asked for
+mcSamples = 262144
+mcPotentialSamples = 20000
+mcBatchSize = 4096
+# if mcCommonSamples is True, the MC potentials use the same samples for all the grid points (getPotentialMCAllPoints),
+# so they are smooth from point to point and mcPotentialSamples is the budget for the whole grid, evaluated in
+# blocks of at most mcGridElements samples x points; otherwise each point has its own mcPotentialSamples
+mcCommonSamples = True
+mcGridElements = 2000000
+mcInitialTolerance = 1e-3
+mcFinalTolerance = 1e-6
+mcToleranceFactor = 0.1
+mcTolerance = mcInitialTolerance
+# the MC integrals run on mcWorkers processes (the blocks of samples of J and K, or the points of the potentials)
+# each integral has its own random streams (see montecarlo.randomStream), derived from mcSeed and from the
+# number of MC integrals done before it (nextMCKey), so a run with the same mcSeed gives the same results
+# whatever mcWorkers is; if mcSeed is None, it is drawn at the start of the run and printed, to repeat it
+mcWorkers = 1
+mcSeed = None
+if mcSeed is None:
+    mcSeed = np.random.randint(0, 2**31 - 1)
+mcIntegrals = 0
+
+# the key of the random streams of the next MC integral
+def nextMCKey():
+    global mcIntegrals
+    mcIntegrals += 1
+    return (mcIntegrals,)
+
+# discrete distribution of the grid points with probability proportional to q(r_i) w_i (w of radialQuadrature),
+# to sample r from the density q(r)
+# returns [P, cumulative P, S], with S = sum_i q(r_i) w_i, so that int q(r) f(r) dr = S E[f(r)]
+def getRadialDistribution(q):
+    qw = q*radialQuadrature.w
+    S = np.sum(qw)
+    P = qw/S
+    return [P, np.cumsum(P), S]
+
+# indices of the grid points sampled from the distribution with the cumulative cdf, for u uniform in [0, 1)
+def sampleGridPoints(cdf, u):
+    return np.clip(np.searchsorted(cdf, u*cdf[-1], side = 'right'), 0, len(cdf)-1)
+
+# directions uniform on the sphere (cos t uniform in [-1, 1] and p in [0, 2 pi)) for u1, u2 uniform in [0, 1)
+# returns [t, p]
+def sampleDirections(u1, u2):
+    return [np.arccos(1 - 2*u1), 2*np.pi*u2]
+
+# |r1 - r2| for r1 = (ra, ta, pa) and r2 = (rb, tb, pb)
+def getDistance(ra, ta, pa, rb, tb, pb):
+    cos12 = np.cos(ta)*np.cos(tb) + np.sin(ta)*np.sin(tb)*np.cos(pa - pb)
+    return np.sqrt(np.maximum(ra**2 + rb**2 - 2*ra*rb*cos12, 0))
+
+# sum_i sum_j a1_i a2_j/max(r_i, r_j), the mean of a1(r1) a2(r2)/|r1 - r2| over the directions of r1 and r2,
+# with two cumulative sums (as in poisson.py)
+def getSWaveMean(r, a1, a2):
+    inner = np.cumsum(a2)
+    outer = np.zeros(len(r))
+    outer[:-1] = np.cumsum((a2/r)[:0:-1])[::-1]
+    return np.sum(a1*(inner/r + outer))
+
+# integrate the integrand of J or K over [0, 1)^6 with the settings above, to an error of mcTolerance
+# if controlMean is given, the integrand returns [g, h], with the control variate h of mean controlMean
+# returns [scale times the integral, its variance]
+def integrateMC(integrand, controlMean = None, scale = 1.0):
+    if controlMean is not None and not mcControlVariate:
+        integrandGH = integrand
+        integrand = lambda u: integrandGH(u)[0]
+        controlMean = None
+    acc = montecarlo.integrate(integrand, 6, mcSamples, blockSize = mcBatchSize, sequence = mcSequence, replicas = mcReplicas,
+                               controlMean = controlMean, tolerance = mcTolerance/scale,
+                               seed = mcSeed, key = nextMCKey(), workers = mcWorkers)
+    print "    %d MC samples, error %.3g (tolerance %.3g)" % (acc.samples, scale*acc.error(), mcTolerance)
+    return [scale*acc.mean, scale**2*acc.varianceOfMean()]
+
+# the integrands are evaluated for blocks of samples at once (see montecarlo.py)
+# with importance sampling, r1 and r2 come from |rpsi1|^2 r^2 and |rpsi2|^2 r^2, so that
+# J = S1 S2 (4 pi)^2 E[Yl1m1(O1)^2 Yl2m2(O2)^2/|r1 - r2|]
+# returns [J, variance of J]
 def getJMC(r, phiList, iOrb, jOrb):
-    J = 0
-    J2 = 0
     print "Using MC integration to calculate J %s,%s" % (iOrb, jOrb)
-    Ntot = int(400000)
-    for N in range(0, Ntot):
-        x1 = np.pi*0.5*random.random()
-        r1 = np.tan(x1)
-        z1 = int((np.log(r1) - xmin)/dx)
-        if z1 > len(r)-1:
-            z1 = len(r)-1
-        # r = tan(x) => dr/dx = sec^2(x)
-        # int f(x) dr = int f(x) dr/dx dx
-        x2 = np.pi*0.5*random.random()
-        r2 = np.tan(x2)
-        z2 = int((np.log(r2) - xmin)/dx)
-        if z2 > len(r)-1:
-            z2 = len(r)-1
-        t1 = random.random()*np.pi
-        t2 = random.random()*np.pi
-        p1 = random.random()*2*np.pi
-        p2 = random.random()*2*np.pi
-        Jn = (np.pi*2)**2*(np.pi)**2*(np.pi*0.5*1.0/(np.cos(x1)**2))*(np.pi*0.5*1.0/(np.cos(x2)**2))*getIntegrandJ(r, z1, t1, p1, z2, t2, p2, phiList[iOrb], phiList[jOrb])
-        J += Jn
-        J2 += Jn**2
-    J = J/float(Ntot)
-    dJ = (J2/float(Ntot-1) - J**2)/float(Ntot)
-    return [J, dJ]
+    phi1 = phiList[iOrb]
+    phi2 = phiList[jOrb]
+    if not mcImportance:
+        def integrand(u):
+            [z1, t1, p1, z2, t2, p2, volume] = getMCCoordinates(r, u)
+            return volume*getIntegrandJ(r, z1, t1, p1, z2, t2, p2, phi1, phi2)
+        return integrateMC(integrand)
+    [P1, cdf1, S1] = getRadialDistribution(phi1.rpsi**2*r**2)
+    [P2, cdf2, S2] = getRadialDistribution(phi2.rpsi**2*r**2)
+    def integrand(u):
+        z1 = sampleGridPoints(cdf1, u[:, 0])
+        z2 = sampleGridPoints(cdf2, u[:, 1])
+        [t1, p1] = sampleDirections(u[:, 2], u[:, 4])
+        [t2, p2] = sampleDirections(u[:, 3], u[:, 5])
+        h = 1.0/getDistance(r[z1], t1, p1, r[z2], t2, p2)
+        g = (4*np.pi)**2*Y(phi1.l, phi1.m, t1, p1)**2*Y(phi2.l, phi2.m, t2, p2)**2*h
+        return [g, h]
+    return integrateMC(integrand, getSWaveMean(r, P1, P2), S1*S2)
 
 # calculate int rpsi1(r1)*Yl1m1(t1, p1)*rpsi1(r2)*Yl1m1(t2, p2)*rpsi2(r2)*Yl2m2(t2, p2)*rpsi2(r1)*Yl2m2(t1, p1)/|r1-r2| r1^2 sin t1 r2^2 sin t2 dt1 dp1 dr1 dt2 dp2 dr2
 def getIntegrandK(r, z1, t1, p1, z2, t2, p2, phi1, phi2):
     return (phi1.rpsi[z1]*Y(phi1.l, phi1.m, t1, p1))*(phi1.rpsi[z2]*Y(phi1.l, phi1.m, t2, p2))*(phi2.rpsi[z2]*Y(phi2.l, phi2.m, t2, p2))*(phi2.rpsi[z1]*Y(phi2.l, phi2.m, t1, p1))*(r[z1]**2*np.sin(t1))*(r[z2]**2*np.sin(t2))/np.sqrt((r[z1]*np.sin(t1)*np.cos(p1) - r[z2]*np.sin(t2)*np.cos(p2))**2 + (r[z1]*np.sin(t1)*np.sin(p1) - r[z2]*np.sin(t2)*np.sin(p2))**2 + (r[z1]*np.cos(t1) - r[z2]*np.cos(t2))**2)
 
+# with importance sampling, r1 and r2 come from |rpsi1 rpsi2| r^2, so that, with f the sign of rpsi1 rpsi2,
+# K = S^2 (4 pi)^2 E[f(r1) f(r2) Yl1m1(O1) Yl2m2(O1) Yl1m1(O2) Yl2m2(O2)/|r1 - r2|]
+# returns [K, variance of K]
 def getKMC(r, phiList, iOrb, jOrb):
-    K = 0
-    K2 = 0
     print "Using MC integration to calculate K %s,%s" % (iOrb, jOrb)
-    Ntot = int(400000)
-    for N in range(0, Ntot):
-        x1 = np.pi*0.5*random.random()
-        r1 = np.tan(x1)
-        z1 = int((np.log(r1) - xmin)/dx)
-        if z1 > len(r)-1:
-            z1 = len(r)-1
-        # r = tan(x) => dr/dx = sec^2(x)
-        # int f(x) dr = int f(x) dr/dx dx
-        x2 = np.pi*0.5*random.random()
-        r2 = np.tan(x2)
-        z2 = int((np.log(r2) - xmin)/dx)
-        if z2 > len(r)-1:
-            z2 = len(r)-1
-        t1 = random.random()*np.pi
-        t2 = random.random()*np.pi
-        p1 = random.random()*2*np.pi
-        p2 = random.random()*2*np.pi
-        Kn = (np.pi*2)**2*(np.pi)**2*(np.pi*0.5*1.0/(np.cos(x1)**2))*(np.pi*0.5*1.0/(np.cos(x2)**2))*getIntegrandK(r, z1, t1, p1, z2, t2, p2, phiList[iOrb], phiList[jOrb])
-        K += Kn
-        K2 += Kn**2
-    K = K/float(Ntot)
-    dK = (K2/float(Ntot-1) - K**2)/float(Ntot)
-    return [K, dK]
+    phi1 = phiList[iOrb]
+    phi2 = phiList[jOrb]
+    if not mcImportance:
+        def integrand(u):
+            [z1, t1, p1, z2, t2, p2, volume] = getMCCoordinates(r, u)
+            return volume*getIntegrandK(r, z1, t1, p1, z2, t2, p2, phi1, phi2)
+        return integrateMC(integrand)
+    [P, cdf, S] = getRadialDistribution(np.abs(phi1.rpsi*phi2.rpsi)*r**2)
+    f = np.sign(phi1.rpsi*phi2.rpsi)
+    def integrand(u):
+        z1 = sampleGridPoints(cdf, u[:, 0])
+        z2 = sampleGridPoints(cdf, u[:, 1])
+        [t1, p1] = sampleDirections(u[:, 2], u[:, 4])
+        [t2, p2] = sampleDirections(u[:, 3], u[:, 5])
+        h = f[z1]*f[z2]/getDistance(r[z1], t1, p1, r[z2], t2, p2)
+        g = (4*np.pi)**2*Y(phi1.l, phi1.m, t1, p1)*Y(phi2.l, phi2.m, t1, p1)*Y(phi1.l, phi1.m, t2, p2)*Y(phi2.l, phi2.m, t2, p2)*h
+        return [g, h]
+    return integrateMC(integrand, getSWaveMean(r, P*f, P*f), S**2)
+
+# J and K of two orbitals a and b with the multipole expansion of 1/|r1 - r2| (deterministic, any l):
+# J(a, b) = sum_k 4 pi/(2k+1) sum_q <a a kq> <b b kq> F^k(a, b)
+# K(a, b) = sum_k 4 pi/(2k+1) sum_q <a b kq>^2 G^k(a, b)
+# with the Gaunt coefficients of the real harmonics <a b kq> = int Ylama Ylbmb Ykq dO (see angular.py) and
+# the radial (Slater) integrals, from the multipoles beta_k of radialPoisson and the quadrature of radialQuadrature,
+# F^k(a, b) = int rpsi_a^2 beta_k[rpsi_b^2] r^2 dr
+# G^k(a, b) = int rpsi_a rpsi_b beta_k[rpsi_a rpsi_b] r^2 dr
+# each costs O(N kmax)
+
+# angular factors 4 pi/(2k+1) sum_q <l1 m1 l2 m2 kq> <l3 m3 l4 m4 kq> for k = 0 ... kmax
+def getMultipoleCoefficients(l1, m1, l2, m2, l3, m3, l4, m4):
+    kmax = min(l1 + l2, l3 + l4)
+    c = np.zeros(kmax+1)
+    for k in range(0, kmax+1):
+        for q in range(-k, k+1):
+            c[k] += couplingTable.realGaunt(l1, m1, l2, m2, k, q)*couplingTable.realGaunt(l3, m3, l4, m4, k, q)
+        c[k] *= 4*np.pi/(2*k+1)
+    return c
+
+def getJAna(r, phiList, iOrb, jOrb):
+    a = phiList[iOrb]
+    b = phiList[jOrb]
+    c = getMultipoleCoefficients(a.l, a.m, a.l, a.m, b.l, b.m, b.l, b.m)
+    beta = radialPoisson.multipoles(b.rpsi**2, len(c)-1)
+    return np.sum([c[k]*radialQuadrature.integrate(a.rpsi**2*beta[k]*r**2) for k in range(0, len(c)) if c[k] != 0])
+
+def getKAna(r, phiList, iOrb, jOrb):
+    a = phiList[iOrb]
+    b = phiList[jOrb]
+    c = getMultipoleCoefficients(a.l, a.m, b.l, b.m, a.l, a.m, b.l, b.m)
+    rho = a.rpsi*b.rpsi
+    beta = radialPoisson.multipoles(rho, len(c)-1)
+    return np.sum([c[k]*radialQuadrature.integrate(rho*beta[k]*r**2) for k in range(0, len(c)) if c[k] != 0])
 
 def calculateE0(r, listPhi, vd, vxc):
     E0 = 0
@@ -567,41 +524,43 @@ def calculateE0(r, listPhi, vd, vxc):
         if listPhi[iOrb].virtual:
             continue
 
-        E0 += listPhi[iOrb].E
-        sumEV += listPhi[iOrb].E
+        # each orbital counts once per electron in it (occ), and vxc already includes exchangeWeight
+        occ = listPhi[iOrb].occ
+        E0 += occ*listPhi[iOrb].E
+        sumEV += occ*listPhi[iOrb].E
         # for the s orbitals, we can factor out the spherical harms.
         if listPhi[iOrb].l == 0:
-            for z in range(0, len(r)):
-                dr = 0
-                if z < len(r)-1:
-                    dr = r[z+1] - r[z]
-                # should have 4*pi*Y^2, but for s orbitals Y^2 = 1/4pi and int dOmega = 4 pi
-                J += (vd[z]*listPhi[iOrb].rpsi[z]**2)*(r[z]**2)*dr
+            # should have 4*pi*Y^2, but for s orbitals Y^2 = 1/4pi and int dOmega = 4 pi
+            J += occ*radialQuadrature.integrate((vd*listPhi[iOrb].rpsi**2)*(r**2))
 
-        # for p, d, etc integrate J and K with MC
+        # for p, d, etc get J and K from the multipole expansion (or integrate them with MC if useMCEnergy is True)
+        # the virtual orbitals have no electrons
         for jOrb in listPhi.keys():
+            if listPhi[jOrb].virtual:
+                continue
             if listPhi[iOrb].l != 0: # done above for s orbitals
-                [Jn, dJn] = getJMC(r, listPhi, iOrb, jOrb)
-                J += Jn
-                dE0 += dJn**2
+                if useMCEnergy:
+                    [Jn, dJn] = getJMC(r, listPhi, iOrb, jOrb)
+                else:
+                    [Jn, dJn] = [getJAna(r, listPhi, iOrb, jOrb), 0]
+                J += occ*listPhi[jOrb].occ*Jn
+                dE0 += (occ*listPhi[jOrb].occ)**2*dJn
 
             if ('+' in jOrb and '-' in iOrb) or ('-' in jOrb and '+' in iOrb):
                 continue
 
             if listPhi[iOrb].l == 0 and listPhi[jOrb].l == 0:
-                Hex = 0
-                for z in range(0, len(r)):
-                    dr = 0
-                    if z < len(r)-1:
-                        dr = r[z+1] - r[z]
-                    # should have 4*pi*Y^2, but for s orbitals Y^2 = 1/4pi and int dOmega = 4 pi
-                    K += vxc[iOrb][jOrb][z]*listPhi[iOrb].rpsi[z]*listPhi[jOrb].rpsi[z]*(r[z]**2)*dr
+                # should have 4*pi*Y^2, but for s orbitals Y^2 = 1/4pi and int dOmega = 4 pi
+                K += occ*radialQuadrature.integrate(vxc[phiToInt[iOrb], phiToInt[jOrb]]*listPhi[iOrb].rpsi*listPhi[jOrb].rpsi*(r**2))
             else:
-                [Kn, dKn] = getKMC(r, listPhi, iOrb, jOrb)
-                K += Kn
-                dE0 += dKn**2
+                if useMCEnergy:
+                    [Kn, dKn] = getKMC(r, listPhi, iOrb, jOrb)
+                else:
+                    [Kn, dKn] = [getKAna(r, listPhi, iOrb, jOrb), 0]
+                K += occ*exchangeWeight(listPhi, jOrb)*Kn
+                dE0 += (occ*exchangeWeight(listPhi, jOrb))**2*dKn
     E0 += -0.5*(J - K)
-    dE0 = np.sqrt(dE0)
+    dE0 = 0.5*np.sqrt(dE0)
     return [E0, sumEV, J, K, dE0]
 
 
@@ -625,11 +584,13 @@ def calculateE0(r, listPhi, vd, vxc):
 #
 # T2 = 1.0/(4*np.pi) int Ylm dOb
 #
+# the contribution of each orbital is kept in hartreeCache, and only calculated again if its density changed
 def getPotentialHAna(r, phiList):
-    totalVd = np.zeros(len(r), dtype=np.float64)
     for iOrb in phiList.keys():
         if phiList[iOrb].virtual:
             continue
+        if not hartreeCache.changed(iOrb, phiList[iOrb].rpsi**2):
+            continue
         Vd = np.zeros(len(r), dtype=np.float64)
         l1 = phiList[iOrb].l
         m1 = phiList[iOrb].m
@@ -642,61 +603,32 @@ def getPotentialHAna(r, phiList):
         for yOrb in phiList.keys():
             if phiList[yOrb].n == n1 and phiList[yOrb].l == l1:
                 nThisOrb += 1
+        # beta_l(r2) = int_r1 rpsi^2(r1) r<^l/r>^(l+1) r1^2 dr1 for every r2 and l at once (see poisson.py)
         if nThisOrb == 2*l1+1: # filled orbital, can calculate it exactly
             nMTot = 2*l1+1
-            for z in range(0, len(r)):
-                r2 = r[z]
-                beta = 0
-                # integrate in r1 with r2 fixed
-                for y in range(0, len(r)):
-                    r1 = r[y]
-                    dr = 0
-                    if y >= 1:
-                        dr = r[y] - r[y-1]
-                    else:
-                        dr = r[y]
-                    rs = r1
-                    rb = r2
-                    if rb < rs:
-                        rs = r2
-                        rb = r1
-                    beta += 1.0/float(nMTot)*(2*l1+1)*phiList[iOrb].rpsi[y]**2/rb*(r1**2)*dr
-                Vd[z] += beta
+            beta = radialPoisson.multipoles(phiList[iOrb].rpsi**2, 0)
+            Vd += 1.0/float(nMTot)*(2*l1+1)*beta[0]
         else: # not filled orbital, we can take an average over angles
             lmax = 2
+            beta = radialPoisson.multipoles(phiList[iOrb].rpsi**2, lmax)
             for l in range(0, lmax+1):
-                for z in range(0, len(r)):
-                    r2 = r[z]
-                    beta = 0
-                    # integrate in r1 with r2 fixed
-                    for y in range(0, len(r)):
-                        r1 = r[y]
-                        dr = 0
-                        if y >= 1:
-                            dr = r[y] - r[y-1]
-                        else:
-                            dr = r[y]
-                        rs = r1
-                        rb = r2
-                        if rb < rs:
-                            rs = r2
-                            rb = r1
-                        beta += 4*np.pi/(2*l+1)*phiList[iOrb].rpsi[y]**2*rs**l/(rb**(l+1))*(r1**2)*dr
-                    T = 0
-                    for m in range(-l, l+1):
-                        # T1 = int Y*l1m1 Yl1m1 Y*lm = (-1)**m int Y*l1m1 Yl1m1 Yl(-m)
-                        # T1 = (-1)**m*(-1)**m int Yl1(-m1) Yl1m1 Yl(-m)
-                        # T1 = (-1)**m*(-1)**m*(-1)**m*np.sqrt((2*l1+1)*(2*l1+1)/(4*np.pi*(2*l+1)))*CG(l1,l1,0,0,l,0)*CG(l1,l1,-m1,m1,l,-(-m))
-                        T1 = (-1)**(m1)*np.sqrt((2*l1+1)*(2*l1+1)/(4*np.pi*(2*l+1)))*CG(l1, l1, 0, 0, l, 0)*CG(l1, l1, -m1, m1, l, -(-m))
-                        # just average effect in angles of Ylm by itself
-                        # average of Ylm is zero except for l = m = 0
-                        T2 = 0
-                        if l == 0 and m == 0:
-                            T2 = 1.0/np.sqrt(4*np.pi)
-                        T += T1*T2
-                    Vd[z] += beta*T
-        totalVd += Vd
-    return totalVd
+                T = 0
+                for m in range(-l, l+1):
+                    # T1 = int Y*l1m1 Yl1m1 Y*lm = (-1)**m int Y*l1m1 Yl1m1 Yl(-m)
+                    # T1 = (-1)**m*(-1)**m int Yl1(-m1) Yl1m1 Yl(-m)
+                    # T1 = (-1)**m*(-1)**m*(-1)**m*np.sqrt((2*l1+1)*(2*l1+1)/(4*np.pi*(2*l+1)))*CG(l1,l1,0,0,l,0)*CG(l1,l1,-m1,m1,l,-(-m))
+                    T1 = (-1)**(m1)*np.sqrt((2*l1+1)*(2*l1+1)/(4*np.pi*(2*l+1)))*couplingTable.clebschGordan(l1, l1, 0, 0, l, 0)*couplingTable.clebschGordan(l1, l1, -m1, m1, l, -(-m))
+                    # just average effect in angles of Ylm by itself
+                    # average of Ylm is zero except for l = m = 0
+                    T2 = 0
+                    if l == 0 and m == 0:
+                        T2 = 1.0/np.sqrt(4*np.pi)
+                    T += T1*T2
+                Vd += 4*np.pi/(2*l+1)*beta[l]*T
+        hartreeCache.store(iOrb, phiList[iOrb].rpsi**2, phiList[iOrb].occ*Vd)
+    if hartreeCache.total is None:
+        return np.zeros(len(r), dtype=np.float64)
+    return np.array(hartreeCache.total, copy = True)
 
 
 ## potential calculation
@@ -719,84 +651,71 @@ def getPotentialHAna(r, phiList):
 #
 # T2 = 1.0/(4*np.pi) int Ylm
 #
-def getPotentialXAna(r, phiList, iOrb):
-    totalVx = {}
-    for jOrb in phiList.keys():
-        if phiList[jOrb].virtual:
-            continue
-
-        if ('+' in jOrb and '-' in iOrb) or ('-' in jOrb and '+' in iOrb):
-              continue
-        totalVx[jOrb] = np.zeros(len(r), dtype=np.float64)
-        Vex = np.zeros(len(r), dtype=np.float64)
-        #lx = phiList[jOrb].l
-        #mx = phiList[jOrb].m
-        l1 = phiList[iOrb].l
-        m1 = phiList[iOrb].m
-        n1 = phiList[iOrb].n
-        l2 = phiList[jOrb].l
-        m2 = phiList[jOrb].m
-        n2 = phiList[jOrb].n
-
-        nThisOrb = 0
-        for yOrb in phiList.keys():
-            if phiList[yOrb].n == n2 and phiList[yOrb].l == l2:
-                nThisOrb += 1
-        if nThisOrb == 2*l2+1: # filled orbital, can calculate it exactly
-            nMTot = 2*l2+1
-
-            for z in range(0, len(r)):
-                r2 = r[z]
-                for l in range(abs(l1-l2), l1+l2+1):
-                    beta = 0
-                    # integrate in r1 with r2 fixed
-                    for y in range(0, len(r)):
-                        r1 = r[y]
-                        dr = 0
-                        if y >= 1:
-                            dr = r[y] - r[y-1]
-                        else:
-                            dr = r[y]
-                        rs = r1
-                        rb = r2
-                        if rb < rs:
-                            rs = r2
-                            rb = r1
-                        beta += phiList[iOrb].rpsi[y]*phiList[jOrb].rpsi[y]*(rs**l)/(rb**(l+1))*r1**2*dr
-                    Vex[z] += 1.0/float(nMTot)*(2*l2+1)/(2*l+1)*CG(l1, l2, 0, 0, l, 0)**2*beta
-        else:
-            lmax = 2
-            for l in range(0, lmax+1):
-                for z in range(0, len(r)):
-                    r2 = r[z]
-                    beta = 0
-                    # integrate in r1 with r2 fixed
-                    for y in range(0, len(r)):
-                        r1 = r[y]
-                        dr = 0
-                        if y >= 1:
-                            dr = r[y] - r[y-1]
-                        else:
-                            dr = r[y]
-                        rs = r1
-                        rb = r2
-                        if rb < rs:
-                            rs = r2
-                            rb = r1
-                        beta += 4*np.pi/(2*l+1)*phiList[iOrb].rpsi[y]*phiList[jOrb].rpsi[y]*rs**l/(rb**(l+1))*(r1**2)*dr
-                    T = 0
-                    for m in range(-l, l+1):
-                        # T1 = int Y*l1m1 Yl2m2 Y*lm = (-1)**m int Y*l1m1 Yl2m2 Yl(-m)
-                        # T1 = (-1)**m*(-1)**m int Yl1(-m1) Yl2m2 Yl(-m)
-                        # T1 = (-1)**m*(-1)**m*(-1)**m*np.sqrt((2*l1+1)*(2*l2+1)/(4*np.pi*(2*l+1)))*CG(l1,l2,0,0,l,0)*CG(l1,l2,-m1,m2,l,-(-m))
-                        T1 = (-1)**(m1)*np.sqrt((2*l1+1)*(2*l2+1)/(4*np.pi*(2*l+1)))*CG(l1, l2, 0, 0, l, 0)*CG(l1, l2, -m1, m2, l, -(-m))
-                        # just average effect in angles of Ylm by itself
-                        T2 = 0
-                        if l == 0 and m == 0:
-                            T2 = 1.0/np.sqrt(4*np.pi)
-                        T += T1*T2
-                    Vex[z] += beta*T
-        totalVx[jOrb] += Vex
+# coefficients c_l of the exchange potential of jOrb in the equation of iOrb, Vex = sum_l c_l beta(rb, l)
+def getExchangeCoefficients(phiList, iOrb, jOrb):
+    l1 = phiList[iOrb].l
+    m1 = phiList[iOrb].m
+    n1 = phiList[iOrb].n
+    l2 = phiList[jOrb].l
+    m2 = phiList[jOrb].m
+    n2 = phiList[jOrb].n
+
+    nThisOrb = 0
+    for yOrb in phiList.keys():
+        if phiList[yOrb].n == n2 and phiList[yOrb].l == l2:
+            nThisOrb += 1
+    if nThisOrb == 2*l2+1: # filled orbital, can calculate it exactly
+        nMTot = 2*l2+1
+        c = np.zeros(l1+l2+1)
+        for l in range(abs(l1-l2), l1+l2+1):
+            c[l] = 1.0/float(nMTot)*(2*l2+1)/(2*l+1)*couplingTable.clebschGordan(l1, l2, 0, 0, l, 0)**2
+    else:
+        lmax = 2
+        c = np.zeros(lmax+1)
+        for l in range(0, lmax+1):
+            T = 0
+            for m in range(-l, l+1):
+                # T1 = int Y*l1m1 Yl2m2 Y*lm = (-1)**m int Y*l1m1 Yl2m2 Yl(-m)
+                # T1 = (-1)**m*(-1)**m int Yl1(-m1) Yl2m2 Yl(-m)
+                # T1 = (-1)**m*(-1)**m*(-1)**m*np.sqrt((2*l1+1)*(2*l2+1)/(4*np.pi*(2*l+1)))*CG(l1,l2,0,0,l,0)*CG(l1,l2,-m1,m2,l,-(-m))
+                T1 = (-1)**(m1)*np.sqrt((2*l1+1)*(2*l2+1)/(4*np.pi*(2*l+1)))*couplingTable.clebschGordan(l1, l2, 0, 0, l, 0)*couplingTable.clebschGordan(l1, l2, -m1, m2, l, -(-m))
+                # just average effect in angles of Ylm by itself
+                T2 = 0
+                if l == 0 and m == 0:
+                    T2 = 1.0/np.sqrt(4*np.pi)
+                T += T1*T2
+            c[l] = 4*np.pi/(2*l+1)*T
+    return c
+
+# returns vxc (see getExchangeMask)
+# beta(rb, l) of rpsi_i rpsi_j is the same for vxc[i, j] and vxc[j, i], so it is calculated once
+# per pair, for all the pairs at once (see poisson.py), and only the coefficients differ
+def getPotentialXAna(r, phiList):
+    mask = getExchangeMask(phiList)
+    totalVx = np.zeros((len(phiList), len(phiList), len(r)), dtype=np.float64)
+    pairs = getExchangePairs(mask)
+    if len(pairs) == 0:
+        return totalVx
+    rho = []
+    coeff = []
+    for [i, j] in pairs:
+        iOrb = intToPhi[i]
+        jOrb = intToPhi[j]
+        rho.append(phiList[iOrb].rpsi*phiList[jOrb].rpsi)
+        coeff.append([getExchangeCoefficients(phiList, iOrb, jOrb), getExchangeCoefficients(phiList, jOrb, iOrb)])
+    # beta_l(r2) = int_r1 rpsi1(r1) rpsi2(r1) r<^l/r>^(l+1) r1^2 dr1 for every pair, r2 and l at once
+    lmax = max([max(len(cij), len(cji)) for [cij, cji] in coeff]) - 1
+    beta = radialPoisson.multipoles(np.array(rho), lmax)
+    for k in range(0, len(pairs)):
+        [i, j] = pairs[k]
+        for [a, b, c] in [[i, j, coeff[k][0]], [j, i, coeff[k][1]]]:
+            if not mask[a, b]:
+                continue
+            Vex = np.zeros(len(r), dtype=np.float64)
+            for l in range(0, len(c)):
+                if c[l] != 0:
+                    Vex += c[l]*beta[l, k]
+            totalVx[a, b] = exchangeWeight(phiList, intToPhi[b])*Vex
     return totalVx
 
 def getLinSyst(listPhi, r, pot, vd, vxc):
@@ -823,6 +742,7 @@ def getLinSyst(listPhi, r, pot, vd, vxc):
         F0 = np.zeros(N, dtype=np.float64)
         #J = np.zeros((N, N), dtype=np.float64)
         J = scipy.sparse.lil_matrix((N, N), dtype=np.float64)
+        mask = getExchangeMask(listPhi)
         for iOrb in sorted(listPhi.keys()):
             nOrb = phiToInt[iOrb]
             l = listPhi[iOrb].l
@@ -832,57 +752,63 @@ def getLinSyst(listPhi, r, pot, vd, vxc):
             # calculate the extra term as \sum_j psi_j Vx_j
             # these are the linear terms due to the remainder of the potentials
             pot_full_effective = pot + vd # this multiplies the current phi[iOrb]
-            if iOrb in vxc[iOrb]:
-                pot_full_effective -= vxc[iOrb][iOrb]
+            if mask[nOrb, nOrb]:
+                pot_full_effective -= vxc[nOrb, nOrb]
             potIndep = np.zeros(len(r), dtype = np.float64)
-            for jOrb in vxc[iOrb].keys():
-                if iOrb == jOrb:
+            for jOrb in listPhi.keys():
+                mOrb = phiToInt[jOrb]
+                if iOrb == jOrb or not mask[nOrb, mOrb]:
                     continue
-                potIndep += listPhi[jOrb].psi*vxc[iOrb][jOrb]
+                potIndep += listPhi[jOrb].psi*vxc[nOrb, mOrb]
+    
+            # f = 1 + a dx^2/12 for every point at once: the part of a that does not depend on E is computed
+            # once in the workspace (see shooting.py), and s_coeff = 2 m r^2 dx^2/12 is its h = df/dE
+            [w, c] = logGridCoefficients(r, pot_full_effective, l, m)
+            ws = NumerovWorkspace(w, c, dx)
+            fList = ws.setEnergy(E)[0][0].tolist()
+            sCoeffList = ws.h.tolist()
+            sList = (ws.h*potIndep).tolist()
     
             # (12 - 10 f_n) y_n - f_{n-1} y_{n-1} - f_{n+1} y_{n+1} + (s[i+1] + 10.0*s[i] + s[i-1]) = 0
             for ir in range(0, len(r)):
-                a = 2*m*r[ir]**2*(E-pot_full_effective[ir]) - (l+0.5)**2
-                f = 1 + a*dx**2/12.0
-                s_coeff = (dx**2)/12.0*2*m*r[ir]**2
-                s = (dx**2)/12.0*2*m*r[ir]**2*potIndep[ir]
+                f = fList[ir]
+                s_coeff = sCoeffList[ir]
+                s = sList[ir]
                 F0[nOrb*Nr+ir] += (12 - 10*f)*listPhi[iOrb].psi[ir] + 10.0*s
                 J[nOrb*Nr+ir, nOrb*Nr+ir] += (12 - 10*f)
-                J[nOrb*Nr + ir, idxE + nOrb] += -10*(2*m*r[ir]**2)*(dx**2/12.0)*listPhi[iOrb].psi[ir]
+                J[nOrb*Nr + ir, idxE + nOrb] += -10*s_coeff*listPhi[iOrb].psi[ir]
                 for jOrb in sorted(listPhi.keys()):
                     mOrb = phiToInt[jOrb]
                     if iOrb == jOrb:
                         continue
-                    if jOrb in vxc[iOrb]:
-                        J[nOrb*Nr+ir, mOrb*Nr+ir] += 10.0*s_coeff*vxc[iOrb][jOrb][ir]
+                    if mask[nOrb, mOrb]:
+                        J[nOrb*Nr+ir, mOrb*Nr+ir] += 10.0*s_coeff*vxc[nOrb, mOrb, ir]
                 if ir > 0:
-                    a = 2*m*r[ir-1]**2*(E-pot_full_effective[ir-1]) - (l+0.5)**2
-                    f = 1 + a*dx**2/12.0
-                    s = (dx**2)/12.0*2*m*r[ir-1]**2*potIndep[ir-1]
-                    s_coeff = (dx**2)/12.0*2*m*r[ir-1]**2
+                    f = fList[ir-1]
+                    s = sList[ir-1]
+                    s_coeff = sCoeffList[ir-1]
                     F0[nOrb*Nr+ir] += -f*listPhi[iOrb].psi[ir-1] + s
                     J[nOrb*Nr+ir, nOrb*Nr+ir-1] += -f
-                    J[nOrb*Nr + ir, idxE + nOrb] += -(2*m*r[ir-1]**2)*(dx**2/12.0)*listPhi[iOrb].psi[ir-1]
+                    J[nOrb*Nr + ir, idxE + nOrb] += -s_coeff*listPhi[iOrb].psi[ir-1]
                     for jOrb in sorted(listPhi.keys()):
                         mOrb = phiToInt[jOrb]
                         if iOrb == jOrb:
                             continue
-                        if jOrb in vxc[iOrb]:
-                            J[nOrb*Nr+ir, mOrb*Nr+ir-1] += s_coeff*vxc[iOrb][jOrb][ir-1]
+                        if mask[nOrb, mOrb]:
+                            J[nOrb*Nr+ir, mOrb*Nr+ir-1] += s_coeff*vxc[nOrb, mOrb, ir-1]
                 if ir < len(r)-1:
-                    a = 2*m*r[ir+1]**2*(E-pot_full_effective[ir+1]) - (l+0.5)**2
-                    f = 1 + a*dx**2/12.0
-                    s = (dx**2)/12.0*2*m*r[ir+1]**2*potIndep[ir+1]
-                    s_coeff = (dx**2)/12.0*2*m*r[ir+1]**2
+                    f = fList[ir+1]
+                    s = sList[ir+1]
+                    s_coeff = sCoeffList[ir+1]
                     F0[nOrb*Nr+ir] += -f*listPhi[iOrb].psi[ir+1] + s
                     J[nOrb*Nr+ir, nOrb*Nr+ir+1] += -f
-                    J[nOrb*Nr + ir, idxE + nOrb] += -(2*m*r[ir+1]**2)*(dx**2/12.0)*listPhi[iOrb].psi[ir+1]
+                    J[nOrb*Nr + ir, idxE + nOrb] += -s_coeff*listPhi[iOrb].psi[ir+1]
                     for jOrb in sorted(listPhi.keys()):
                         mOrb = phiToInt[jOrb]
                         if iOrb == jOrb:
                             continue
-                        if jOrb in vxc[iOrb]:
-                            J[nOrb*Nr+ir, mOrb*Nr+ir+1] += s_coeff*vxc[iOrb][jOrb][ir+1]
+                        if mask[nOrb, mOrb]:
+                            J[nOrb*Nr+ir, mOrb*Nr+ir+1] += s_coeff*vxc[nOrb, mOrb, ir+1]
 
         # (sum psi^2*r^2*dr = 1)
         for iOrb in listPhi:
@@ -890,19 +816,12 @@ def getLinSyst(listPhi, r, pot, vd, vxc):
             n = listPhi[iOrb].n
             nOrb = phiToInt[iOrb]
             E = listPhi[iOrb].E
-            for ir in range(0, len(r)):
-    	        dr = 0
-    	        if ir < len(r)-1:
-                    dr = r[ir+1] - r[ir]
-                F0[idxE + nOrb] += (listPhi[iOrb].psi[ir]*r[ir]**(-0.5))**2 * r[ir]**2 * dr
+            # (psi r^-0.5)^2 r^2 dr = psi^2 r dr, integrated with the quadrature of quadrature.py
+            F0[idxE + nOrb] += radialQuadrature.integrate(listPhi[iOrb].psi**2*r)
             F0[idxE + nOrb] += - 1.0
             F0[idxSE] += 0 # this is the lagrange multiplier eq.: lambda = sum E^2
             # n = int delta(psi(x)) |psi'(x)| dx = sum_roots int delta (x - x_i) |psi'(x)| / |psi'(x_i)| dx
-            for ir in range(0, len(r)):
-    	        dr = 0
-    	        if ir < len(r)-1:
-                    dr = r[ir+1] - r[ir]
-                J[idxE + nOrb, nOrb*Nr + ir] += 2*listPhi[iOrb].psi[ir]*dr*r[ir]
+            J[idxE + nOrb, nOrb*Nr:(nOrb+1)*Nr] = 2*listPhi[iOrb].psi*r*radialQuadrature.w
             J[idxSE, idxE + nOrb] += -2*E
         J[idxSE, idxSE] += 1 # this is a lagrange multiplier: lambda = sum E^2 -> lambda - sum E^2 = 0
         nF0 = 0
@@ -923,7 +842,8 @@ class phi:
     Emin = -99.0
     wait = 2
     virtual = False
-    def __init__(self, _n, _l, _m, _E, _virtual = False):
+    occ = 1 # number of electrons in this orbital (up to 2 in restricted mode)
+    def __init__(self, _n, _l, _m, _E, _virtual = False, _occ = 1):
         self.n = _n
         self.l = _l
         self.m = _m
@@ -932,22 +852,17 @@ class phi:
         self.Emin = -99.0
         self.wait = 2
         self.virtual = _virtual
+        self.occ = _occ
 
+    # r is the grid of radialQuadrature
     def toPsi(self, r, changeInPlace = False):
-        n = 0
-        for i in range(0, len(self.psi)):
-            self.rpsi[i] = self.psi[i]*r[i]**(-0.5) # undo y->R(r) transform
-	    ip = len(r)-1
-	    if i < len(r)-1:
-	        ip = i+1
-	    dr = np.fabs(r[ip]-r[i])
-            n += (r[i]*self.rpsi[i])**2*dr        # normalise it so that int |r R(r)|^2 dr == 1
+        self.rpsi[:] = self.psi*r**(-0.5) # undo y->R(r) transform
+        n = radialQuadrature.norm(self.rpsi)        # normalise it so that int |r R(r)|^2 dr == 1
         parity = 1
         if self.rpsi[0] < 0:
             parity = -1
         if n != 0:
-            for i in range(0, len(self.psi)):
-                self.rpsi[i] /= parity*np.sqrt(n)
+            self.rpsi /= parity*n
         if changeInPlace:
             self.psi = self.rpsi[:]
     def toFile(self, r, name, fname):
@@ -1019,20 +934,58 @@ Z = 5
 xmin = np.log(1e-4)
 dx = 1e-1/Z
 r = init(dx, Z*150, xmin)
+# radial Poisson solver on r for the Hartree and exchange potentials (see poisson.py):
+# the first order sums of Gauss' law, or Numerov's method (O(dx^4)) if useNumerovPoisson is True
+useNumerovPoisson = False
+if useNumerovPoisson:
+    radialPoisson = NumerovPoissonSolver(r)
+else:
+    radialPoisson = GaussLawSolver(r)
+# the radial integrals on r (normalisation and energy), see quadrature.py
+radialQuadrature = LogGridQuadrature(r)
+# direct potential of each orbital in getPotentialHAna, calculated again only when the relative change
+# of its density is larger than hartreeTolerance (see poisson.py)
+hartreeTolerance = 1e-8
+hartreeCache = HartreeCache(hartreeTolerance)
 
 useMC = False
+# the potentials of the p, d and f orbitals in useMC mode: angular quadrature on the sphere (getPotentialOnSphere,
+# with harmonics up to 2 lmaxOrbital and nodes exact for the products of three of them, see angular.SphereQuadrature),
+# or MC integration (getPotentialHMC and getPotentialXCMC) if useAngularQuadrature is False
+useAngularQuadrature = True
+lmaxOrbital = 3
+sphereQuadrature = angular.SphereQuadrature(2*lmaxOrbital, 4*lmaxOrbital)
+# Clebsch-Gordan and Gaunt coefficients of the potentials and of J and K, for all the couplings of two orbitals
+# (up to 2 lmaxOrbital), calculated once so that the inner loops only look them up (see angular.CouplingTable)
+couplingTable = angular.CouplingTable(2*lmaxOrbital)
+# J and K of the p, d, ... orbitals in the energy: from the multipole expansion with Gaunt coefficients
+# (getJAna and getKAna, exact up to the grid), or with MC (getJMC and getKMC) if useMCEnergy is True
+useMCEnergy = False
+
+# set this to true to solve each spatial orbital (n, l, m) once, with the number of electrons in it,
+# instead of one equation per spin orbital ('1s1+' and '1s1-' below)
+# the direct potential counts each orbital occ times and the exchange one occ/2 times (see exchangeWeight),
+# which is exact for the filled orbitals and halves the Newton system of getLinSyst
+# (here the single 2p electron is then averaged over the spin)
+restricted = False
 
 listPhi = {}
 # create objects to hold energy and wave functions of each Hartree-Fock equation
 # provide boundary conditions n, l in first arguments
 # provide initial energy to use when starting to look for solutions
 # propose to start with the Hydrogen-like (if Hydrogen had atomic number Z) energy level (0.5*Z^2/n^2)
-listPhi['1s1+'] = phi(1, 0, 0, -Z**2/(1.0**2)*0.5)
-listPhi['1s1-'] = phi(1, 0, 0, -Z**2/(1.0**2)*0.5)
-listPhi['2s1+'] = phi(2, 0, 0, -Z**2/(2.0**2)*0.5)
-listPhi['2s1-'] = phi(2, 0, 0, -Z**2/(2.0**2)*0.5)
-listPhi['2p1+'] = phi(2, 1, 0, -Z**2/(2.0**2)*0.5)
-listPhi['2p2+'] = phi(2, 1, 1, -Z**2/(2.0**2)*0.5, True)
+if restricted:
+    listPhi['1s1'] = phi(1, 0, 0, -Z**2/(1.0**2)*0.5, False, 2)
+    listPhi['2s1'] = phi(2, 0, 0, -Z**2/(2.0**2)*0.5, False, 2)
+    listPhi['2p1'] = phi(2, 1, 0, -Z**2/(2.0**2)*0.5, False, 1)
+    listPhi['2p2'] = phi(2, 1, 1, -Z**2/(2.0**2)*0.5, True)
+else:
+    listPhi['1s1+'] = phi(1, 0, 0, -Z**2/(1.0**2)*0.5)
+    listPhi['1s1-'] = phi(1, 0, 0, -Z**2/(1.0**2)*0.5)
+    listPhi['2s1+'] = phi(2, 0, 0, -Z**2/(2.0**2)*0.5)
+    listPhi['2s1-'] = phi(2, 0, 0, -Z**2/(2.0**2)*0.5)
+    listPhi['2p1+'] = phi(2, 1, 0, -Z**2/(2.0**2)*0.5)
+    listPhi['2p2+'] = phi(2, 1, 1, -Z**2/(2.0**2)*0.5, True)
 
 Nwait = 4*len(listPhi)
 
@@ -1057,12 +1010,13 @@ for iOrb in listPhi.keys():
 Nscf = 1000
 
 vd_last = {}
-vxc_last = {}
+vxc_last = None # exchange potentials vxc of the last iteration (see getExchangeMask)
 gamma_v = 0.5
 
 abortIt = False
 E0_old = 0
 E0 = 0
+print "Random seed of the MC integrals: mcSeed = %d" % mcSeed
 for iSCF in range(0, Nscf):
     print bcolors.HEADER + "On HF SCF iteration %d" % iSCF + bcolors.ENDC
 
@@ -1070,37 +1024,27 @@ for iSCF in range(0, Nscf):
         listPhi[iOrb].wait = 0
 
     if iSCF == 0:
-        vxc = {}
         vd = np.zeros(len(r), dtype = np.float64)
         vd_last = vd
-        for iOrb in sorted(listPhi.keys()):
-            nOrb = phiToInt[iOrb]
-            vxc[iOrb] = {}
-            vxc_last[iOrb] = {}
-            for jOrb in sorted(listPhi.keys()):
-                vxc[iOrb][jOrb] = np.zeros(len(r), dtype = np.float64)
-                vxc_last[iOrb][jOrb] = vxc[iOrb][jOrb]
+        vxc = np.zeros((len(listPhi), len(listPhi), len(r)), dtype = np.float64)
+        vxc_last = vxc
     else:
         gamma_v_eff = gamma_v # *np.exp(-iSCF/20.0)
         if iSCF >= 20:
             gamma_v_eff = gamma_v # *np.exp(-1.0)
-        vxc = {}
-        vxc_new = {}
         if useMC:
             vd_new = getPotentialH(r, listPhi)
         else:
             vd_new = getPotentialHAna(r, listPhi)
         vd = vd_last*(1-gamma_v_eff) + vd_new*(gamma_v_eff)
         vd_last = vd
-        for iOrb in sorted(listPhi.keys()):
-            if useMC:
-                vxc_new[iOrb] = getPotentialX(r, listPhi, iOrb)
-            else:
-                vxc_new[iOrb] = getPotentialXAna(r, listPhi, iOrb)
-            vxc[iOrb] = {}
-            for jOrb in vxc_new[iOrb]:
-                vxc[iOrb][jOrb] = vxc_last[iOrb][jOrb]*(1-gamma_v_eff) + vxc_new[iOrb][jOrb]*(gamma_v_eff)
-                vxc_last[iOrb][jOrb] = vxc[iOrb][jOrb]
+        if useMC:
+            vxc_new = getPotentialX(r, listPhi)
+        else:
+            vxc_new = getPotentialXAna(r, listPhi)
+        # all the pairs at once (vxc_new is zero where the exchange mask is False)
+        vxc = vxc_last*(1-gamma_v_eff) + vxc_new*(gamma_v_eff)
+        vxc_last = vxc
     np.set_printoptions(threshold=np.inf)
 
     # Newton iterations
@@ -1295,14 +1239,16 @@ for iSCF in range(0, Nscf):
         savePlotInFile('pseudo_potentials2.plt', r, plist, leg, 'r^2 R(r)^2', [ymin, ymax])
 
         # now save the potential shapes
+        mask = getExchangeMask(listPhi)
         for iOrb in listPhi.keys():
             leg = []
             plt.clf()
             c = 0
             ymin = pot[idxlow]
             l = [vd[0]]
-            for item in vxc[iOrb]:
-                l.append(vxc[iOrb][item][0])
+            exchanged = [item for item in sorted(listPhi.keys()) if mask[phiToInt[iOrb], phiToInt[item]]]
+            for item in exchanged:
+                l.append(vxc[phiToInt[iOrb], phiToInt[item], 0])
             ymax = 1.3*np.amax(l)
             vlist = []
             plt.plot(r[0:idx], pot[0:idx], col[c], label='Vnuc')
@@ -1313,9 +1259,9 @@ for iSCF in range(0, Nscf):
             vlist.append(vd)
             leg.append('Vd')
             c += 1
-            for item in vxc[iOrb]:
-                plt.plot(r[0:idx], vxc[iOrb][item][0:idx], col[c], label='Vxc wrt %s' % item)
-                vlist.append(vxc[iOrb][item])
+            for item in exchanged:
+                plt.plot(r[0:idx], vxc[phiToInt[iOrb], phiToInt[item], 0:idx], col[c], label='Vxc wrt %s' % item)
+                vlist.append(vxc[phiToInt[iOrb], phiToInt[item]])
                 leg.append('Vxc wrt %s' % item)
                 c += 1
             plt.legend(leg, frameon=False)
@@ -1342,6 +1288,9 @@ for iSCF in range(0, Nscf):
         break
     else:
         print bcolors.WARNING + "(SCF it. %d ends) E0 = %.14f eV +/- %.14f, dE0/E0 = %.14f. \sum e = %.14f eV. J = %.14f eV. K = %.14f eV." % (iSCF, E0*eV, dE0*eV, (1 - E0_old/E0), sumEV*eV, J*eV, K*eV) + '' + bcolors.ENDC
+    # tighten the tolerance of the MC integrals as the SCF converges
+    if iSCF > 0:
+        mcTolerance = max(mcFinalTolerance, mcToleranceFactor*np.fabs(E0 - E0_old))
     E0_old = E0
 
 for item in listPhi:
@@ -1349,7 +1298,9 @@ for item in listPhi:
 
 writePotential(r, pot, "nucleus", "nucleus", "all", "all", "pot_nuc.dat")
 writePotential(r, vd,  "vd",      "hartree", "all", "all", "pot_vd.dat")
-for item in vxc:
-    for acted in vxc[item]:
-        writePotential(r, vxc[item][acted],  "vxc", "exchange", item, acted, "pot_vxc_%s_%s.dat" % (item, acted))
+mask = getExchangeMask(listPhi)
+for item in listPhi:
+    for acted in listPhi:
+        if mask[phiToInt[item], phiToInt[acted]]:
+            writePotential(r, vxc[phiToInt[item], phiToInt[acted]],  "vxc", "exchange", item, acted, "pot_vxc_%s_%s.dat" % (item, acted))
 
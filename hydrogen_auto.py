@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
+from shooting import logGridCoefficients, shootBatch, bracketEnergies, shootRatiosBatch, ratiosToY, ratiosToBranches, decayRatio
+from shooting import NumerovWorkspace, wkbCutoff, wkbRatio, padToGrid
+from eigensolver import lowestLevels, sturmCount
+from rootfinder import findLevel
+from richardson import extrapolate, equivalentGridSizes
+from quadrature import LogGridQuadrature
 
 eV = 27.2113966413442 # Hartrees
 
@@ -20,65 +27,6 @@ def init(dx, N, xmin):
         r[i] = np.exp(xmin + i*dx)
     return r
 
-def F(i, f, y):
-    return (12 - 10*f[i])*y[i] - f[i-1]*y[i-1] - f[i+1]*y[i+1]
-
-def getAF(r, pot, E, l, dx, m):
-    icl = -1
-    a = np.zeros(len(r))
-    f = np.zeros(len(r))
-    for i in range(0, len(r)):
-        a[i] = 2*m*r[i]**2*(E - pot[i]) - (l+0.5)**2
-	f[i] = 1 + a[i]*dx**2/12.0
-	if icl < 0 and i >= 1 and a[i]*a[i-1] < 0:
-	    icl = i
-    return [a, f, icl]
-
-# only assuming tendency from Schr. eq.:
-# psi = r^l
-# psi -> r R(r) * angular part
-# xi = r^l/r
-# y = xi/sqrt(r)
-# y = r^l/r/sqrt(r)
-# generic approx. solution
-# from ignoring r^2 term in:
-# d^2y/dx^2 + [2mr^2(E-V) - (l+0.5)^2] y = 0
-# when r -> 0, x-> - infinity
-# -> d^2y/dx^2 = (l+0.5)^2 y
-# -> y = exp((l+0.5) x)   # notice that x -> -infinity means exp(x) converges not exp(-x)
-# -> y = exp((l+0.5) ln(Zr)) = (Zr)^(l+0.5)
-def outwardSolution(r, l, Z, f):
-    y = np.zeros(len(r))
-    no = 0
-    y[0] = ((Z*r[0])**(l+0.5))/n
-    y[1] = ((Z*r[1])**(l+0.5))/n
-    for i in range(1, len(r)-1):
-	y[i+1] = ((12 - f[i]*10)*y[i] - f[i-1]*y[i-1])/f[i+1]
-    for i in range(1, len(r)-1):
-	if y[i]*y[i+1] < 0:
-	    no += 1
-    return [y, no]
-
-def inwardSolution(r, l, Z, f, E):
-    yp = np.zeros(len(r))
-    nop = 0
-    m = 1
-    # for r->infinity, only d^2y/dx^2 + 2mEy = 0 terms contribute
-    # (remember E is negative)
-    # so approximate it at r->infinity as an exponential
-    yp[len(r)-1] = np.exp(-np.sqrt(-2*m*E)*r[len(r)-1])
-    yp[len(r)-2] = np.exp(-np.sqrt(-2*m*E)*r[len(r)-2])
-    for i in reversed(range(1, len(r)-1)):
-	yp[i-1] = ((12 - f[i]*10)*yp[i] - f[i+1]*yp[i+1])/f[i-1];
-	if yp[i-1] > 10:
-	  for j in reversed(range(i-1, len(r)-1)):
-	    yp[j] /= yp[i-1]
-
-    for i in reversed(range(1, len(r)-1)):
-	if yp[i-1]*yp[i] < 0:
-	    nop += 1
-    return [yp, nop]
-
 def matchInOut(y, yp, icl):
     # renormalise
     y_ren = np.zeros(len(y))
@@ -109,13 +57,35 @@ def matchInOut(y, yp, icl):
 # the eq. in terms of r, so it would be:
 # deriv(deriv(xi)) + 2 m / hbar^2 [ E - V - (hbar^2 l (l+1) ) / 2 m r^2 ] xi (r) = 0
 # in which case, a = 2 m / hbar^2 [ E - V - (hbar^2 l (l+1) ) / 2 m r^2 ] and dx is replaced by r(i) - r(i-1)
-def solve(r, dx, pot, n, l, E, Z):
+#
+# outward starting values, only assuming tendency from Schr. eq.:
+# psi = r^l
+# psi -> r R(r) * angular part
+# xi = r^l/r
+# y = xi/sqrt(r)
+# y = r^l/r/sqrt(r)
+# generic approx. solution
+# from ignoring r^2 term in:
+# d^2y/dx^2 + [2mr^2(E-V) - (l+0.5)^2] y = 0
+# when r -> 0, x-> - infinity
+# -> d^2y/dx^2 = (l+0.5)^2 y
+# -> y = exp((l+0.5) x)   # notice that x -> -infinity means exp(x) converges not exp(-x)
+# -> y = exp((l+0.5) ln(Zr)) = (Zr)^(l+0.5)
+# ws is the shooting.NumerovWorkspace of r, pot and l, kept between calls so that only the E term of f
+# is updated for each trial energy (a new one is made if it is not given)
+def solve(r, dx, pot, n, l, E, Z, ws = None):
     m = 1.0
-    icl = -1
-    [a, f, icl] = getAF(r, pot, E, l, dx, m)
-    
-    [y, no] = outwardSolution(r, l, Z, f)
-    [yp, nop] = inwardSolution(r, l, Z, f, E)
+    N = len(r)
+    if ws is None:
+        [w, c] = logGridCoefficients(r, pot, l, m)
+        ws = NumerovWorkspace(w, c, dx)
+    # outward starting values y = (Zr)^(l+0.5) (see above), and the inward solution starts from
+    # the WKB tail at the last point of r (see shooting.wkbRatio)
+    # z = dy/dE is propagated alongside y in the same pass (see shooting.py), to get dF/dE below
+    [yN2yN1, dyN2yN1] = wkbRatio(ws.w, ws.c, dx, E)
+    [Fb, dFb, no, nop, icl, y, yp, levels] = ws.shootDerivative(E, ((Z*r[0])**(l+0.5))/n, ((Z*r[1])**(l+0.5))/n,
+                                                                 1.0, yN2yN1, 0, 0, 0, dyN2yN1)
+    [y, yp, icl, no, nop, levels] = [y[0], yp[0], icl[0], no[0], nop[0], levels[0]]
     y_ren = matchInOut(y, yp, icl)
     # y_ren is continuous
     # y_ren was estimated outward until icl
@@ -134,42 +104,41 @@ def solve(r, dx, pot, n, l, E, Z):
     # for E_new, F(E_new) = 0
     # dE = E_new - E_current = - F(E_current)/(F'(E_current))
     # F(E_current) = (12 - 10 f_icl) y_icl - f_{icl-1} y_{icl-1} - f_{icl+1} y_{icl+1}
-    Ficl = F(icl, f, y_ren) # get F at icl
-    # calculate dF/dE, by varying E very slightly
-    dE = -0.1e-1
-    if dE == 0:
-      dE = -0.1e-1
-    # recalculate the solution with a slihtly varied E
-    [ap, fp, iclp] = getAF(r, pot, E+dE, l, dx, m)
-    [y_ep, no_ep] = outwardSolution(r, l, Z, fp)
-    [yp_ep, nop_ep] = inwardSolution(r, l, Z, fp, E)
-    y_ep_ren = matchInOut(y_ep, yp_ep, icl)
-    # new solution has a discontinuity at icl again
-    # dF/dE is defined as the difference over dE of the change in F
-    Fp = F(icl, fp, y_ep_ren)
-    print "F, Fp, dF ", Ficl, Fp, Fp - Ficl
-    if Fp != Ficl:
-        bestdE = -Ficl*dE/(Fp - Ficl)
-    else:
-        bestdE = dE
+    # F(icl) on y_ren and dF/dE, without solving again at a slightly varied E
+    Ficl = Fb[0]
+    dFdE = dFb[0]
+    print "F, dF/dE ", Ficl, dFdE
+    # with no matching point, F is NaN and findLevel bisects
+    return [y_ren, yp, icl, no, nop, Ficl, dFdE, levels]
+
+# same as solve, but propagating the ratios y_{i+1}/y_i (renormalized Numerov, see shooting.py)
+# nothing overflows, whatever the number of grid points
+# the scale-free mismatch at icl replaces F, and its derivative is propagated alongside the ratios
+def solveRatios(r, dx, pot, n, l, E, Z, ws = None):
+    m = 1.0
+    N = len(r)
+    if ws is None:
+        [w, c] = logGridCoefficients(r, pot, l, m)
+        ws = NumerovWorkspace(w, c, dx)
+    y1y0 = (r[1]/r[0])**(l+0.5)
+    [yN2yN1, dyN2yN1] = wkbRatio(ws.w, ws.c, dx, E)
+    [D, dD, no, nop, icl, R, Q, f, levels] = ws.shootRatiosDerivative(E, y1y0, yN2yN1, 0, dyN2yN1)
+    icl = icl[0]
     if icl < 0:
-        bestdE = 10 # arbitrary, but must be positive to make energy less negative
-    return [y_ren, yp, icl, no, nop, bestdE]
+        return [np.zeros(N), np.zeros(N), icl, no[0], nop[0], np.nan, np.nan, levels[0]]
+    print "D, dD/dE ", D[0], dD[0]
+    # the matched solution, and the inward one (from icl on, continuous with it at icl) for the plot
+    [y, yp] = ratiosToBranches(f[0], R[0], Q[0], icl)
+    y_ren = ratiosToY(f[0], R[0], Q[0], icl)
+    return [y_ren, yp, icl, no[0], nop[0], D[0], dD[0], levels[0]]
 
 
+# transform y back into R(r) on the grid x and normalise it (see quadrature.py)
 def toPsi(x, y):
-    n = 0
-    psi = np.zeros(len(y))
-    for i in range(0, len(y)):
-        psi[i] = y[i]*r[i]**(-0.5) # undo y->R(r) transform
-	ip = len(y)-1
-	if i < len(y)-1:
-	    ip = i+1
-	dr = np.fabs(r[ip]-r[i])
-        n += (r[i]*psi[i])**2*dr        # normalise it so that int |r R(r)|^2 dr == 1
+    psi = y*x**(-0.5) # undo y->R(r) transform
+    n = LogGridQuadrature(x).norm(psi)        # normalise it so that int |r R(r)|^2 dr == 1
     if n != 0:
-        for i in range(0, len(y)):
-            psi[i] /= np.sqrt(n)
+        psi /= n
     return psi
 
 def nodes(n, l):
@@ -182,54 +151,112 @@ E = -0.5
 Emax = -1e-3
 Emin = -20.0
 dx = 1e-3
-r = init(dx, 13000, np.log(1e-4))
+# propagate ratios of neighbouring points instead of y, so that long grids do not overflow
+useRatios = True
+# set this to a list of decreasing grid spacings (for instance [4e-3, 2e-3, 1e-3]) to find the level on grids
+# covering the same range of r as dx and Npoints below, and extrapolate the energy to dx = 0 (see richardson.py)
+richardsonDx = None
+Npoints = 13000
+r = init(dx, Npoints, np.log(1e-4))
 pot = V(r, Z)
-no = 0
-nop = 0
-for i in range(0,100):
-    [y, yp, icl, no, nop, bestdE] = solve(r, dx, pot, n, l, E, Z)
-    dE = 0
-    if no > nodes(n, l):
-	Emax = E-1e-15
-	dE = (Emax + Emin)*0.5 - E
-    elif no < nodes(n, l):
-	Emin = E+1e-15
-	dE = (Emax + Emin)*0.5 - E
+# set this to True to get the lowest Nlevels levels with this l at once from the
+# matrix form of Numerov's method, instead of shooting for level n
+solveAllLevels = False
+Nlevels = 4
+if solveAllLevels:
+    [w, c] = logGridCoefficients(r, pot, l)
+    # y ~ r^(l+0.5) before the first grid point
+    [Elevels, yLevels] = lowestLevels(w, c, dx, Nlevels, leftRatio = np.exp(-(l+0.5)*dx))
+    for k in range(0, Nlevels):
+        print "n = ", l+1+k, ", l = ", l, ": E = ", Elevels[k]*eV, " eV"
+    sys.exit(0)
+
+# bracket and find the level n, l on a grid with spacing dx and Npoints points, starting at E
+# returns the energy, the grid and the outward and inward solutions on it
+def findEnergy(dx, Npoints, E, Emin, Emax):
+    r = init(dx, Npoints, np.log(1e-4))
+    pot = V(r, Z)
+    # shoot a vector of trial energies at once and bracket the level with the outward node count
+    Escan = -np.logspace(np.log10(-Emin), np.log10(-Emax), 64)
+    [w, c] = logGridCoefficients(r, pot, l)
+    if useRatios:
+        [Ficl, noScan, nopScan, iclScan, RScan, QScan, fScan] = shootRatiosBatch(w, c, Escan, dx, (r[1]/r[0])**(l+0.5),
+                                                                                 decayRatio(Escan, r[len(r)-1] - r[len(r)-2]))
     else:
-        dE = 1e-1*bestdE
-	if np.fabs(dE) > 0.5:
-	    dE = 0.5*dE/np.fabs(dE)
-
-    print "Iteration ", i, ", E = ", E, ", dE = ", dE, ", nodes = ", no, nop, ", expected nodes = ", nodes(n, l), ", crossing zero at = ", icl
-    psi = toPsi(r, y)
-    psip = toPsi(r, yp)
-    exact_p = 2*np.exp(-r)   # solution for R(r) in Hydrogen, n = 1
-    idx = np.where(r > 5)
-    idx = idx[0][0]
-    if i % 10 == 0:
-      plt.clf()
-      plt.plot(r[0:idx], psi[0:idx], 'r-', label='$R_{-}$')
-      plt.plot(r[0:idx], psip[0:idx], 'b-', label='$R_{+}$')
-      plt.plot(r[0:idx], exact_p[0:idx], 'g--', label='$R_{exact}$')
-      plt.legend(('$R(r)$ from 0', '$R(r)$ from +$\\infty$', 'Exact $R(r)$'), frameon=False)
-      plt.xlabel('$r$')
-      plt.ylabel('$|R(r)|$')
-      #plt.text(0.01*0.6, psip[0]*0.85, '$E = $ %s' % E)
-      #plt.text(0.01*0.6, psip[0]*0.75, '$\\Delta E = $ %s' % dE)
-      plt.title('')
-      plt.draw()
-      plt.show()
-    E += dE
-    if dE > 0 and E > Emax:
-        E = Emax
-    elif dE < 0 and E < Emin:
-        E = Emin
-    prev_dE = dE
-    if np.fabs(dE) < 1e-8 or np.fabs(Emax - Emin) < 1e-5:
-      print "Converged to energy ", E*eV, " eV"
-      break
+        [Ficl, noScan, nopScan, iclScan, yScan, ypScan] = shootBatch(w, c, Escan, dx,
+                                                                     ((Z*r[0])**(l+0.5))/n, ((Z*r[1])**(l+0.5))/n,
+                                                                     np.exp(-np.sqrt(-2*Escan)*r[len(r)-1]), np.exp(-np.sqrt(-2*Escan)*r[len(r)-2]))
+    bracket = bracketEnergies(Escan, noScan, nodes(n, l))
+    if bracket is not None:
+        [Emin, Emax] = bracket
+        if E <= Emin or E >= Emax:
+            E = 0.5*(Emin + Emax)
+        print "Eigenvalue bracketed in [", Emin, ",", Emax, "], starting at E = ", E
+    leftRatio = np.exp(-(l+0.5)*dx)
+    # the level is below Emax: beyond the point where the WKB tail at Emax has decayed
+    # the solution is zero to double precision, so only propagate up to there (see shooting.wkbCutoff)
+    Nc = wkbCutoff(w, c, dx, Emax)
+    [rc, potc, w, c] = [r[0:Nc], pot[0:Nc], w[0:Nc], c[0:Nc]]
+    print "Outer cut-off at r = ", rc[Nc-1], " (", Nc, " of ", len(r), " points)"
+    # f and the solution buffers for every trial energy below
+    ws = NumerovWorkspace(w, c, dx)
+    # mismatch at the matching point, its derivative and the number of levels below E, for findLevel
+    # the Sturm sequence of the Numerov matrix counts the levels below E in O(N) without propagating anything,
+    # so only shoot once E is in the window of the level with nodes(n, l) zeroes
+    def shoot(E):
+        count = sturmCount(w, c, dx, E, None, leftRatio)[0]
+        if count < nodes(n, l) or count > nodes(n, l) + 1:
+            print "E = ", E, ", levels below E = ", count, ", expected nodes = ", nodes(n, l), ", bisecting"
+            return [np.nan, np.nan, count]
+        if useRatios:
+            [y, yp, icl, no, nop, Ficl, dFdE, levels] = solveRatios(rc, dx, potc, n, l, E, Z, ws)
+        else:
+            [y, yp, icl, no, nop, Ficl, dFdE, levels] = solve(rc, dx, potc, n, l, E, Z, ws)
+        print "E = ", E, ", nodes = ", no, nop, ", expected nodes = ", nodes(n, l), ", crossing zero at = ", icl
+        # once shot, count the levels from the matched solution: this goes from nodes(n, l) to nodes(n, l)+1
+        # exactly where F vanishes, while the boundary conditions of the Numerov matrix differ slightly
+        if np.isnan(Ficl):
+            return [Ficl, dFdE, count]
+        return [Ficl, dFdE, levels]
 
-print "Last energy ", E*eV, " eV"
-    
+    [E, Emin, Emax, iterations, evaluations, converged] = findLevel(shoot, nodes(n, l), Emin, Emax, E, 1e-8)
+    if converged:
+        print "Converged to energy ", E*eV, " eV after ", iterations, " iterations (", evaluations, " shooting passes)"
+    else:
+        print "Not converged after ", iterations, " iterations (", evaluations, " shooting passes): the level is in [", Emin*eV, ", ", Emax*eV, "] eV, using E = ", E*eV, " eV"
+
+    if useRatios:
+        [y, yp, icl, no, nop, Ficl, dFdE, levels] = solveRatios(rc, dx, potc, n, l, E, Z, ws)
+    else:
+        [y, yp, icl, no, nop, Ficl, dFdE, levels] = solve(rc, dx, potc, n, l, E, Z, ws)
+    # the solution is zero beyond the cut-off
+    return [E, r, padToGrid(y, len(r)), padToGrid(yp, len(r))]
 
+if richardsonDx is None:
+    [E, r, y, yp] = findEnergy(dx, Npoints, E, Emin, Emax)
+else:
+    # the same level on grids covering the same range of r, extrapolated to dx = 0
+    Elist = []
+    for [dxk, Nk] in zip(richardsonDx, equivalentGridSizes(dx, Npoints, richardsonDx)):
+        print "Grid with dx = ", dxk, " and ", Nk, " points"
+        [Ek, r, y, yp] = findEnergy(dxk, Nk, E, Emin, Emax)
+        Elist.append(Ek)
+    [E, Eerr, p] = extrapolate(richardsonDx, Elist)
+    print "Energies ", np.array(Elist)*eV, " eV extrapolated to dx = 0: ", E*eV, " eV (discretisation error on the finest grid ", Eerr*eV, " eV, order ", p, ")"
+psi = toPsi(r, y)
+psip = toPsi(r, yp)
+exact_p = 2*np.exp(-r)   # solution for R(r) in Hydrogen, n = 1
+idx = np.where(r > 5)
+idx = idx[0][0]
+plt.clf()
+plt.plot(r[0:idx], psi[0:idx], 'r-', label='$R_{-}$')
+plt.plot(r[0:idx], psip[0:idx], 'b-', label='$R_{+}$')
+plt.plot(r[0:idx], exact_p[0:idx], 'g--', label='$R_{exact}$')
+plt.legend(('$R(r)$ from 0', '$R(r)$ from +$\\infty$', 'Exact $R(r)$'), frameon=False)
+plt.xlabel('$r$')
+plt.ylabel('$|R(r)|$')
+plt.title('')
+plt.draw()
+plt.show()
 
+print "Last energy ", E*eV, " eV"
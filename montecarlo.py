@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+import hashlib
+import multiprocessing
+import numpy as np
+
+# Monte Carlo integration in blocks, used for the Coulomb (J) and exchange (K) integrals of hf_newton.py
+#
+# Drawing the samples one at a time and evaluating the integrand for each of them with numpy scalars
+# costs tens of microseconds per sample. Here the samples are drawn as blocks of blockSize points
+# uniform in [0, 1)^dim, and the integrand is evaluated for the whole block at once, so each sample
+# costs a few vectorised operations.
+# The mean and the variance are accumulated block by block (MCAccumulator, with the pairwise update
+# of Chan, Golub and LeVeque), so the memory does not grow with the number of samples and there is no
+# sum of squares to lose precision.
+#
+# Two ways to need fewer samples for the same error:
+#  - quasi-Monte Carlo: the points come from a low-discrepancy sequence (Sobol or Halton) instead of
+#    a pseudo-random generator, so the error falls almost as 1/N instead of 1/sqrt(N) for smooth integrands.
+#    The error is estimated from independent replicas of the sequence, each one randomly shifted
+#    (a random digital shift for Sobol, a random shift modulo 1 for Halton), so each replica is an
+#    unbiased estimate and their spread gives the error bar.
+#  - control variates: the integrand also returns h, a function with known mean, strongly correlated
+#    with it, and the estimate is mean(g) - c (mean(h) - known mean), with the c (cov(g, h)/var(h))
+#    that minimises the variance (ControlVariateAccumulator).
+#
+# N is then only a budget if a tolerance is given: the samples are drawn in batches, and the integration
+# stops as soon as the standard error of the mean is below the tolerance. The number of samples used is
+# in the samples attribute of the returned accumulator.
+#
+# The batches are independent tasks, each one with its own random stream (randomStream: the stream key of
+# numpy's SeedSequence, or a hash of the seed and the key with older numpy versions), so they can run on
+# a pool of worker processes (parallelMap). The partial means and variances of the tasks are merged
+# (merge, the same pairwise update) in the order of the tasks, and the tolerance is checked after each
+# of them, so a given seed gives bit-identical results whatever the number of workers.
+
+# the samples are numbers, or vectors (one row of values per sample, for an integrand with several
+# components, such as a potential on a grid), in which case mean, M2 and the errors are arrays
+class MCAccumulator:
+    n = 0
+    mean = 0.0
+    M2 = 0.0      # sum of the squared deviations from the mean
+    samples = 0   # integrand evaluations behind the mean (n, unless the samples are means of replicas)
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.samples = 0
+
+    # add a block of samples (one per row if they are vectors)
+    def add(self, values):
+        values = np.asarray(values, dtype = np.float64)
+        if values.ndim < 2:
+            values = values.ravel()
+        block = MCAccumulator()
+        block.n = len(values)
+        if block.n == 0:
+            return
+        block.mean = np.mean(values, axis = 0)
+        block.M2 = np.sum((values - block.mean)**2, axis = 0)
+        block.samples = block.n
+        self.merge(block)
+
+    # add the samples of another accumulator
+    def merge(self, other):
+        if other.n == 0:
+            return
+        delta = other.mean - self.mean
+        n = self.n + other.n
+        self.mean += delta*other.n/float(n)
+        self.M2 += other.M2 + delta**2*self.n*other.n/float(n)
+        self.n = n
+        self.samples += other.samples
+
+    # variance of the samples
+    def variance(self):
+        if self.n < 2:
+            return np.inf
+        return self.M2/float(self.n - 1)
+
+    # variance of the mean, the square of its statistical error
+    def varianceOfMean(self):
+        return self.variance()/float(max(self.n, 1))
+
+    # statistical error of the mean
+    def error(self):
+        return np.sqrt(self.varianceOfMean())
+
+# mean of g with h as control variate, where the mean of h is known (controlMean)
+# mean, varianceOfMean and error as in MCAccumulator, for the controlled estimate
+class ControlVariateAccumulator:
+    n = 0
+    controlMean = 0.0
+    meanG = 0.0
+    meanH = 0.0
+    M2G = 0.0     # sums of the squared deviations and of the products of the deviations
+    M2H = 0.0
+    CGH = 0.0
+    mean = 0.0
+    samples = 0   # as in MCAccumulator
+
+    def __init__(self, _controlMean):
+        self.n = 0
+        self.samples = 0
+        self.controlMean = _controlMean
+        self.meanG = 0.0
+        self.meanH = 0.0
+        self.M2G = 0.0
+        self.M2H = 0.0
+        self.CGH = 0.0
+        self.mean = 0.0
+
+    # optimal coefficient of the control variate
+    def coefficient(self):
+        if self.M2H <= 0:
+            return 0.0
+        return self.CGH/self.M2H
+
+    # add a block of samples of g and of h
+    def add(self, g, h):
+        g = np.asarray(g, dtype = np.float64).ravel()
+        h = np.asarray(h, dtype = np.float64).ravel()
+        block = ControlVariateAccumulator(self.controlMean)
+        block.n = len(g)
+        if block.n == 0:
+            return
+        block.meanG = np.mean(g)
+        block.meanH = np.mean(h)
+        block.M2G = np.sum((g - block.meanG)**2)
+        block.M2H = np.sum((h - block.meanH)**2)
+        block.CGH = np.sum((g - block.meanG)*(h - block.meanH))
+        block.samples = block.n
+        self.merge(block)
+
+    # add the samples of another accumulator (with the same controlMean)
+    def merge(self, other):
+        if other.n == 0:
+            return
+        dG = other.meanG - self.meanG
+        dH = other.meanH - self.meanH
+        n = self.n + other.n
+        f = self.n*other.n/float(n)
+        self.meanG += dG*other.n/float(n)
+        self.meanH += dH*other.n/float(n)
+        self.M2G += other.M2G + dG**2*f
+        self.M2H += other.M2H + dH**2*f
+        self.CGH += other.CGH + dG*dH*f
+        self.n = n
+        self.samples += other.samples
+        self.mean = self.meanG - self.coefficient()*(self.meanH - self.controlMean)
+
+    # variance of g - c h, for the optimal c
+    def variance(self):
+        if self.n < 3:
+            return np.inf
+        M2 = self.M2G - self.coefficient()*self.CGH
+        return max(M2, 0.0)/float(self.n - 2)
+
+    def varianceOfMean(self):
+        return self.variance()/float(max(self.n, 1))
+
+    def error(self):
+        return np.sqrt(self.varianceOfMean())
+
+# the first primes, the bases of the Halton sequence in each dimension
+_haltonBases = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]
+
+# points start ... start+n-1 of the Halton sequence in dim dimensions (dim <= 12), shape (n, dim)
+def halton(n, dim, start = 0):
+    if dim > len(_haltonBases):
+        raise ValueError("halton: at most %d dimensions" % len(_haltonBases))
+    # the point 0 is 0 in all dimensions: start at 1
+    index = np.arange(start+1, start+n+1)
+    x = np.zeros((n, dim))
+    for d in range(0, dim):
+        b = _haltonBases[d]
+        i = np.array(index)
+        f = 1.0
+        while np.any(i > 0):
+            f /= b
+            x[:, d] += f*(i % b)
+            i //= b
+    return x
+
+# direction numbers of the Sobol sequence (Joe and Kuo, new-joe-kuo-6.21201) for dimensions 2, 3, ...:
+# degree s of the primitive polynomial, its coefficients a and the initial m_1 ... m_s
+# (dimension 1 is the van der Corput sequence in base 2)
+_sobolPolynomials = [[1, 0, [1]],
+                     [2, 1, [1, 3]],
+                     [3, 1, [1, 3, 1]],
+                     [3, 2, [1, 1, 1]],
+                     [4, 1, [1, 1, 3, 3]],
+                     [4, 4, [1, 3, 5, 13]],
+                     [5, 2, [1, 1, 5, 5, 17]],
+                     [5, 4, [1, 1, 5, 5, 5]],
+                     [5, 7, [1, 1, 7, 11, 19]],
+                     [5, 11, [1, 1, 5, 1, 1]],
+                     [5, 13, [1, 1, 1, 3, 11]]]
+_sobolBits = 30
+
+# the direction numbers V_k = m_k 2^(bits-k) for k = 1 ... bits, in dimension d (0 based)
+def _sobolDirections(d):
+    V = np.zeros(_sobolBits, dtype = np.int64)
+    if d == 0:
+        for k in range(0, _sobolBits):
+            V[k] = 1 << (_sobolBits - k - 1)
+        return V
+    [s, a, m] = _sobolPolynomials[d-1]
+    for k in range(0, min(s, _sobolBits)):
+        V[k] = m[k] << (_sobolBits - k - 1)
+    for k in range(s, _sobolBits):
+        v = V[k-s] ^ (V[k-s] >> s)
+        for j in range(1, s):
+            if (a >> (s - 1 - j)) & 1:
+                v ^= V[k-j]
+        V[k] = v
+    return V
+
+# points start ... start+n-1 of the Sobol sequence in dim dimensions (dim <= 12), shape (n, dim)
+# as integers in [0, 2^30) if asIntegers is True (for the digital shift), otherwise in [0, 1)
+# the point i is the XOR of the direction numbers of the bits set in its Gray code i ^ (i >> 1)
+def sobol(n, dim, start = 0, asIntegers = False):
+    if dim > len(_sobolPolynomials) + 1:
+        raise ValueError("sobol: at most %d dimensions" % (len(_sobolPolynomials) + 1))
+    index = np.arange(start, start+n, dtype = np.int64)
+    gray = index ^ (index >> 1)
+    x = np.zeros((n, dim), dtype = np.int64)
+    for d in range(0, dim):
+        V = _sobolDirections(d)
+        for k in range(0, _sobolBits):
+            bit = (gray >> k) & 1
+            if not np.any(bit):
+                continue
+            x[:, d] ^= bit*V[k]
+    if asIntegers:
+        return x
+    return x/float(1 << _sobolBits)
+
+# a block of points start ... start+n-1 of the randomly shifted sequence ('sobol' or 'halton') in [0, 1)^dim
+# shift is an array with dim entries (integers in [0, 2^30) for 'sobol', uniform in [0, 1) for 'halton')
+def shiftedSequence(sequence, n, dim, start, shift):
+    if sequence == 'sobol':
+        return (sobol(n, dim, start, asIntegers = True) ^ shift)/float(1 << _sobolBits)
+    elif sequence == 'halton':
+        return np.mod(halton(n, dim, start) + shift, 1.0)
+    raise ValueError("Unknown sequence " + str(sequence))
+
+# a random shift for shiftedSequence
+def randomShift(sequence, dim, rng):
+    if sequence == 'sobol':
+        return rng.randint(0, 1 << _sobolBits, size = dim).astype(np.int64)
+    return rng.random_sample(dim)
+
+# a numpy.random.RandomState for the independent stream key (a tuple of integers) of seed
+# with numpy's SeedSequence if there is one (numpy >= 1.17), otherwise from a hash of seed and key
+def randomStream(seed, key):
+    key = tuple([int(k) for k in key])
+    if hasattr(np.random, 'SeedSequence'):
+        state = np.random.SeedSequence(int(seed), spawn_key = key).generate_state(8)
+    else:
+        digest = hashlib.sha256(repr((int(seed),) + key).encode('ascii')).digest()
+        state = np.frombuffer(digest, dtype = np.uint32)
+    return np.random.RandomState(state)
+
+# function of the running parallelMap, inherited by the forked workers
+# (so that it can be a closure, which could not be pickled)
+_parallelFunction = None
+
+def _callParallelFunction(task):
+    return _parallelFunction(task)
+
+# function(task) for each task, in order, on a pool of workers processes if workers > 1
+# the workers are forked (Linux and macOS), and function must not start a pool itself
+# the workers run ahead of the results consumed so far, and stop when the generator is closed
+def parallelImap(function, tasks, workers = 1):
+    global _parallelFunction
+    tasks = list(tasks)
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield function(task)
+        return
+    _parallelFunction = function
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        for result in pool.imap(_callParallelFunction, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _parallelFunction = None
+
+# [function(task) for task in tasks], on a pool of workers processes if workers > 1 (see parallelImap)
+def parallelMap(function, tasks, workers = 1):
+    return list(parallelImap(function, tasks, workers))
+
+# an accumulator for the integrand values, with the control variate if controlMean is not None
+def _newAccumulator(controlMean):
+    if controlMean is None:
+        return MCAccumulator()
+    return ControlVariateAccumulator(controlMean)
+
+# add the integrand values to acc (values is [g, h] with a control variate)
+def _addValues(acc, values, controlMean):
+    if controlMean is None:
+        acc.add(values)
+    else:
+        acc.add(values[0], values[1])
+
+# integrate over [0, 1)^dim: the mean of integrand(u) over N points u in [0, 1)^dim
+# integrand takes an array of shape (n, dim) and returns the n values
+# (or [g, h], with the control variate h, if controlMean, the mean of h, is given)
+# sequence is None for pseudo-random points, or 'sobol' or 'halton' for quasi-Monte Carlo,
+# in which case N is split in replicas randomly shifted copies of the sequence, whose means
+# are the samples of the returned accumulator (use a power of 2 for N/replicas with 'sobol')
+# the values can also be vectors, one row per point (but not with a control variate)
+# if tolerance is given, stop as soon as the error of the mean (the largest one for vectors) is below it,
+# with at most N samples:
+# pseudo-random points are added blockSize at a time, and the replicas of the sequence start with
+# blockSize/replicas points each, doubled until the error or the budget is reached
+# the blocks of pseudo-random points (or the shifts of the replicas) use the streams key + (k,) of seed,
+# where k counts the blocks (replicas), and run on workers processes; if seed is None it is drawn from
+# rng (a numpy.random.RandomState, the global numpy.random generator if it is None)
+# returns the MCAccumulator (or ControlVariateAccumulator) with the mean, its error and the samples used
+def integrate(integrand, dim, N, blockSize = 100000, rng = None, sequence = None, replicas = 16, controlMean = None, tolerance = None,
+              seed = None, key = (), workers = 1):
+    if seed is None:
+        if rng is None:
+            rng = np.random
+        seed = rng.randint(0, 2**31 - 1)
+    key = tuple(key)
+    if sequence is None:
+        # the block k has the samples k blockSize ... (k+1) blockSize - 1
+        def runBlock(k):
+            acc = _newAccumulator(controlMean)
+            nb = min(blockSize, N - k*blockSize)
+            values = integrand(randomStream(seed, key + (k,)).random_sample((nb, dim)))
+            _addValues(acc, values, controlMean)
+            return acc
+        acc = _newAccumulator(controlMean)
+        # the blocks computed ahead of the one that reaches the tolerance are dropped
+        blocks = parallelImap(runBlock, range(0, (N + blockSize - 1)//blockSize), workers)
+        for block in blocks:
+            acc.merge(block)
+            if tolerance is not None and np.max(acc.error()) <= tolerance:
+                blocks.close()
+                break
+        return acc
+    Nrep = max(N//replicas, 1)
+    target = Nrep
+    if tolerance is not None:
+        target = min(max(blockSize//replicas, 1), Nrep)
+    shifts = [randomShift(sequence, dim, randomStream(seed, key + (k,))) for k in range(0, replicas)]
+    reps = [MCAccumulator() for k in range(0, replicas)]
+    repsH = [MCAccumulator() for k in range(0, replicas)]
+    while True:
+        # the points reps[k].n ... target - 1 of the replica k
+        def runReplica(k):
+            segment = MCAccumulator()
+            segmentH = MCAccumulator()
+            while reps[k].n + segment.n < target:
+                nb = min(blockSize, target - reps[k].n - segment.n)
+                values = integrand(shiftedSequence(sequence, nb, dim, reps[k].n + segment.n, shifts[k]))
+                if controlMean is None:
+                    segment.add(values)
+                else:
+                    segment.add(values[0])
+                    segmentH.add(values[1])
+            return [segment, segmentH]
+        segments = parallelMap(runReplica, range(0, replicas), workers)
+        acc = _newAccumulator(controlMean)
+        for k in range(0, replicas):
+            reps[k].merge(segments[k][0])
+            repsH[k].merge(segments[k][1])
+            if controlMean is None:
+                acc.add([reps[k].mean])
+            else:
+                acc.add([reps[k].mean], [repsH[k].mean])
+        acc.samples = sum([rep.n for rep in reps])
+        if target >= Nrep or (tolerance is not None and np.max(acc.error()) <= tolerance):
+            return acc
+        target = min(2*target, Nrep)
+
+if __name__ == '__main__':
+    # the mean of x^2 + y^2 over [0, 1)^2 is 2/3
+    def integrand(u):
+        return u[:, 0]**2 + u[:, 1]**2
+    for sequence in [None, 'sobol', 'halton']:
+        acc = integrate(integrand, 2, 2**16, sequence = sequence, seed = 1)
+        assert abs(acc.mean - 2.0/3.0) < 4*acc.error(), [sequence, acc.mean, acc.error()]
+        print sequence, ': ', acc.mean, ' +- ', acc.error()
+    # x + y, with mean 1, as a control variate
+    def integrandCV(u):
+        return [integrand(u), u[:, 0] + u[:, 1]]
+    acc = integrate(integrandCV, 2, 2**16, controlMean = 1.0, seed = 1)
+    assert abs(acc.mean - 2.0/3.0) < 4*acc.error(), [acc.mean, acc.error()]
+    print 'control variate: ', acc.mean, ' +- ', acc.error()
+    # the tolerance stops the integration before the budget
+    acc = integrate(integrand, 2, 10**6, blockSize = 10000, tolerance = 1e-3, seed = 1)
+    assert acc.error() <= 1e-3 and acc.n < 10**6, [acc.error(), acc.n]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.signal
+from quadrature import LogGridQuadrature
+
+# Radial Poisson solver for the Hartree and exchange potentials of helium.py and hf_newton.py
+#
+# For a spherically symmetric "charge density" rho(r) (|R(r)|^2 for the direct potential, or the product
+# R_i(r) R_j(r) of two orbitals for the exchange one), the potential int rho(r')/|r - r'| d^3r' / (4 pi)
+# follows from Gauss' law (e0 = 1):
+# 0) Q(r) = sum_{r' <= r} rho(r') r'^2 dr'       (the charge inside r, divided by 4 pi)
+# 1) E(r) = Q(r)/r^2                             (the field at r)
+# 2) V(r) = V(r_max) + sum_{r' >= r} E(r') dr'   (integrated back from the end of the grid)
+# with dr_i = r_i - r_{i-1} (r_0 for the first point) in the first sum and r_{i+1} - r_i in the second,
+# as in the loops this replaces. Both sums are cumulative sums, so a whole stack of densities
+# (one row per orbital or per pair of orbitals) is done at once in O(N) vectorized operations.
+#
+# For densities that are not spherically symmetric, the multipole expansion
+# 1/|r1 - r2| = sum_l 4 pi/(2l+1) r<^l/r>^(l+1) sum_m Y*lm(O1) Ylm(O2)
+# needs the radial integrals (with the same weights r1^2 dr1 as Q above)
+# beta_l(r2) = sum_{r1} rho(r1) r<^l/r>^(l+1) r1^2 dr1
+#            = r2^-(l+1) sum_{r1 <= r2} rho(r1) r1^l r1^2 dr1 + r2^l sum_{r1 > r2} rho(r1) r1^-(l+1) r1^2 dr1
+# which are again two cumulative sums, one outward and one inward, so all l up to lmax cost O(N lmax).
+
+class GaussLawSolver:
+    r = None
+    r2dr = None   # r^2 dr for the enclosed charge
+    drOut = None  # r_{i+1} - r_i for the outer integral of the field
+
+    def __init__(self, _r):
+        self.r = np.asarray(_r, dtype = np.float64)
+        dr = np.empty(len(self.r))
+        dr[0] = self.r[0]
+        dr[1:] = np.diff(self.r)
+        self.r2dr = self.r**2*dr
+        self.drOut = np.diff(self.r)
+
+    # charge inside each r for rho, which is a single density or one row per density
+    def enclosedCharge(self, rho):
+        return np.cumsum(rho*self.r2dr, axis = -1)
+
+    # potential of rho (a single density or one row per density)
+    # if outerCharge is True, V(r_max) = Q(r_max)/r_max, the potential of the total charge,
+    # otherwise V(r_max) = 0
+    def potential(self, rho, outerCharge = True):
+        rho = np.asarray(rho, dtype = np.float64)
+        Q = self.enclosedCharge(rho)
+        E = Q/self.r**2
+        V = np.zeros(rho.shape)
+        V[..., :-1] = np.cumsum((E[..., :-1]*self.drOut)[..., ::-1], axis = -1)[..., ::-1]
+        if outerCharge:
+            V += Q[..., -1:]/self.r[-1]
+        return V
+
+    # beta_l above for l = 0 ... lmax, for rho (a single density or one row per density)
+    # returns an array with one entry per l in the first axis, and the shape of rho in the others
+    def multipoles(self, rho, lmax):
+        rho = np.asarray(rho, dtype = np.float64)
+        beta = np.zeros((lmax+1,) + rho.shape)
+        q = rho*self.r2dr
+        for l in range(0, lmax+1):
+            rl = self.r**l
+            rl1 = self.r**(l+1)
+            inner = np.cumsum(q*rl, axis = -1)
+            # the points beyond each r2, summed inward so that nothing is subtracted
+            outer = np.zeros(rho.shape)
+            outer[..., :-1] = np.cumsum((q/rl1)[..., :0:-1], axis = -1)[..., ::-1]
+            beta[l] = inner/rl1 + outer*rl
+        return beta
+
+# Radial Poisson equation with Numerov's method
+#
+# beta_l above is also the solution of the radial Poisson equation
+# (1/r) d^2(r beta)/dr^2 - l(l+1)/r^2 beta = -(2l+1) rho
+# that behaves as r^l close to r = 0 and as Q_l/r^(l+1) beyond the density, with Q_l = int rho r^(l+2) dr.
+# On the logarithmic grid r = exp(x), phi = sqrt(r) beta turns it into
+# d^2phi/dx^2 - (l+1/2)^2 phi = -(2l+1) r^(5/2) rho
+# which Numerov's method (as in numerov.py, with f = 1 - (l+1/2)^2 dx^2/12 and s = dx^2/12 times the right-hand side)
+# solves with O(dx^4) errors, against O(dx) for the sums of GaussLawSolver.
+# f does not depend on x, so the recurrence is a linear filter (scipy.signal.lfilter), run for all the densities at once.
+# The particular solution starts from phi = 0 at the first two points (the density contributes O(r^(l+5/2)) there),
+# and the regular solution of the homogeneous recurrence, lambda^i with lambda + 1/lambda = (12 - 10 f)/f,
+# is added to get beta(r_max) = Q_l/r_max^(l+1), with Q_l from the quadrature of quadrature.py.
+# Same interface as GaussLawSolver, so either can be used for the Hartree and exchange potentials.
+class NumerovPoissonSolver:
+    r = None
+    dx = 0
+    sqrtr = None
+    r52 = None    # r^(5/2) for the right-hand side
+    quad = None   # quadrature.LogGridQuadrature on r, for Q_l
+
+    # r must be a logarithmic grid, r_i = r_0 exp(i dx)
+    def __init__(self, _r):
+        self.quad = LogGridQuadrature(_r)
+        self.r = self.quad.r
+        self.dx = self.quad.dx
+        self.sqrtr = np.sqrt(self.r)
+        self.r52 = self.r**2.5
+
+    # beta_l for a single l, with beta(r_max) = Q_l/r_max^(l+1) if outerCharge is True, or 0 otherwise
+    def solve(self, rho, l, outerCharge = True):
+        rho = np.asarray(rho, dtype = np.float64)
+        N = len(self.r)
+        f = 1 - (l+0.5)**2*self.dx**2/12.0
+        g = (12 - 10*f)/f
+        s = -(2*l+1)*self.dx**2/12.0*self.r52*rho
+        # phi_{i+1} = g phi_i - phi_{i-1} + (s_{i+1} + 10 s_i + s_{i-1})/f, from phi_0 = phi_1 = 0
+        source = (s[..., 2:] + 10*s[..., 1:-1] + s[..., :-2])/f
+        phi = np.zeros(rho.shape)
+        phi[..., 2:] = scipy.signal.lfilter([1.0], [1.0, -g, 1.0], source, axis = -1)
+        lam = 0.5*(g + np.sqrt(g**2 - 4))
+        # regular homogeneous solution, 1 at the last point
+        phiH = lam**(np.arange(N) - (N-1.0))
+        target = 0.0
+        if outerCharge:
+            Q = self.quad.integrate(rho*self.r**(l+2))
+            target = Q/self.r[-1]**(l+1)*self.sqrtr[-1]
+        A = target - phi[..., -1]
+        phi += np.multiply.outer(A, phiH)
+        return phi/self.sqrtr
+
+    # potential of rho (a single density or one row per density), as GaussLawSolver.potential
+    def potential(self, rho, outerCharge = True):
+        return self.solve(rho, 0, outerCharge)
+
+    # beta_l for l = 0 ... lmax, as GaussLawSolver.multipoles
+    def multipoles(self, rho, lmax):
+        rho = np.asarray(rho, dtype = np.float64)
+        beta = np.zeros((lmax+1,) + rho.shape)
+        for l in range(0, lmax+1):
+            beta[l] = self.solve(rho, l)
+        return beta
+
+# Direct (Hartree) potential of a set of orbitals, updated incrementally between SCF iterations
+#
+# The direct potential is a sum of one contribution per orbital. Each contribution is kept with the density
+# it was calculated from, and it only has to be calculated again when that density changed by more than
+# tolerance (relative to its largest value): the total is then corrected by the difference between the
+# new and the old contribution, so the orbitals that did not move (usually the core) cost nothing.
+# The caller calculates the contributions (with any of the solvers above, for all the changed orbitals at once).
+class HartreeCache:
+    tolerance = 0
+    rho = None            # density of each orbital when its contribution was calculated
+    contribution = None   # contribution of each orbital to total
+    total = None          # sum of the contributions
+
+    def __init__(self, _tolerance = 1e-8):
+        self.tolerance = _tolerance
+        self.rho = {}
+        self.contribution = {}
+        self.total = None
+
+    # True if key has no contribution yet, or if rho differs from the density it was calculated from by more than tolerance
+    def changed(self, key, rho):
+        if not key in self.rho:
+            return True
+        old = self.rho[key]
+        return np.max(np.abs(rho - old)) > self.tolerance*np.max(np.abs(old))
+
+    # replace the contribution of key, calculated from rho, and update the total
+    def store(self, key, rho, contribution):
+        if self.total is None:
+            self.total = np.zeros(len(contribution))
+        if key in self.contribution:
+            self.total -= self.contribution[key]
+        self.total += contribution
+        self.rho[key] = np.array(rho, copy = True)
+        self.contribution[key] = np.array(contribution, copy = True)
+
+if __name__ == '__main__':
+    # the 1s orbital of hydrogen, R = 2 exp(-r), has the direct potential V = 1/r - (1 + 1/r) exp(-2r)
+    dx = 1e-2
+    r = np.exp(np.log(1e-5) + dx*np.arange(1500))
+    rho = 4*np.exp(-2*r)
+    exact = 1/r - (1 + 1/r)*np.exp(-2*r)
+    errNumerov = np.max(np.fabs(NumerovPoissonSolver(r).potential(rho) - exact))
+    errGauss = np.max(np.fabs(GaussLawSolver(r).potential(rho) - exact))
+    # O(dx^4) for Numerov, O(dx) for Gauss' law
+    assert errNumerov < 1e-8, errNumerov
+    assert errGauss < 1e-2, errGauss
+    beta = NumerovPoissonSolver(r).multipoles(rho, 1)
+    assert np.array_equal(beta[0], NumerovPoissonSolver(r).potential(rho))
+    print 'largest error of the 1s direct potential: ', errNumerov, ' (Numerov), ', errGauss, ' (Gauss\' law)'
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Radial integrals on the logarithmic grids of helium.py, hydrogen_auto.py, hf_newton.py and poisson.py
+#
+# All of them are int g(r) dr on r_i = exp(xmin + i dx)/C, with equally spaced x. With dr = r dx,
+# int g(r) dr = int g(r(x)) r(x) dx
+# is an integral of a smooth function on equally spaced points, so the Newton-Cotes rules apply:
+# Simpson's rule (errors O(dx^4)) or Bode's rule (O(dx^6)), instead of the rectangle rule with
+# dr = r_{i+1} - r_i (O(dx)) used so far.
+# The weights w_i (the Newton-Cotes weights in x times r_i) depend only on the grid, so they are
+# computed once, and each integral is the dot product sum_i g(r_i) w_i, for a single integrand or
+# for a stack of them (one per row).
+# The integral starts at r_0 and not at 0, which does not matter for the r^2 dr volume element, since r_0 is tiny.
+
+# Simpson weights for N equally spaced points with spacing dx
+# (Simpson's 3/8 rule on the last four points if N is even, and the trapezoidal rule for N = 2)
+def simpsonWeights(N, dx):
+    wt = np.zeros(N)
+    if N == 2:
+        wt[:] = 0.5*dx
+        return wt
+    M = N
+    if N % 2 == 0:
+        M = N - 3
+    if M >= 3:
+        wt[0:M:2] += 2.0
+        wt[1:M:2] += 4.0
+        wt[0] -= 1.0
+        wt[M-1] -= 1.0
+        wt[0:M] *= dx/3.0
+    if N % 2 == 0:
+        wt[N-4:] += np.array([3.0, 9.0, 9.0, 3.0])*dx/8.0
+    return wt
+
+# Bode weights for N equally spaced points with spacing dx
+# the intervals left over from the groups of four are done with Simpson's rule (2 intervals),
+# the 3/8 rule (3 intervals) or both (5 intervals, if there is a single one left over)
+def bodeWeights(N, dx):
+    M = N - 1
+    tail = M % 4
+    if tail == 1:
+        tail = 5
+    B = M - tail
+    if B < 4:
+        return simpsonWeights(N, dx)
+    wt = np.zeros(N)
+    for k, c in enumerate([7.0, 32.0, 12.0, 32.0, 7.0]):
+        wt[k:B-3+k:4] += c*2.0*dx/45.0
+    if tail == 2 or tail == 5:
+        wt[B:B+3] += np.array([1.0, 4.0, 1.0])*dx/3.0
+    if tail == 3:
+        wt[B:] += np.array([3.0, 9.0, 9.0, 3.0])*dx/8.0
+    if tail == 5:
+        wt[B+2:] += np.array([3.0, 9.0, 9.0, 3.0])*dx/8.0
+    return wt
+
+class LogGridQuadrature:
+    r = None
+    dx = 0
+    w = None      # int g(r) dr = sum_i g(r_i) w_i
+
+    # r must be a logarithmic grid, r_i = r_0 exp(i dx)
+    # rule is 'bode' or 'simpson'
+    def __init__(self, _r, rule = 'bode'):
+        self.r = np.asarray(_r, dtype = np.float64)
+        self.dx = np.log(self.r[1]/self.r[0])
+        if not np.allclose(np.diff(np.log(self.r)), self.dx):
+            raise ValueError("LogGridQuadrature needs a logarithmic grid")
+        if rule == 'bode':
+            self.w = bodeWeights(len(self.r), self.dx)*self.r
+        elif rule == 'simpson':
+            self.w = simpsonWeights(len(self.r), self.dx)*self.r
+        else:
+            raise ValueError("Unknown quadrature rule " + str(rule))
+
+    # int g(r) dr, for a single integrand or one per row of g
+    def integrate(self, g):
+        return np.dot(g, self.w)
+
+    # sqrt(int R(r)^2 r^2 dr)
+    def norm(self, R):
+        return np.sqrt(self.integrate(R**2*self.r**2))
+
+if __name__ == '__main__':
+    # int exp(-r) dr from r_0 to r_{N-1} = exp(-r_0) - exp(-r_{N-1}) on coarse grids up to r ~ 40
+    # (an even and an odd number of points), where the error of Simpson's rule is well above the rounding errors
+    errSimpson = []
+    for dx in [0.1, 0.05]:
+        r = np.exp(np.log(1e-4) + dx*np.arange(int(round(np.log(4e5)/dx)) + 1))
+        exact = np.exp(-r[0]) - np.exp(-r[-1])
+        errBode = LogGridQuadrature(r).integrate(np.exp(-r)) - exact
+        errSimpson.append(LogGridQuadrature(r, 'simpson').integrate(np.exp(-r)) - exact)
+        assert abs(errBode) < 1e-10 and abs(errSimpson[-1]) < 1e-9, [errBode, errSimpson[-1]]
+        print 'dx = ', dx, ', N = ', len(r), ': error ', errBode, ' (Bode), ', errSimpson[-1], ' (Simpson)'
+    order = np.log2(errSimpson[0]/errSimpson[1])
+    assert abs(order - 4) < 0.2, order
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Richardson extrapolation to dx = 0, shared by helium.py and hydrogen_auto.py
+#
+# A quantity computed on a grid with spacing dx behaves as
+# E(dx) = E(0) + A dx^p + B dx^(p+q) + ...
+# Numerov's method and the quadrature of quadrature.py have p = 4 (and q = 2), but the Gauss' law sums
+# of poisson.py are first order in dx, so when they enter the result p is 1.
+# Given E on a decreasing sequence of spacings, each column of the table
+# T[k][j] = T[k][j-1] + (T[k][j-1] - T[k-1][j-1])/((dx_{k-1}/dx_k)^(p + (j-1) q) - 1)
+# removes the next term of the expansion, one power at a time (exactly for constant ratios dx_{k-1}/dx_k,
+# as for the halved spacings in the examples of helium.py and hydrogen_auto.py).
+# p is 4 by default. The order observed in each three consecutive values (observedOrder) is compared with it:
+# differences at the noise level (of the SCF iterations, or of the root finder) give orders far from p,
+# and the extrapolated value is then worse than the finest grid, so a warning is printed.
+# The observed order can replace p (estimate = True), but only if it is stable, that is, within
+# orderTolerance of p for all the triples; otherwise p is kept.
+
+# order p of the leading error term from the last three values of E on the spacings dxList
+# (exact for constant ratios between the spacings)
+# returns NaN if the differences change sign (or one of them is zero)
+def observedOrder(dxList, values):
+    [h0, h1, h2] = dxList[-3:]
+    [E0, E1, E2] = values[-3:]
+    d01 = E0 - E1
+    d12 = E1 - E2
+    if d01 == 0 or d12 == 0 or d01*d12 < 0:
+        return np.nan
+    return np.log(d01/d12)/np.log(np.sqrt(h0*h1)/np.sqrt(h1*h2))
+
+# orders observed in each three consecutive values of E on the spacings dxList
+def observedOrders(dxList, values):
+    return [observedOrder(dxList[k-2:k+1], values[k-2:k+1]) for k in range(2, len(values))]
+
+# extrapolate the values of E on the (decreasing) spacings dxList to dx = 0
+# p is the order of the leading error term and q the step between the orders of the next ones
+# with three values or more, the observed orders are checked against p (see above): if one of them is NaN or
+# further than orderTolerance from p, a warning is printed and p is used anyway
+# if estimate is True and the observed orders are all within orderTolerance of p, the last of them replaces p
+# and only that term is removed
+# returns [E(0), error, p], where error = |E(0) - E(dx)| estimates the discretisation error of the finest grid
+def extrapolate(dxList, values, p = 4, q = 2, estimate = False, orderTolerance = 0.5):
+    K = len(values)
+    if K == 1:
+        return [values[0], np.nan, p]
+    columns = K - 1
+    if K >= 3:
+        orders = observedOrders(dxList, values)
+        stable = np.all(np.isfinite(orders)) and np.all(np.fabs(np.array(orders) - p) <= orderTolerance)
+        if not stable:
+            print "Richardson extrapolation: observed orders ", orders, " instead of ", p, ", the differences between the grids are not dominated by the O(dx^", p, ") error (too noisy or too coarse), using p = ", p
+        elif estimate:
+            p = orders[-1]
+            columns = 1
+    T = [[v] for v in values]
+    for k in range(1, K):
+        for j in range(1, min(k, columns)+1):
+            ratio = (float(dxList[k-1])/dxList[k])**(p + (j-1)*q)
+            T[k].append(T[k][j-1] + (T[k][j-1] - T[k-1][j-1])/(ratio - 1))
+    best = T[K-1][-1]
+    return [best, np.fabs(best - values[K-1]), p]
+
+# grids covering the same range as the one with spacing dx and N points, one per spacing in dxList
+# returns the number of points of each of them
+def equivalentGridSizes(dx, N, dxList):
+    return [int(np.round((N-1)*dx/h)) + 1 for h in dxList]
+
+# E = 1 + dx^4 + dx^6 is reproduced exactly from three halved spacings, and its order is observed as 4
+if __name__ == '__main__':
+    dxList = [0.1, 0.05, 0.025, 0.0125]
+    values = [1 + h**4 + h**6 for h in dxList]
+    [E, err, p] = extrapolate(dxList[:3], values[:3])
+    assert abs(E - 1) < 1e-14, E
+    [E, err, p] = extrapolate(dxList, values, estimate = True)
+    assert abs(p - 4) < 0.1 and abs(E - 1) < 1e-8, [E, p]
+    print 'extrapolate: ', E, ', observed order ', p
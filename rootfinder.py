@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Safeguarded eigenvalue root finder shared by helium.py, hydrogen_auto.py, harmonic.py and well.py
+#
+# Each script looks for the energy E of the level with a given number of nodes, where the mismatch
+# F(E) between the outward and the inward solutions at the matching point vanishes.
+# The function shoot(E) given to findLevel returns [F, dFdE, count], where
+# dFdE is the derivative of F (NaN if it is not available, which forces the other steps below) and
+# count is the number of levels below E (the Sturm count of eigensolver.py, or the outward node count).
+# F can also be NaN, for instance when E is so far from the level that shooting is skipped.
+#
+# The level with k nodes lies where count goes from k to k+1, so count alone keeps a bracket
+# [Emin, Emax] around it, which only ever shrinks. The next trial energy is, in order of preference:
+#  - the Newton step E - F/dFdE, if it lands inside the bracket;
+#  - an Illinois step (regula falsi between the bracket ends, halving F at an end that is kept twice),
+#    if F has opposite signs at the two ends;
+#  - the middle of the bracket.
+# As in Brent's method, a step that is not at least half as small as the one before the last is
+# replaced by bisection, so the bracket shrinks at least as fast as with bisection alone, and once
+# Newton takes over it converges quadratically.
+
+# find the level with the given number of nodes in [Emin, Emax], starting at E (the middle if it is None or outside)
+# stops when the Newton step or the bracket is smaller than tol, or after maxIter evaluations
+# returns [E, Emin, Emax, iterations, evaluations, converged], where evaluations counts the calls to shoot
+# that shot the solution (F is not NaN), iterations all of them, and converged is False if maxIter ran out
+# first (E is then the next trial energy, which was not shot)
+def findLevel(shoot, nodes, Emin, Emax, E = None, tol = 1e-10, maxIter = 100):
+    if E is None or E <= Emin or E >= Emax:
+        E = 0.5*(Emin + Emax)
+    Fmin = np.nan
+    Fmax = np.nan
+    # which end was replaced in the last iteration (-1 for Emin, +1 for Emax)
+    side = 0
+    # the last two steps
+    steps = [np.inf, np.inf]
+    nevals = 0
+    it = 0
+    converged = False
+    while it < maxIter:
+        it += 1
+        [F, dFdE, count] = shoot(E)
+        if np.isfinite(F):
+            nevals += 1
+        if F == 0:
+            converged = True
+            break
+        if count <= nodes:
+            Emin = E
+            Fmin = F
+            if side == -1:
+                Fmax *= 0.5
+            side = -1
+        else:
+            Emax = E
+            Fmax = F
+            if side == 1:
+                Fmin *= 0.5
+            side = 1
+        Enext = None
+        if np.isfinite(F) and np.isfinite(dFdE) and dFdE != 0:
+            En = E - F/dFdE
+            if np.fabs(En - E) < tol and En >= Emin and En <= Emax:
+                E = En
+                converged = True
+                break
+            if En > Emin and En < Emax:
+                Enext = En
+        if Enext is None and np.isfinite(Fmin) and np.isfinite(Fmax) and Fmin*Fmax < 0:
+            Enext = (Emin*Fmax - Emax*Fmin)/(Fmax - Fmin)
+        if Enext is None or np.fabs(Enext - E) > 0.5*steps[0]:
+            Enext = 0.5*(Emin + Emax)
+        steps = [steps[1], np.fabs(Enext - E)]
+        E = Enext
+        if Emax - Emin < tol:
+            converged = True
+            break
+    return [E, Emin, Emax, it, nevals, converged]
+
+if __name__ == '__main__':
+    # F(E) = E^2 - 2, with a single level (at sqrt(2)) in [0, 4]
+    def shoot(E):
+        return [E*E - 2, 2*E, int(E*E > 2)]
+    [E, Emin, Emax, iterations, evaluations, converged] = findLevel(shoot, 0, 0.0, 4.0)
+    assert converged and abs(E - np.sqrt(2)) < 1e-10, E
+    print 'findLevel with Newton steps: ', E, ' after ', iterations, ' iterations'
+    # without the derivative, only Illinois and bisection steps
+    def shootNoDerivative(E):
+        return [E*E - 2, np.nan, int(E*E > 2)]
+    [E, Emin, Emax, iterations, evaluations, converged] = findLevel(shootNoDerivative, 0, 0.0, 4.0)
+    assert converged and abs(E - np.sqrt(2)) < 1e-10, E
+    print 'findLevel without dF/dE: ', E, ' after ', iterations, ' iterations'
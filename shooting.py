@@ -0,0 +1,748 @@
+#!/usr/bin/env python
+
+import math
+import numpy as np
+
+# Numerov shooting kernels shared by helium.py, hydrogen_auto.py, harmonic.py and well.py
+#
+# All the scripts solve
+# d^2y/dx^2 + a(x) y = 0
+# with a(x) linear in the energy:
+# a(x) = w(x) E + c(x)
+# for the logarithmic grid (x = ln r, y = sqrt(r) R(r)):
+#   w = 2 m r^2,   c = - 2 m r^2 V - (l+0.5)^2
+# for the linear grid (harmonic.py, well.py):
+#   w = 2 m,       c = - 2 m V
+# and the Numerov auxiliary function is f = 1 + a dx^2/12
+#
+# The functions here take a whole vector of trial energies and propagate all of them
+# at once, as a 2-D array with shape (number of energies, number of grid points).
+# The loop over the grid is still done in Python, but each step is a vector operation
+# over all energies, so scanning many energies costs about as much as a single solve.
+# With a single energy (every call from rootfinder.findLevel) a vector operation per grid point
+# costs more than the arithmetic itself, so the loops run on plain floats instead, as in
+# eigensolver.sturmCount, with the same operations in the same order (so the same results).
+# They fall back to the vector loops if some f is exactly zero, where the plain floats would raise.
+
+# y0 given as a scalar or with one entry per energy, as a float, for the plain float loops
+def scalarValue(v):
+    return float(np.ravel(v)[0])
+
+# True if the grid-major buffer with one column per energy can be propagated with plain floats
+def singleEnergy(ft):
+    return ft.shape[1] == 1 and not np.any(ft[:, 0] == 0)
+
+# w and c above for the logarithmic grid r = exp(x)
+def logGridCoefficients(r, pot, l, m = 1.0):
+    w = 2*m*r**2
+    c = -2*m*r**2*pot - (l+0.5)**2
+    return [w, c]
+
+# w and c above for a linear grid
+def linearGridCoefficients(pot, m = 1.0):
+    w = 2*m*np.ones(len(pot))
+    c = -2*m*np.asarray(pot, dtype = np.float64)
+    return [w, c]
+
+# a and f above for a vector of energies
+# returns a and f with shape (len(Elist), len(w)) and the
+# index icl where a changes sign for each energy (-1 if it never does)
+def getAFBatch(w, c, Elist, dx):
+    Elist = np.atleast_1d(np.asarray(Elist, dtype = np.float64))
+    a = np.outer(Elist, w) + c[np.newaxis, :]
+    f = 1 + a*dx**2/12.0
+    change = a[:, 1:]*a[:, :-1] < 0
+    icl = np.argmax(change, axis = 1) + 1
+    icl[~np.any(change, axis = 1)] = -1
+    return [a, f, icl]
+
+# propagate y_{n+1} = ((12 - 10 f_n) y_n - f_{n-1} y_{n-1}) / f_{n+1}
+# for all energies at once, starting from y[:, 0] = y0 and y[:, 1] = y1
+# (y0 and y1 can be scalars or have one entry per energy)
+# also counts the number of zeroes of each solution
+def outwardBatch(f, y0, y1):
+    nE, N = f.shape
+    # grid-major copies, so that each step reads and writes contiguous memory
+    ft = np.ascontiguousarray(f.T)
+    yt = np.zeros((N, nE))
+    yt[0] = y0
+    yt[1] = y1
+    # wrong energies make the solution diverge, which is fine here
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        if singleEnergy(ft):
+            fl = ft[:, 0].tolist()
+            y = yt[:, 0].tolist()
+            for i in range(1, N-1):
+                y[i+1] = ((12 - fl[i]*10)*y[i] - fl[i-1]*y[i-1])/fl[i+1]
+            yt[:, 0] = y
+        else:
+            for i in range(1, N-1):
+                yt[i+1] = ((12 - ft[i]*10)*yt[i] - ft[i-1]*yt[i-1])/ft[i+1]
+        no = np.sum(yt[1:-1]*yt[2:] < 0, axis = 0)
+    return [yt.T, no]
+
+# propagate y_{n-1} = ((12 - 10 f_n) y_n - f_{n+1} y_{n+1}) / f_{n-1}
+# for all energies at once, starting from y[:, N-1] = yN1 and y[:, N-2] = yN2
+# also counts the number of zeroes of each solution
+def inwardBatch(f, yN1, yN2):
+    nE, N = f.shape
+    ft = np.ascontiguousarray(f.T)
+    yt = np.zeros((N, nE))
+    yt[N-1] = yN1
+    yt[N-2] = yN2
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        if singleEnergy(ft):
+            fl = ft[:, 0].tolist()
+            y = yt[:, 0].tolist()
+            for i in reversed(range(1, N-1)):
+                y[i-1] = ((12 - fl[i]*10)*y[i] - fl[i+1]*y[i+1])/fl[i-1]
+            yt[:, 0] = y
+        else:
+            for i in reversed(range(1, N-1)):
+                yt[i-1] = ((12 - ft[i]*10)*yt[i] - ft[i+1]*yt[i+1])/ft[i-1]
+        nop = np.sum(yt[:-2]*yt[1:-1] < 0, axis = 0)
+    return [yt.T, nop]
+
+# mismatch of the Numerov identity at icl for the function that is y up to icl-1
+# and yp (rescaled to be continuous with y at icl) from icl onwards
+# F = (12 - 10 f_icl) y_icl - f_{icl-1} y_{icl-1} - f_{icl+1} y_{icl+1}
+# it is NaN for energies with no classical turning point
+def matchingMismatch(f, y, yp, icl):
+    nE, N = f.shape
+    Ficl = np.empty(nE)
+    Ficl.fill(np.nan)
+    ok = np.where((icl >= 1) & (icl < N-1))[0]
+    i = icl[ok]
+    with np.errstate(over = 'ignore', invalid = 'ignore', divide = 'ignore'):
+        rat = np.ones(len(ok))
+        ypi = yp[ok, i]
+        yi = y[ok, i]
+        good = (yi != 0) & (ypi != 0)
+        rat[good] = yi[good]/ypi[good]
+        Ficl[ok] = (12 - 10*f[ok, i])*rat*ypi - f[ok, i-1]*y[ok, i-1] - f[ok, i+1]*rat*yp[ok, i+1]
+    return Ficl
+
+# shoot a vector of trial energies in one pass over the grid
+# w and c define a = w E + c (see logGridCoefficients and linearGridCoefficients)
+# y0, y1 are the outward starting values at the first two grid points
+# yN1, yN2 are the inward starting values at the last two grid points
+# (all four can be scalars or have one entry per energy)
+# returns the mismatch F(icl), the outward and inward node counts, icl and
+# the outward and inward solutions, one row per energy
+def shootBatch(w, c, Elist, dx, y0, y1, yN1, yN2):
+    [a, f, icl] = getAFBatch(w, c, Elist, dx)
+    [y, no] = outwardBatch(f, y0, y1)
+    [yp, nop] = inwardBatch(f, yN1, yN2)
+    Ficl = matchingMismatch(f, y, yp, icl)
+    return [Ficl, no, nop, icl, y, yp]
+
+# the outward node count is the number of eigenvalues below E:
+# it jumps from k to k+1 when E crosses the eigenvalue with k nodes
+# Elist must be sorted in increasing order
+# returns [Elow, Ehigh] around the eigenvalue with the requested number of nodes,
+# or None if the scan does not contain it
+def bracketEnergies(Elist, no, nodes):
+    for i in range(0, len(Elist)-1):
+        if no[i] <= nodes and no[i+1] > nodes:
+            return [Elist[i], Elist[i+1]]
+    return None
+
+# Renormalized Numerov (B. R. Johnson, J. Chem. Phys. 69, 4678 (1978))
+#
+# With u_i = f_i y_i the recurrence reads u_{i+1} = g_i u_i - u_{i-1}, with g_i = (12 - 10 f_i)/f_i.
+# Instead of u, carry the ratios of neighbouring points, which never overflow:
+# outward: R_i = u_{i+1}/u_i,     R_i = g_i - 1/R_{i-1}
+# inward:  Q_i = u_{i-1}/u_i,     Q_i = g_i - 1/Q_{i+1}
+# A negative ratio is a zero of the solution, so the nodes are counted from the ratios,
+# and the Numerov identity at icl for the matched solution is
+# F(icl)/u_icl = g_icl - 1/R_{icl-1} - 1/Q_{icl+1} = R_icl - 1/Q_{icl+1}
+# which does not depend on the (arbitrary) scale of the outward and inward solutions.
+# y itself is only rebuilt from the ratios when it is needed (see ratiosToY).
+
+# g_i above, for f with one row per energy
+def getG(f):
+    return (12 - 10*f)/f
+
+# outward ratios, starting from the ratio y_1/y_0 (a scalar or one per energy)
+# returns R with the same shape as f (the last column is unused) and the number of nodes
+def outwardRatios(f, y1y0):
+    nE, N = f.shape
+    gt = np.ascontiguousarray(getG(f).T)
+    ft = f.T
+    Rt = np.zeros((N, nE))
+    tiny = 1e-300
+    with np.errstate(divide = 'ignore'):
+        Rt[0] = y1y0*ft[1]/ft[0]
+        if nE == 1:
+            g = gt[:, 0].tolist()
+            R = Rt[:, 0].tolist()
+            for i in range(1, N-1):
+                Rprev = R[i-1]
+                if Rprev == 0:
+                    Rprev = tiny
+                R[i] = g[i] - 1.0/Rprev
+            Rt[:, 0] = R
+        else:
+            for i in range(1, N-1):
+                Rt[i] = gt[i] - 1.0/np.where(Rt[i-1] == 0, tiny, Rt[i-1])
+    # far out on long grids f < 0 (dx is too coarse there for Numerov) and the ratios alternate in sign
+    # there are no real zeroes that deep in the classically forbidden region, so only count where f > 0
+    no = np.sum((Rt[1:N-1] < 0) & (ft[1:N-1] > 0) & (ft[2:N] > 0), axis = 0)
+    return [Rt.T, no]
+
+# inward ratios, starting from the ratio y_{N-2}/y_{N-1} (a scalar or one per energy)
+# returns Q with the same shape as f (the first column is unused) and the number of nodes
+def inwardRatios(f, yN2yN1):
+    nE, N = f.shape
+    gt = np.ascontiguousarray(getG(f).T)
+    ft = f.T
+    Qt = np.zeros((N, nE))
+    tiny = 1e-300
+    with np.errstate(divide = 'ignore'):
+        Qt[N-1] = yN2yN1*ft[N-2]/ft[N-1]
+        if nE == 1:
+            g = gt[:, 0].tolist()
+            Q = Qt[:, 0].tolist()
+            for i in reversed(range(1, N-1)):
+                Qnext = Q[i+1]
+                if Qnext == 0:
+                    Qnext = tiny
+                Q[i] = g[i] - 1.0/Qnext
+            Qt[:, 0] = Q
+        else:
+            for i in reversed(range(1, N-1)):
+                Qt[i] = gt[i] - 1.0/np.where(Qt[i+1] == 0, tiny, Qt[i+1])
+    nop = np.sum((Qt[1:N-1] < 0) & (ft[0:N-2] > 0) & (ft[1:N-1] > 0), axis = 0)
+    return [Qt.T, nop]
+
+# scale-free mismatch R_icl - 1/Q_{icl+1} at the matching point, NaN where there is no icl
+def ratioMismatch(R, Q, icl):
+    nE, N = R.shape
+    D = np.empty(nE)
+    D.fill(np.nan)
+    ok = np.where((icl >= 1) & (icl < N-1))[0]
+    with np.errstate(divide = 'ignore'):
+        D[ok] = R[ok, icl[ok]] - 1.0/Q[ok, icl[ok]+1]
+    return D
+
+# rebuild the outward and inward solutions for a single energy (1-D f, R, Q), with u = f y = 1 at icl for both,
+# so that they are continuous there: below icl, u_{i-1} = u_i/R_{i-1} for the outward one (zero beyond icl),
+# and above it, u_{i+1} = u_i/Q_{i+1} for the inward one (zero below icl)
+# both only shrink away from icl, so this cannot overflow either
+def ratiosToBranches(f, R, Q, icl):
+    N = len(f)
+    uo = [0.0]*N
+    ui = [0.0]*N
+    uo[icl] = 1.0
+    ui[icl] = 1.0
+    Rl = R.tolist()
+    Ql = Q.tolist()
+    # a zero ratio makes the rest infinite, as the division by zero does in numpy, and those points are zeroed below
+    for i in reversed(range(1, icl+1)):
+        if Rl[i-1] == 0:
+            uo[i-1] = np.inf
+        else:
+            uo[i-1] = uo[i]/Rl[i-1]
+    for i in range(icl, N-1):
+        if Ql[i+1] == 0:
+            ui[i+1] = np.inf
+        else:
+            ui[i+1] = ui[i]/Ql[i+1]
+    [uo, ui] = [np.array(uo), np.array(ui)]
+    uo[~np.isfinite(uo)] = 0
+    ui[~np.isfinite(ui)] = 0
+    return [uo/f, ui/f]
+
+# the matched y for a single energy: the outward solution of ratiosToBranches up to icl and the inward one beyond it
+def ratiosToY(f, R, Q, icl):
+    [y, yp] = ratiosToBranches(f, R, Q, icl)
+    y[icl+1:] = yp[icl+1:]
+    return y
+
+# inward starting ratio y_{N-2}/y_{N-1} = exp(sqrt(-2 m E) (r_{N-1} - r_{N-2})) of the decaying solution exp(-sqrt(-2 m E) r)
+# far out on long logarithmic grids this overflows to inf, which inwardRatios handles (1/Q = 0 there)
+def decayRatio(Elist, dr, m = 1.0):
+    with np.errstate(over = 'ignore'):
+        return np.exp(np.sqrt(-2*m*np.asarray(Elist, dtype = np.float64))*dr)
+
+# same as shootBatch, but propagating ratios
+# y1y0 is y_1/y_0 and yN2yN1 is y_{N-2}/y_{N-1} (scalars or one per energy)
+# returns the scale-free mismatch, the node counts, icl and the ratios
+def shootRatiosBatch(w, c, Elist, dx, y1y0, yN2yN1):
+    [a, f, icl] = getAFBatch(w, c, Elist, dx)
+    [R, no] = outwardRatios(f, y1y0)
+    [Q, nop] = inwardRatios(f, yN2yN1)
+    D = ratioMismatch(R, Q, icl)
+    return [D, no, nop, icl, R, Q, f]
+
+# Energy derivatives
+#
+# f = 1 + (w E + c) dx^2/12, so df/dE = h = w dx^2/12 does not depend on E.
+# Differentiating Numerov's recurrence f_{i+1} y_{i+1} = (12 - 10 f_i) y_i - f_{i-1} y_{i-1}
+# gives the same recurrence for z = dy/dE, with a source term from y:
+# z_{i+1} = ((12 - 10 f_i) z_i - f_{i-1} z_{i-1} - 10 h_i y_i - h_{i-1} y_{i-1} - h_{i+1} y_{i+1}) / f_{i+1}
+# and for the ratios, with dg_i = dg/dE = -12 h_i/f_i^2:
+# dR_i = dg_i + dR_{i-1}/R_{i-1}^2,     dQ_i = dg_i + dQ_{i+1}/Q_{i+1}^2
+# Propagating them in the same loop as y (or R and Q) gives the mismatch and its exact
+# derivative with a single pass over the grid, instead of a second solve at E+dE.
+
+# h = df/dE above
+def getH(w, dx):
+    return w*dx**2/12.0
+
+# smallest and largest matching point of a batch of energies, so that the outward propagation can stop
+# at the largest one and the inward propagation at the smallest one
+# if any energy has no matching point, the whole grid, [0, N-1], is returned
+def matchingRange(icl, N):
+    if np.any(icl < 1) or np.any(icl >= N-1):
+        return [0, N-1]
+    return [np.min(icl), np.max(icl)]
+
+# The propagation loops below work on grid-major arrays (one row per grid point, one column per energy),
+# written in place, so that NumerovWorkspace can reuse its buffers; the *Derivative functions
+# allocate them and return the usual layout, with one row per energy.
+
+# propagate y and z = dy/dE outward in the grid-major yt and zt, from y0, y1, z0 and z1,
+# up to the point iend, with ft the grid-major f and hl = h as a list
+# returns the number of nodes of y up to iend
+def propagateOutwardDerivative(ft, hl, yt, zt, y0, y1, z0, z1, iend):
+    yt[0] = y0
+    yt[1] = y1
+    zt[0] = z0
+    zt[1] = z1
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        if singleEnergy(ft):
+            n = max(iend, 1) + 1
+            fl = ft[:n, 0].tolist()
+            y = yt[:n, 0].tolist()
+            z = zt[:n, 0].tolist()
+            for i in range(1, iend):
+                y[i+1] = ((12 - fl[i]*10)*y[i] - fl[i-1]*y[i-1])/fl[i+1]
+                z[i+1] = ((12 - fl[i]*10)*z[i] - fl[i-1]*z[i-1] - 10*hl[i]*y[i] - hl[i-1]*y[i-1] - hl[i+1]*y[i+1])/fl[i+1]
+            yt[:n, 0] = y
+            zt[:n, 0] = z
+        else:
+            for i in range(1, iend):
+                yt[i+1] = ((12 - ft[i]*10)*yt[i] - ft[i-1]*yt[i-1])/ft[i+1]
+                zt[i+1] = ((12 - ft[i]*10)*zt[i] - ft[i-1]*zt[i-1] - 10*hl[i]*yt[i] - hl[i-1]*yt[i-1] - hl[i+1]*yt[i+1])/ft[i+1]
+        no = np.sum(yt[1:iend]*yt[2:iend+1] < 0, axis = 0)
+    return no
+
+# propagate y and z = dy/dE inward in the grid-major yt and zt, from yN1, yN2, zN1 and zN2,
+# down to the point istart
+# returns the number of nodes of y down to istart
+def propagateInwardDerivative(ft, hl, yt, zt, yN1, yN2, zN1, zN2, istart):
+    N = len(yt)
+    yt[N-1] = yN1
+    yt[N-2] = yN2
+    zt[N-1] = zN1
+    zt[N-2] = zN2
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        if singleEnergy(ft):
+            n = min(istart, N-2)
+            fl = [0.0]*n + ft[n:, 0].tolist()
+            y = [0.0]*n + yt[n:, 0].tolist()
+            z = [0.0]*n + zt[n:, 0].tolist()
+            for i in reversed(range(istart+1, N-1)):
+                y[i-1] = ((12 - fl[i]*10)*y[i] - fl[i+1]*y[i+1])/fl[i-1]
+                z[i-1] = ((12 - fl[i]*10)*z[i] - fl[i+1]*z[i+1] - 10*hl[i]*y[i] - hl[i+1]*y[i+1] - hl[i-1]*y[i-1])/fl[i-1]
+            yt[n:, 0] = y[n:]
+            zt[n:, 0] = z[n:]
+        else:
+            for i in reversed(range(istart+1, N-1)):
+                yt[i-1] = ((12 - ft[i]*10)*yt[i] - ft[i+1]*yt[i+1])/ft[i-1]
+                zt[i-1] = ((12 - ft[i]*10)*zt[i] - ft[i+1]*zt[i+1] - 10*hl[i]*yt[i] - hl[i+1]*yt[i+1] - hl[i-1]*yt[i-1])/ft[i-1]
+        nop = np.sum(yt[istart:-2]*yt[istart+1:-1] < 0, axis = 0)
+    return nop
+
+# same as outwardBatch, also propagating z = dy/dE from z[:, 0] = z0 and z[:, 1] = z1
+# only the points up to iend are propagated (all of them by default), and the nodes are counted there
+def outwardBatchDerivative(f, h, y0, y1, z0 = 0, z1 = 0, iend = None):
+    nE, N = f.shape
+    if iend is None:
+        iend = N-1
+    ft = np.ascontiguousarray(f.T)
+    yt = np.zeros((N, nE))
+    zt = np.zeros((N, nE))
+    no = propagateOutwardDerivative(ft, h.tolist(), yt, zt, y0, y1, z0, z1, iend)
+    return [yt.T, zt.T, no]
+
+# same as inwardBatch, also propagating z = dy/dE from z[:, N-1] = zN1 and z[:, N-2] = zN2
+# only the points down to istart are propagated (all of them by default), and the nodes are counted there
+def inwardBatchDerivative(f, h, yN1, yN2, zN1 = 0, zN2 = 0, istart = 0):
+    nE, N = f.shape
+    ft = np.ascontiguousarray(f.T)
+    yt = np.zeros((N, nE))
+    zt = np.zeros((N, nE))
+    nop = propagateInwardDerivative(ft, h.tolist(), yt, zt, yN1, yN2, zN1, zN2, istart)
+    return [yt.T, zt.T, nop]
+
+# the mismatch of matchingMismatch and its derivative with respect to E
+# with s = yp_{icl+1}/yp_icl, the matched solution has y_{icl+1} = y_icl s, so
+# F = (12 - 10 f_icl) y_icl - f_{icl-1} y_{icl-1} - f_{icl+1} y_icl s
+# and the scale of the inward solution drops out
+def matchingMismatchDerivative(f, h, y, z, yp, zp, icl):
+    nE, N = f.shape
+    Ficl = matchingMismatch(f, y, yp, icl)
+    dF = np.empty(nE)
+    dF.fill(np.nan)
+    ok = np.where((icl >= 1) & (icl < N-1))[0]
+    i = icl[ok]
+    with np.errstate(over = 'ignore', invalid = 'ignore', divide = 'ignore'):
+        s = yp[ok, i+1]/yp[ok, i]
+        # ds/dE, written so that large inward solutions do not overflow
+        ds = (zp[ok, i+1] - s*zp[ok, i])/yp[ok, i]
+        dF[ok] = (-10*h[i]*y[ok, i] + (12 - 10*f[ok, i])*z[ok, i] - h[i-1]*y[ok, i-1] - f[ok, i-1]*z[ok, i-1]
+                  - h[i+1]*y[ok, i]*s - f[ok, i+1]*(z[ok, i]*s + y[ok, i]*ds))
+    return [Ficl, dF]
+
+# same as shootBatch, but also returns dF/dE and the number of levels below each energy (see levelCount)
+# z0, z1, zN1 and zN2 are the derivatives of the starting values with respect to E
+# the outward solution is only propagated up to icl+1 and the inward one down to icl-1
+# (the largest and smallest icl of all energies), as nothing else is used by the matched solution;
+# so y beyond icl+1 and yp below icl-1 are zero, and no and nop only count the nodes of the kept parts
+def shootDerivativeBatch(w, c, Elist, dx, y0, y1, yN1, yN2, z0 = 0, z1 = 0, zN1 = 0, zN2 = 0):
+    [a, f, icl] = getAFBatch(w, c, Elist, dx)
+    h = getH(w, dx)
+    [lo, hi] = matchingRange(icl, len(w))
+    [y, z, no] = outwardBatchDerivative(f, h, y0, y1, z0, z1, min(hi+1, len(w)-1))
+    [yp, zp, nop] = inwardBatchDerivative(f, h, yN1, yN2, zN1, zN2, max(lo-1, 0))
+    [Ficl, dF] = matchingMismatchDerivative(f, h, y, z, yp, zp, icl)
+    levels = levelCount(f, y, yp, Ficl, icl)
+    return [Ficl, dF, no, nop, icl, y, yp, levels]
+
+# derivative of decayRatio with respect to E: d/dE exp(k dr) = - m dr/k exp(k dr), with k = sqrt(-2 m E)
+def decayRatioDerivative(Elist, dr, m = 1.0):
+    Elist = np.asarray(Elist, dtype = np.float64)
+    k = np.sqrt(-2*m*Elist)
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        return -m*dr/k*np.exp(k*dr)
+
+# propagate R and dR/dE outward in the grid-major Rt and dRt, from the ratio y1y0 = y_1/y_0 and its derivative,
+# up to R_iend, with gt and dgt the grid-major g and dg/dE
+# returns the number of nodes up to iend
+def propagateOutwardRatios(ft, h, gt, dgt, Rt, dRt, y1y0, dy1y0, iend):
+    tiny = 1e-300
+    with np.errstate(divide = 'ignore', over = 'ignore', invalid = 'ignore'):
+        Rt[0] = y1y0*ft[1]/ft[0]
+        dRt[0] = dy1y0*ft[1]/ft[0] + y1y0*(h[1]*ft[0] - ft[1]*h[0])/ft[0]**2
+        if Rt.shape[1] == 1:
+            n = iend + 1
+            g = gt[:n, 0].tolist()
+            dg = dgt[:n, 0].tolist()
+            R = Rt[:n, 0].tolist()
+            dR = dRt[:n, 0].tolist()
+            for i in range(1, n):
+                Rprev = R[i-1]
+                if Rprev == 0:
+                    Rprev = tiny
+                R[i] = g[i] - 1.0/Rprev
+                # Rprev**2 as a product, which gives inf instead of raising on overflow (and 0 on underflow, with tiny)
+                R2 = Rprev*Rprev
+                if R2 == 0:
+                    R2 = tiny
+                dR[i] = dg[i] + dR[i-1]/R2
+            Rt[:n, 0] = R
+            dRt[:n, 0] = dR
+        else:
+            for i in range(1, iend+1):
+                Rprev = np.where(Rt[i-1] == 0, tiny, Rt[i-1])
+                Rt[i] = gt[i] - 1.0/Rprev
+                dRt[i] = dgt[i] + dRt[i-1]/Rprev**2
+    no = np.sum((Rt[1:iend+1] < 0) & (ft[1:iend+1] > 0) & (ft[2:iend+2] > 0), axis = 0)
+    return no
+
+# propagate Q and dQ/dE inward in the grid-major Qt and dQt, from the ratio yN2yN1 = y_{N-2}/y_{N-1}
+# and its derivative, down to Q_istart
+# returns the number of nodes down to istart
+def propagateInwardRatios(ft, h, gt, dgt, Qt, dQt, yN2yN1, dyN2yN1, istart):
+    N = len(Qt)
+    tiny = 1e-300
+    with np.errstate(divide = 'ignore', over = 'ignore', invalid = 'ignore'):
+        Qt[N-1] = yN2yN1*ft[N-2]/ft[N-1]
+        dQt[N-1] = dyN2yN1*ft[N-2]/ft[N-1] + yN2yN1*(h[N-2]*ft[N-1] - ft[N-2]*h[N-1])/ft[N-1]**2
+        # an infinite starting ratio (see decayRatio) has 1/Q = 0 and no dependence on E
+        dQt[N-1][~np.isfinite(Qt[N-1])] = 0
+        if Qt.shape[1] == 1:
+            g = gt[:, 0].tolist()
+            dg = dgt[:, 0].tolist()
+            Q = Qt[:, 0].tolist()
+            dQ = dQt[:, 0].tolist()
+            for i in reversed(range(istart, N-1)):
+                Qnext = Q[i+1]
+                if Qnext == 0:
+                    Qnext = tiny
+                Q[i] = g[i] - 1.0/Qnext
+                if math.isinf(Qnext) or math.isnan(Qnext):
+                    dQ[i] = dg[i]
+                else:
+                    Q2 = Qnext*Qnext
+                    if Q2 == 0:
+                        Q2 = tiny
+                    dQ[i] = dg[i] + dQ[i+1]/Q2
+            Qt[istart:, 0] = Q[istart:]
+            dQt[istart:, 0] = dQ[istart:]
+        else:
+            for i in reversed(range(istart, N-1)):
+                Qnext = np.where(Qt[i+1] == 0, tiny, Qt[i+1])
+                Qt[i] = gt[i] - 1.0/Qnext
+                dQt[i] = dgt[i] + np.where(np.isfinite(Qnext), dQt[i+1]/Qnext**2, 0)
+    nop = np.sum((Qt[istart:N-1] < 0) & (ft[istart-1:N-2] > 0) & (ft[istart:N-1] > 0), axis = 0)
+    return nop
+
+# same as outwardRatios, also propagating dR = dR/dE
+# dy1y0 is the derivative of the starting ratio y_1/y_0 with respect to E
+# only R_0 ... R_iend are propagated (all of them by default), and the nodes are counted there
+def outwardRatiosDerivative(f, h, y1y0, dy1y0 = 0, iend = None):
+    nE, N = f.shape
+    if iend is None:
+        iend = N-2
+    gt = np.ascontiguousarray(getG(f).T)
+    dgt = np.ascontiguousarray((-12*h[np.newaxis, :]/f**2).T)
+    Rt = np.zeros((N, nE))
+    dRt = np.zeros((N, nE))
+    no = propagateOutwardRatios(f.T, h, gt, dgt, Rt, dRt, y1y0, dy1y0, iend)
+    return [Rt.T, dRt.T, no]
+
+# same as inwardRatios, also propagating dQ = dQ/dE
+# dyN2yN1 is the derivative of the starting ratio y_{N-2}/y_{N-1} with respect to E
+# only Q_istart ... Q_{N-1} are propagated (all of them by default), and the nodes are counted there
+def inwardRatiosDerivative(f, h, yN2yN1, dyN2yN1 = 0, istart = 1):
+    nE, N = f.shape
+    gt = np.ascontiguousarray(getG(f).T)
+    dgt = np.ascontiguousarray((-12*h[np.newaxis, :]/f**2).T)
+    Qt = np.zeros((N, nE))
+    dQt = np.zeros((N, nE))
+    nop = propagateInwardRatios(f.T, h, gt, dgt, Qt, dQt, yN2yN1, dyN2yN1, istart)
+    return [Qt.T, dQt.T, nop]
+
+# ratioMismatch and its derivative dD/dE = dR_icl + dQ_{icl+1}/Q_{icl+1}^2
+def ratioMismatchDerivative(R, dR, Q, dQ, icl):
+    nE, N = R.shape
+    D = ratioMismatch(R, Q, icl)
+    dD = np.empty(nE)
+    dD.fill(np.nan)
+    ok = np.where((icl >= 1) & (icl < N-1))[0]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        dD[ok] = dR[ok, icl[ok]] + dQ[ok, icl[ok]+1]/Q[ok, icl[ok]+1]**2
+    return [D, dD]
+
+# same as shootRatiosBatch, but also returns dD/dE and the number of levels below each energy (see ratioLevelCount)
+# dy1y0 and dyN2yN1 are the derivatives of the starting ratios with respect to E
+# only R_0 ... R_icl and Q_{icl+1} ... Q_{N-1} are propagated (for the largest and smallest icl of all energies),
+# which is all the matched solution uses, and no and nop only count the nodes there
+def shootRatiosDerivativeBatch(w, c, Elist, dx, y1y0, yN2yN1, dy1y0 = 0, dyN2yN1 = 0):
+    [a, f, icl] = getAFBatch(w, c, Elist, dx)
+    h = getH(w, dx)
+    [lo, hi] = matchingRange(icl, len(w))
+    [R, dR, no] = outwardRatiosDerivative(f, h, y1y0, dy1y0, min(hi, len(w)-2))
+    [Q, dQ, nop] = inwardRatiosDerivative(f, h, yN2yN1, dyN2yN1, max(lo+1, 1))
+    [D, dD] = ratioMismatchDerivative(R, dR, Q, dQ, icl)
+    levels = ratioLevelCount(f, R, Q, D, icl)
+    return [D, dD, no, nop, icl, R, Q, f, levels]
+
+# Number of levels below E, consistent with the root of the mismatch
+#
+# The matched solution (outward up to icl, inward from icl) has the same number of nodes k on both sides
+# of the level with k nodes, and the mismatch changes sign there. dR/dE and dQ/dE above are negative
+# (h > 0), so D = R_icl - 1/Q_{icl+1} decreases with E between its poles, and F = u_icl D.
+# The number of levels below E is then the number of nodes of the matched solution, plus one if D < 0.
+# Unlike the Sturm count of the Numerov matrix or the outward node count, whose boundary conditions
+# differ slightly from those of the shooting, this goes from k to k+1 exactly where F vanishes.
+
+# crossOut[:, j] and crossIn[:, j] are True where the outward and inward solutions change sign
+# between j and j+1; only the outward ones below icl and the inward ones above it are kept,
+# and as in outwardRatios, only where f > 0 at both points
+def matchedNodes(crossOut, crossIn, f, icl):
+    nE, N = f.shape
+    j = np.arange(N-1)[np.newaxis, :]
+    fpos = (f[:, :-1] > 0) & (f[:, 1:] > 0)
+    kept = np.where(j < icl[:, np.newaxis], crossOut, crossIn) & fpos
+    return np.sum(kept, axis = 1)
+
+# levels below each energy for the solutions of shootBatch or shootDerivativeBatch
+def levelCount(f, y, yp, Ficl, icl):
+    nE, N = f.shape
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        count = matchedNodes(y[:, :-1]*y[:, 1:] < 0, yp[:, :-1]*yp[:, 1:] < 0, f, icl)
+        ok = np.where((icl >= 1) & (icl < N-1))[0]
+        i = icl[ok]
+        count[ok] += Ficl[ok]*y[ok, i]*f[ok, i] < 0
+    return count
+
+# levels below each energy for the ratios of shootRatiosBatch or shootRatiosDerivativeBatch
+# R_j = u_{j+1}/u_j and Q_{j+1} = u_j/u_{j+1} are negative where u changes sign between j and j+1
+def ratioLevelCount(f, R, Q, D, icl):
+    count = matchedNodes(R[:, :-1] < 0, Q[:, 1:] < 0, f, icl)
+    count[D < 0] += 1
+    return count
+
+# WKB tail and per-orbital outer cut-off
+#
+# Beyond the outer classical turning point (a < 0 from there on) a bound state decays as
+# y ~ (-a)^(-1/4) exp(- sum sqrt(-a) dx), in the grid variable x, on either grid.
+# Once the exponent reaches tail (35 by default: exp(-35) ~ 6e-16 of the value at the turning point)
+# the rest of the grid only holds zeros to double precision, so a deeply bound orbital can be
+# propagated on a much shorter grid, starting the inward solution from the WKB ratio at the cut-off.
+# The cut-off is taken at the top of the bracket around the level (the farthest turning point)
+# and kept fixed while looking for it, so that F(E) stays a smooth function of E.
+
+# number of grid points to keep for the energy E (all of them if a is still positive at the end of the grid)
+def wkbCutoff(w, c, dx, E, tail = 35.0):
+    a = w*E + c
+    N = len(a)
+    allowed = np.where(a > 0)[0]
+    if len(allowed) == 0 or allowed[-1] >= N-2:
+        return N
+    itp = allowed[-1]
+    S = np.cumsum(np.sqrt(-a[itp+1:]))*dx
+    beyond = np.where(S > tail)[0]
+    if len(beyond) == 0:
+        return N
+    return min(itp + beyond[0] + 3, N)
+
+# inward starting ratio y_{N-2}/y_{N-1} of the WKB solution above at the last two points of w and c,
+# and its derivative with respect to E (Elist is a scalar or one entry per energy)
+# this replaces decayRatio, which assumes that the potential has vanished at the end of the grid
+def wkbRatio(w, c, dx, Elist):
+    Elist = np.asarray(Elist, dtype = np.float64)
+    a1 = w[-1]*Elist + c[-1]
+    a2 = w[-2]*Elist + c[-2]
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        k1 = np.sqrt(-a1)
+        k2 = np.sqrt(-a2)
+        ratio = (a1/a2)**0.25*np.exp(0.5*(k1 + k2)*dx)
+        dratio = ratio*(0.25*(w[-1]/a1 - w[-2]/a2) - 0.25*(w[-1]/k1 + w[-2]/k2)*dx)
+    return [ratio, dratio]
+
+# y from a cut grid, padded with zeros to the N points of the full grid
+def padToGrid(y, N):
+    return np.concatenate([y, np.zeros(N - len(y))])
+
+# Reusable shooting workspace
+#
+# f = 1 + (w E + c) dx^2/12 = f0 + E h, with f0 = 1 + c dx^2/12 and h = w dx^2/12,
+# so for a given grid, l and potential only the E h term changes from one trial energy to the next.
+# NumerovWorkspace computes f0 and h once, and allocates once the grid-major buffers
+# for f, g, dg/dE and the outward and inward solutions (or ratios) and their derivatives.
+# For each trial energy, f (and g) are updated in place and the buffers are overwritten,
+# so nothing of the size of the grid is allocated or recomputed from r and V in the energy loop.
+# Its shoot methods return the same as shootDerivativeBatch and shootRatiosDerivativeBatch, but
+# the solutions returned are views of the buffers, so they are overwritten by the next call.
+# With nE = 1 (rootfinder.findLevel) the propagation itself runs on plain floats (see the top of this file),
+# which is most of the cost of a shot, and the buffers only hold the result.
+class NumerovWorkspace:
+    w = None      # a = w E + c
+    c = None
+    dx = 0
+    nE = 1        # number of energies shot at once
+    f0 = None     # f = f0 + E h
+    h = None
+    hl = None     # h as a list, for the propagation loops
+    m12h = None   # -12 h, for dg/dE = -12 h/f^2
+    Elist = None
+    ft = None     # grid-major buffers, one row per grid point and one column per energy
+    gt = None
+    dgt = None
+    above = None  # f > 1, that is a > 0
+    change = None # a changes sign between i-1 and i
+    yt = None     # y, or R for the ratios
+    zt = None     # dy/dE, or dR/dE
+    ypt = None    # yp, or Q for the ratios
+    zpt = None    # dyp/dE, or dQ/dE
+
+    def __init__(self, _w, _c, _dx, _nE = 1):
+        self.w = np.asarray(_w, dtype = np.float64)
+        self.c = np.asarray(_c, dtype = np.float64)
+        self.dx = _dx
+        self.nE = _nE
+        N = len(self.w)
+        self.f0 = 1 + self.c*_dx**2/12.0
+        self.h = getH(self.w, _dx)
+        self.hl = self.h.tolist()
+        self.m12h = -12*self.h[:, np.newaxis]
+        self.Elist = np.zeros(_nE)
+        self.ft = np.zeros((N, _nE))
+        self.gt = np.zeros((N, _nE))
+        self.dgt = np.zeros((N, _nE))
+        self.above = np.zeros((N, _nE), dtype = bool)
+        self.change = np.zeros((N-1, _nE), dtype = bool)
+        self.yt = np.zeros((N, _nE))
+        self.zt = np.zeros((N, _nE))
+        self.ypt = np.zeros((N, _nE))
+        self.zpt = np.zeros((N, _nE))
+
+    # update f in place for nE new energies (or a single one, if nE = 1)
+    # returns f, with one row per energy, and icl, as getAFBatch
+    def setEnergy(self, Elist):
+        self.Elist[:] = Elist
+        np.multiply(self.h[:, np.newaxis], self.Elist[np.newaxis, :], out = self.ft)
+        self.ft += self.f0[:, np.newaxis]
+        np.greater(self.ft, 1, out = self.above)
+        np.not_equal(self.above[1:], self.above[:-1], out = self.change)
+        icl = np.argmax(self.change, axis = 0) + 1
+        icl[~np.any(self.change, axis = 0)] = -1
+        return [self.ft.T, icl]
+
+    # same as shootDerivativeBatch for this workspace's w, c and dx
+    def shootDerivative(self, Elist, y0, y1, yN1, yN2, z0 = 0, z1 = 0, zN1 = 0, zN2 = 0):
+        [f, icl] = self.setEnergy(Elist)
+        N = len(self.w)
+        [lo, hi] = matchingRange(icl, N)
+        for b in [self.yt, self.zt, self.ypt, self.zpt]:
+            b.fill(0)
+        no = propagateOutwardDerivative(self.ft, self.hl, self.yt, self.zt, y0, y1, z0, z1, min(hi+1, N-1))
+        nop = propagateInwardDerivative(self.ft, self.hl, self.ypt, self.zpt, yN1, yN2, zN1, zN2, max(lo-1, 0))
+        [y, z, yp, zp] = [self.yt.T, self.zt.T, self.ypt.T, self.zpt.T]
+        [Ficl, dF] = matchingMismatchDerivative(f, self.h, y, z, yp, zp, icl)
+        levels = levelCount(f, y, yp, Ficl, icl)
+        return [Ficl, dF, no, nop, icl, y, yp, levels]
+
+    # same as shootRatiosDerivativeBatch for this workspace's w, c and dx
+    def shootRatiosDerivative(self, Elist, y1y0, yN2yN1, dy1y0 = 0, dyN2yN1 = 0):
+        [f, icl] = self.setEnergy(Elist)
+        N = len(self.w)
+        [lo, hi] = matchingRange(icl, N)
+        # g = 12/f - 10 and dg/dE = -12 h/f^2, in place
+        np.divide(12.0, self.ft, out = self.gt)
+        self.gt -= 10
+        np.multiply(self.ft, self.ft, out = self.dgt)
+        np.divide(self.m12h, self.dgt, out = self.dgt)
+        for b in [self.yt, self.zt, self.ypt, self.zpt]:
+            b.fill(0)
+        no = propagateOutwardRatios(self.ft, self.h, self.gt, self.dgt, self.yt, self.zt, y1y0, dy1y0, min(hi, N-2))
+        nop = propagateInwardRatios(self.ft, self.h, self.gt, self.dgt, self.ypt, self.zpt, yN2yN1, dyN2yN1, max(lo+1, 1))
+        [R, dR, Q, dQ] = [self.yt.T, self.zt.T, self.ypt.T, self.zpt.T]
+        [D, dD] = ratioMismatchDerivative(R, dR, Q, dQ, icl)
+        levels = ratioLevelCount(f, R, Q, D, icl)
+        return [D, dD, no, nop, icl, R, Q, f, levels]
+
+if __name__ == '__main__':
+    from rootfinder import findLevel
+    # hydrogen (Z = 1, l = 0) on a logarithmic grid up to r ~ 100: the levels are -1/(2 n^2) Hartree
+    dx = 5e-3
+    r = np.exp(np.log(1e-4) + dx*np.arange(2800))
+    [w, c] = logGridCoefficients(r, -1/r, 0)
+    y1y0 = np.exp(0.5*dx)
+    Escan = -np.logspace(0, np.log10(0.02), 100)
+    [D, no, nop, icl, R, Q, f] = shootRatiosBatch(w, c, Escan, dx, y1y0, wkbRatio(w, c, dx, Escan)[0])
+    ws = NumerovWorkspace(w, c, dx)
+    # two energies at once go through the vector loops
+    ws2 = NumerovWorkspace(w, c, dx, 2)
+    def shoot(E):
+        [yN2yN1, dyN2yN1] = wkbRatio(w, c, dx, E)
+        [D, dD, no, nop, icl, R, Q, f, levels] = ws.shootRatiosDerivative(E, y1y0, yN2yN1, 0, dyN2yN1)
+        return [D[0], dD[0], levels[0]]
+    for n in range(1, 4):
+        [Emin, Emax] = bracketEnergies(Escan, no, n-1)
+        [E, Emin, Emax, iterations, evaluations, converged] = findLevel(shoot, n-1, Emin, Emax)
+        assert converged and abs(E + 0.5/n**2) < 1e-5, [n, E]
+        # the plain float loops give the same as the vector loops
+        [yN2yN1, dyN2yN1] = wkbRatio(w, c, dx, [E, E])
+        single = ws.shootRatiosDerivative(E, y1y0, yN2yN1[0], 0, dyN2yN1[0])
+        pair = ws2.shootRatiosDerivative([E, E], y1y0, yN2yN1, 0, dyN2yN1)
+        assert single[0][0] == pair[0][0] and single[1][0] == pair[1][0], [single[0:2], pair[0:2]]
+        single = ws.shootDerivative(E, r[0]**0.5, r[1]**0.5, 1.0, yN2yN1[0], 0, 0, 0, dyN2yN1[0])
+        pair = ws2.shootDerivative([E, E], r[0]**0.5, r[1]**0.5, 1.0, yN2yN1, 0, 0, 0, dyN2yN1)
+        assert single[0][0] == pair[0][0] and single[1][0] == pair[1][0], [single[0:2], pair[0:2]]
+        print 'n = ', n, ': E = ', E, ' Hartree (', evaluations, ' shooting passes)'
@@ -3,6 +3,7 @@
 import sys
 import numpy as np
 import scipy.special
+import angular
 
 class bcolors:
     HEADER = '\033[4m'
@@ -41,259 +42,19 @@ def kappa(qr, l1, l2, b1, b2, l):
     k += sr**(l1 + l2)*np.exp(-sr**2 * (b1+b2)) * rl**l/rh**(l+1) * sr *dx
   return k
 
+# real spherical harmonics, with the arguments of scipy.special.sph_harm (theta is the azimuthal angle and phi the polar one)
+# Ylm = sqrt(2) (-1)^m Im(Y_l^|m|) for m < 0, Y_l^0 for m = 0 and sqrt(2) (-1)^m Re(Y_l^m) for m > 0
 def SphHarmReal(m, l, theta, phi):
   if m < 0:
-    return np.sqrt(2)*(-1.0)**m*scipy.special.sph_harm(m, l, theta, phi).imag
+    return np.sqrt(2)*(-1.0)**m*scipy.special.sph_harm(-m, l, theta, phi).imag
   elif m == 0:
     return scipy.special.sph_harm(m, l, theta, phi).real
   elif m > 0:
     return np.sqrt(2)*(-1.0)**m*scipy.special.sph_harm(m, l, theta, phi).real
 
+# Clebsch-Gordan coefficient <j1 m1 j2 m2|j m> for any j1, j2 (Racah's formula, see angular.py)
 def CG(j1, j2, m1, m2, j, m):
-    if abs(m) > j:
-        return 0
-    if j1 + j2 < j:
-        return 0
-    if abs(j1-j2) > j:
-        return 0
-    if m1+m2 != m:
-        return 0
-    if j1 < j2:
-        return (-1.0)**(j-j1-j2)*CG(j2,j1,m2,m1,j,m)
-    if m < 0:
-        return (-1.0)**(j-j1-j2)*CG(j1,j2,-m1,-m2,j,-m)
-    if j2 == 0:
-        if j == j1 and m == m1:
-            return 1
-        else:
-            return 0
-    elif j1 == 1 and j2 == 1:
-        if m == 2:
-            if m1 == 1 and m2 == 1 and j == 2:
-                return 1
-            else:
-                return 0
-        elif m == 1:
-            if m1 == 1 and m2 == 0 and j == 2:
-                return 0.5**0.5
-            elif m1 == 1 and m2 == 0 and j == 1:
-                return 0.5**0.5
-            elif m1 == 0 and m2 == 1 and j == 1:
-                return - (0.5**0.5)
-            elif m1 == 1 and m2 == 0 and j == 2:
-                return (0.5**0.5)
-            else:
-                return 0
-        elif m == 0:
-            if m1 == 1 and m2 == -1 and j == 2:
-                return (1.0/6.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 1:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 0:
-                return (1.0/3.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 2:
-                return (2.0/3.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 1:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 0:
-                return - (1.0/3.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 2:
-                return (1.0/6.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 1:
-                return - (1.0/2.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 0:
-                return (1.0/3.0)**0.5
-            else:
-                return 0
-        else:
-            return 0
-    elif j1 == 2 and j2 == 1:
-        if m == 3:
-            if m1 == 2 and m2 == 1 and j == 3:
-                return 1
-            else:
-                return 0
-        elif m == 2:
-            if m1 == 2 and m2 == 0 and j == 3:
-                return (1.0/3.0)**0.5
-            elif m1 == 2 and m2 == 0 and j == 2:
-                return (2.0/3.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 3:
-                return (2.0/3.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 2:
-                return - (1.0/3.0)**0.5
-            else:
-                return 0
-        elif m == 1:
-            if m1 == 2 and m2 == -1 and j == 3:
-                return (1.0/15.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 2:
-                return (1.0/3.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 1:
-                return (3.0/5.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 3:
-                return (8.0/15.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 2:
-                return (1.0/16.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 1:
-                return - (3.0/10.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 3:
-                return (2.0/5.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 2:
-                return -(1.0/2.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 1:
-                return (1.0/10.0)**0.5
-            else:
-                return 0
-        elif m == 0:
-            if m1 == 1 and m2 == -1 and j == 3:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 2:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 1:
-                return (3.0/10.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 3:
-                return (3.0/5.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 2:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 1:
-                return - (2.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 3:
-                return (1.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 2:
-                return - (1.0/2.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 1:
-                return - (3.0/10.0)**0.5
-            else:
-                return 0
-    elif j1 == 2 and j2 == 2:
-        if m == 4:
-            if m1 == 2 and m2 == 2 and j == 4:
-                return 1
-            else:
-                return 0
-        elif m == 3:
-            if m1 == 2 and m2 == 1 and j == 4:
-                return (1.0/2.0)**0.5
-            elif m1 == 2 and m2 == 1 and j == 3:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == 2 and j == 4:
-                return (1.0/2.0)**0.5
-            elif m1 == 1 and m2 == 2 and j == 3:
-                return - (1.0/2.0)**0.5
-            else:
-                return 0
-        elif m == 2:
-            if m1 == 2 and m2 == 0 and j == 4:
-                return (3.0/14.0)**0.5
-            elif m1 == 2 and m2 == 0 and j == 3:
-                return (1.0/2.0)**0.5
-            elif m1 == 2 and m2 == 0 and j == 2:
-                return (2.0/7.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 4:
-                return (4.0/7.0)**0.5
-            elif m1 == 1 and m2 == 1 and j == 3:
-                return 0
-            elif m1 == 1 and m2 == 1 and j == 2:
-                return - (3.0/7.0)**0.5
-            elif m1 == 0 and m2 == 2 and j == 4:
-                return (3.0/14.0)**0.5
-            elif m1 == 0 and m2 == 2 and j == 3:
-                return -(1.0/2.0)**0.5
-            elif m1 == 0 and m2 == 2 and j == 2:
-                return (2.0/7.0)**0.5
-            else:
-                return 0
-        elif m == 1:
-            if m1 == 2 and m2 == -1 and j == 4:
-                return (1.0/14.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 3:
-                return (3.0/10.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 2:
-                return (3.0/7.0)**0.5
-            elif m1 == 2 and m2 == -1 and j == 1:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 4:
-                return (3.0/7.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 3:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 2:
-                return - (1.0/14.0)**0.5
-            elif m1 == 1 and m2 == 0 and j == 1:
-                return - (3.0/10.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 4:
-                return (3.0/7.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 3:
-                return - (1.0/5.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 2:
-                return - (1.0/14.0)**0.5
-            elif m1 == 0 and m2 == 1 and j == 1:
-                return - (3.0/10.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 4:
-                return (1.0/14.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 3:
-                return - (3.0/10.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 2:
-                return (3.0/7.0)**0.5
-            elif m1 == -1 and m2 == 2 and j == 1:
-                return - (1.0/5.0)**0.5
-            else:
-                return 0
-        elif m == 0:
-            if m1 == 2 and m2 == -2 and j == 4:
-                return (1.0/70.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 3:
-                return (1.0/10.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 2:
-                return (2.0/7.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 1:
-                return (2.0/5.0)**0.5
-            elif m1 == 2 and m2 == -2 and j == 0:
-                return (1.0/5.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 4:
-                return (8.0/35.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 3:
-                return (2.0/5.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 2:
-                return (1.0/14.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 1:
-                return -(1.0/10.0)**0.5
-            elif m1 == 1 and m2 == -1 and j == 0:
-                return -(1.0/5.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 4:
-                return (18.0/35.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 3:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 2:
-                return -(2.0/7.0)**0.5
-            elif m1 == 0 and m2 == 0 and j == 1:
-                return 0
-            elif m1 == 0 and m2 == 0 and j == 0:
-                return (1.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 4:
-                return (8.0/35.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 3:
-                return -(2.0/5.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 2:
-                return (1.0/14.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 1:
-                return (1.0/10.0)**0.5
-            elif m1 == -1 and m2 == 1 and j == 0:
-                return -(1.0/5.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 4:
-                return (1.0/70.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 3:
-                return -(1.0/10.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 2:
-                return (2.0/7.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 1:
-                return -(2.0/5.0)**0.5
-            elif m1 == -2 and m2 == 2 and j == 0:
-                return (1.0/5.0)**0.5
-            else:
-                return 0
-
-    return 0
+    return angular.clebschGordan(j1, j2, m1, m2, j, m)
 
 
 '''